@@ -1,8 +1,8 @@
 import gradio as gr
 from llm_loader import load_model
-from processing import process_input
-from transcription_diarization import diarize_audio
-from visualization import create_charts
+from pipeline import AnalysisPipeline
+from instrumentation import RunMetrics, start_metrics_server
+from transcription_backends import DEFAULT_TRANSCRIPTION_BACKEND
 import time
 import re
 import cv2
@@ -11,36 +11,25 @@ from config import openai_api_key
 
 # Load the model
 llm = load_model(openai_api_key)
+analysis_pipeline = AnalysisPipeline(llm)
 
-def analyze_video(video_path, progress=gr.Progress()):
-    start_time = time.time()
-    if not video_path:
-        return [None] * 29  # Return None for all outputs
-
-    progress(0, desc="Starting analysis...")
-    progress(0.2, desc="Starting transcription and diarization")
-    transcription = diarize_audio(video_path)
-    progress(0.5, desc="Transcription and diarization complete.")
-
-    progress(0.6, desc="Processing transcription")
-    results = process_input(transcription, llm)
-    progress(0.7, desc="Transcription processing complete.")
-
-    progress(0.9, desc="Generating charts")
-    charts, explanations, general_impressions = create_charts(results)
-
-    progress(1.0, desc="Charts generation complete.")
-    
-    end_time = time.time()
-    execution_time = end_time - start_time
+# Sessions running analyze_video at once; the pipeline's per-stage limits bound the actual work
+MAX_CONCURRENT_ANALYSES = 32
+QUEUE_MAX_SIZE = 100
+# Prometheus metrics are served at /metrics on METRICS_PORT (e.g. 9464) when it is set; the
+# endpoint listens on localhost only unless METRICS_HOST says otherwise
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
 
+def build_outputs(status, transcription, chart_data):
     output_components = []  # transcript
 
-    output_components.append(f"Completed in {int(execution_time)} seconds.")
+    output_components.append(status)
     output_components.append(gr.Textbox(value=transcription, label="Transcript", lines=10, visible=True))
-                
+
+    charts, explanations, general_impressions = chart_data or ({}, {}, {})
+
     for i, (speaker_id, speaker_charts) in enumerate(charts.items(), start=1):
-        print(speaker_id)
         speaker_explanations = explanations[speaker_id]
         speaker_general_impression = general_impressions[speaker_id]
         
@@ -85,6 +74,34 @@ def analyze_video(video_path, progress=gr.Progress()):
     return output_components
 
 
+async def analyze_video(video_path, backend=DEFAULT_TRANSCRIPTION_BACKEND, progress=gr.Progress()):
+    # An async generator: stages run on the pipeline's pools and each speaker is shown when ready
+    start_time = time.time()
+    if not video_path:
+        yield [None] * 29  # Return None for all outputs
+        return
+
+    progress(0, desc="Starting analysis...")
+    progress(0.2, desc="Starting transcription and diarization")
+    # Audio upload progress fills the 0.2-0.3 band of the bar
+    upload_progress = lambda fraction, desc: progress(0.2 + 0.1 * (fraction or 0), desc=desc)
+
+    transcription, charts = "", None
+    metrics = RunMetrics()
+    async for status, transcription, results, charts in analysis_pipeline.run(video_path, upload_progress,
+                                                                              metrics=metrics, backend=backend):
+        if not results:
+            progress(0.5, desc="Transcription and diarization complete.")
+        else:
+            progress(0.7, desc=status)
+        yield build_outputs(f"{status} ({int(time.time() - start_time)} seconds)", transcription, charts)
+
+    progress(1.0, desc="Charts generation complete.")
+
+    execution_time = time.time() - start_time
+    yield build_outputs(f"Completed in {int(execution_time)} seconds.\n{metrics.summary()}", transcription, charts)
+
+
 
 with gr.Blocks() as iface:
     gr.Markdown("# Multiple Speakers Personality Analyzer")
@@ -92,13 +109,15 @@ with gr.Blocks() as iface:
 
     with gr.Row():
         video_input = gr.Video(label="Upload Video")
+        backend_input = gr.Radio(choices=[("Amazon Transcribe", 'aws'), ("Local (CPU, experimental)", 'local')],
+                                 value=DEFAULT_TRANSCRIPTION_BACKEND, label="Transcription")
     
     analyze_button = gr.Button("Analyze")
             
     # Create output components
     output_components = []
     # Add transcript output near the top
-    execution_box = gr.Textbox(label="Execution Info", value="N/A", lines=1)
+    execution_box = gr.Textbox(label="Execution Info", value="N/A", lines=1, max_lines=16)
     output_components.append(execution_box)
 
     transcript = gr.Textbox(label="Transcript", lines=10, visible=False)
@@ -144,11 +163,15 @@ with gr.Blocks() as iface:
 
     analyze_button.click(
         fn=analyze_video,
-        inputs=[video_input],
+        inputs=[video_input, backend_input],
         outputs=output_components,
-        show_progress=True
+        show_progress=True,
+        concurrency_limit=MAX_CONCURRENT_ANALYSES
     )
 
 
 if __name__ == "__main__":
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
+    iface.queue(default_concurrency_limit=MAX_CONCURRENT_ANALYSES, max_size=QUEUE_MAX_SIZE)
     iface.launch()
\ No newline at end of file
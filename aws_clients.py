@@ -0,0 +1,35 @@
+import threading
+import boto3
+from botocore.config import Config
+from config import aws_access_key_id, aws_secret_access_key
+
+AWS_REGION = 'eu-central-1'
+# Shared across all threads, so size the HTTP pool for parallel multipart parts and polling
+MAX_POOL_CONNECTIONS = 32
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """Process-wide boto3 client per service.
+
+    boto3 clients are thread-safe and keep a pool of HTTP connections, so sharing one client
+    avoids repeating credential and endpoint setup on every call.
+    """
+    with _lock:
+        if service_name not in _clients:
+            _clients[service_name] = boto3.client(
+                service_name,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=AWS_REGION,
+                config=Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries={'mode': 'adaptive'})
+            )
+        return _clients[service_name]
+
+
+def set_client(service_name, client):
+    """Replace the shared client, e.g. with a local stand-in from fake_backends."""
+    with _lock:
+        _clients[service_name] = client
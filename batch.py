@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from config import openai_api_key
+from instrumentation import RunMetrics
+from llm_loader import load_model
+from llm_scheduler import BATCH
+from pipeline import AnalysisPipeline, STAGE_LIMITS, backend_run_id
+from processing import empty_results, results_to_json
+from transcription_backends import DEFAULT_TRANSCRIPTION_BACKEND, TRANSCRIPTION_BACKENDS, get_backend
+from transcription_diarization import FAILED_TRANSCRIPTIONS
+
+MEDIA_EXTENSIONS = ('.mp4', '.mov', '.mkv', '.avi', '.webm', '.m4v', '.wav', '.mp3', '.m4a', '.flac', '.ogg')
+# Videos being worked on at once; bounds the temporary audio on disk, stage limits bound the work
+MAX_IN_FLIGHT = 16
+
+
+def find_videos(source):
+    """Absolute paths of the media files under a directory (recursively, sorted), or of those listed
+    in a manifest file. Paths are absolute so resuming matches them whatever the working directory.
+
+    A manifest has one path per line, relative to the manifest's directory; blank lines and
+    lines starting with '#' are skipped.
+    """
+    if os.path.isdir(source):
+        videos = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            videos.extend(os.path.abspath(os.path.join(root, name)) for name in sorted(files)
+                          if name.lower().endswith(MEDIA_EXTENSIONS))
+        return videos
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, 'r', encoding='utf-8') as file:
+        lines = [line.strip() for line in file]
+    return [os.path.abspath(os.path.join(base_dir, line)) for line in lines if line and not line.startswith('#')]
+
+
+def completed_videos(output_path):
+    """Videos already analysed successfully according to an existing JSONL output."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash
+            if record.get('status') == 'ok':
+                done.add(record['video'])
+    return done
+
+
+def export_charts(chart_data, charts_path):
+    """Write every speaker's charts and explanations into one HTML page."""
+    charts, explanations, general_impressions = chart_data
+    with open(charts_path, 'w', encoding='utf-8') as file:
+        file.write("<html><head><meta charset='utf-8'></head><body>\n")
+        first = True
+        for speaker_id, speaker_charts in charts.items():
+            file.write(f"<h2>{speaker_id}</h2>\n<p>{general_impressions.get(speaker_id, '')}</p>\n")
+            for name, figure in speaker_charts.items():
+                if figure is None:
+                    continue
+                # plotly.js is loaded once, from the CDN, by the first figure
+                file.write(figure.to_html(full_html=False, include_plotlyjs='cdn' if first else False))
+                first = False
+            for name, explanation in explanations.get(speaker_id, {}).items():
+                file.write(f"<p><b>{name}</b>: {explanation}</p>\n")
+        file.write("</body></html>\n")
+
+
+def charts_path_for(video_path, charts_dir, videos_root):
+    """Chart page of a video, mirroring its path under videos_root so equal file names don't collide."""
+    relative = os.path.relpath(video_path, videos_root) if videos_root else os.path.basename(video_path)
+    return os.path.join(charts_dir, f"{relative}.html")
+
+
+async def analyse_video(pipeline, video_path, charts_dir, backend=None, videos_root=None, run_id=None):
+    start_time = time.perf_counter()
+    record = {'video': video_path}
+    metrics = RunMetrics()
+    try:
+        transcription, results, chart_data = None, {}, None
+        async for _, transcription, results, chart_data in pipeline.run(video_path, run_id=run_id, metrics=metrics,
+                                                                        backend=backend):
+            pass
+        if transcription in FAILED_TRANSCRIPTIONS:
+            record.update(status='failed', error=transcription)
+        elif results == empty_results():
+            # The analysis failed and fell back to an empty result; failed records are retried on resume
+            record.update(status='failed', error="Analysis produced no results", transcription=transcription)
+        else:
+            record.update(status='ok', transcription=transcription, results=results_to_json(results))
+            if charts_dir and chart_data:
+                charts_path = charts_path_for(video_path, charts_dir, videos_root)
+                os.makedirs(os.path.dirname(charts_path), exist_ok=True)
+                await pipeline.run_stage('charts', export_charts, chart_data, charts_path)
+                record['charts'] = charts_path
+    except Exception as e:
+        record.update(status='failed', error=f"{type(e).__name__}: {e}")
+    record['seconds'] = round(time.perf_counter() - start_time, 2)
+    record['metrics'] = metrics.to_dict()
+    return record
+
+
+async def run_batch(videos, output_path, llm, charts_dir=None, stage_limits=None, max_in_flight=MAX_IN_FLIGHT,
+                    resume=True, use_cache=True, backend=None):
+    """Analyse videos concurrently, appending one JSON record per video to output_path.
+
+    Stages of different videos overlap (extraction of one while another is transcribed).
+    Chart pages mirror the videos' directories under charts_dir. With resume, videos recorded as
+    'ok' in output_path are skipped. A video listed twice, or with the same content as an earlier
+    one, is analysed once. backend names the transcription backend for every video. Returns run
+    statistics.
+    """
+    done = completed_videos(output_path) if resume else set()
+    unique = list(dict.fromkeys(videos))
+    pending = [video for video in unique if video not in done]
+    skipped = len(unique) - len(pending)
+    videos_root = os.path.commonpath([os.path.dirname(video) for video in videos]) if videos else None
+
+    pipeline = AnalysisPipeline(llm, stage_limits=stage_limits, use_cache=use_cache)
+    admission = asyncio.Semaphore(max_in_flight)
+    counts = {'ok': 0, 'failed': 0}
+    start_time = time.perf_counter()
+
+    with open(output_path, 'a' if resume else 'w', encoding='utf-8') as output:
+        async def worker(video_path, run_id):
+            async with admission:
+                record = await analyse_video(pipeline, video_path, charts_dir, backend, videos_root, run_id)
+            # Written and flushed per video, so a crash loses at most the videos in flight
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            counts[record['status']] += 1
+            print(f"[{sum(counts.values())}/{len(pending)}] {record['status']} {video_path} ({record['seconds']}s)")
+
+        try:
+            pending, duplicates = await _distinct_videos(pipeline, pending, backend)
+            repeated = len(videos) - len(unique) + len(duplicates)
+            print(f"{len(videos)} videos, {skipped} already done, {repeated} duplicates, {len(pending)} to analyse")
+            for video_path, original in duplicates.items():
+                print(f"Skipping {video_path}: same content as {original}")
+            await asyncio.gather(*(worker(video, run_id) for video, run_id in pending.items()))
+        finally:
+            pipeline.shutdown()
+
+    elapsed = time.perf_counter() - start_time
+    return {
+        'videos': len(pending),
+        'skipped': skipped,
+        'duplicates': repeated,
+        **counts,
+        'elapsed_s': round(elapsed, 1),
+        'videos_per_hour': round(3600 * counts['ok'] / elapsed, 1) if elapsed else 0.0,
+        'stages': pipeline.stats(),
+    }
+
+
+async def _distinct_videos(pipeline, videos, backend):
+    """Map each video with distinct content to its run ID, and each duplicate to the video it repeats.
+
+    Duplicates would share a run directory and wait on each other's run lock only to repeat the
+    same analysis, so they are dropped before scheduling. Missing files are kept, to be recorded
+    as failed by analyse_video.
+    """
+    backend = get_backend(backend)
+
+    async def run_id(video_path):
+        try:
+            return await pipeline.run_stage('extract', backend_run_id, video_path, backend)
+        except OSError:
+            return None
+
+    run_ids = await asyncio.gather(*(run_id(video) for video in videos))
+    distinct, duplicates, seen = {}, {}, {}
+    for video_path, video_run_id in zip(videos, run_ids):
+        if video_run_id in seen:
+            duplicates[video_path] = seen[video_run_id]
+            continue
+        if video_run_id is not None:
+            seen[video_run_id] = video_path
+        distinct[video_path] = video_run_id
+    return distinct, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse a directory or manifest of videos without the UI")
+    parser.add_argument('source', help="Directory of videos, or a manifest file with one path per line")
+    parser.add_argument('--output', default='results.jsonl', help="JSONL file receiving one record per video")
+    parser.add_argument('--charts-dir', help="Write an HTML page of charts per video into this directory")
+    parser.add_argument('--no-resume', action='store_true', help="Redo videos already in the output file")
+    parser.add_argument('--no-cache', action='store_true', help="Skip the transcript cache")
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument('--backend', choices=sorted(TRANSCRIPTION_BACKENDS), default=DEFAULT_TRANSCRIPTION_BACKEND,
+                        help="Transcription backend (default %(default)s; 'local' is experimental)")
+    for stage, limit in STAGE_LIMITS.items():
+        parser.add_argument(f'--{stage}-workers', type=int, default=limit,
+                            help=f"Videos in the {stage} stage at once (default {limit})")
+    args = parser.parse_args()
+
+    stage_limits = {stage: getattr(args, f'{stage}_workers') for stage in STAGE_LIMITS}
+    summary = asyncio.run(run_batch(find_videos(args.source), args.output, load_model(openai_api_key, priority=BATCH),
+                                    charts_dir=args.charts_dir, stage_limits=stage_limits,
+                                    max_in_flight=args.max_in_flight, resume=not args.no_resume,
+                                    use_cache=not args.no_cache, backend=args.backend))
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1523 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; children covers ffmpeg subprocesses
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_rss, children_rss) / 1024
+
+
+def _run_extraction(mode, video_path, audio_format, queue):
+    from transcription_diarization import convert_to_wav, convert_to_wav_moviepy
+
+    output_dir = tempfile.mkdtemp(prefix='bench_audio_')
+    try:
+        start_time = time.perf_counter()
+        if mode == 'moviepy':
+            output_path = convert_to_wav_moviepy(video_path, output_dir=output_dir)
+        else:
+            output_path = convert_to_wav(video_path, output_dir=output_dir, audio_format=audio_format)
+        wall_time = time.perf_counter() - start_time
+        queue.put({
+            'mode': mode if mode == 'moviepy' else f'stream-{audio_format}',
+            'wall_time_s': round(wall_time, 3),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'output_mb': round(os.path.getsize(output_path) / 2**20, 2) if output_path else None,
+        })
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def bench_audio_extraction(video_path, formats=('wav', 'flac', 'ogg')):
+    """Compare the moviepy full decode against streaming extraction, one fresh process per run."""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for mode, audio_format in [('moviepy', 'wav')] + [('stream', f) for f in formats]:
+        queue = context.Queue()
+        process = context.Process(target=_run_extraction, args=(mode, video_path, audio_format, queue))
+        process.start()
+        process.join()
+        if not queue.empty():
+            results.append(queue.get())
+    return results
+
+
+def synthetic_transcript(n_words, n_speakers=3, words_per_segment=20, item_labels=False, seed=0):
+    """Amazon Transcribe-shaped JSON with n_words pronunciations split into speaker segments."""
+    rng = random.Random(seed)
+    items, segments = [], []
+    t = 0.0
+    for start in range(0, n_words, words_per_segment):
+        speaker_label = f"spk_{rng.randrange(n_speakers)}"
+        segment_start = t
+        for i in range(start, min(start + words_per_segment, n_words)):
+            word_end = t + 0.1 + rng.random() * 0.4
+            item = {'type': 'pronunciation', 'start_time': f"{t:.3f}", 'end_time': f"{word_end:.3f}",
+                    'alternatives': [{'content': f"word{i}"}]}
+            if item_labels:
+                item['speaker_label'] = speaker_label
+            items.append(item)
+            if rng.random() < 0.08:
+                items.append({'type': 'punctuation', 'alternatives': [{'content': '.'}]})
+            t = word_end + 0.05
+        segments.append({'speaker_label': speaker_label, 'start_time': f"{segment_start:.3f}",
+                         'end_time': f"{t - 0.05:.3f}"})
+        t += 0.3
+    return {'results': {'speaker_labels': {'segments': segments}, 'items': items}}
+
+
+def _legacy_extract_transcriptions(transcript_data):
+    # Reference copy of the original O(words x segments) speaker lookup
+    segments = transcript_data['results']['speaker_labels']['segments']
+    current_speaker, current_text, transcriptions = None, [], []
+    speaker_mapping = {}
+    for item in transcript_data['results']['items']:
+        if item['type'] == 'pronunciation':
+            start_time, end_time = float(item['start_time']), float(item['end_time'])
+            speaker_segment = next((seg for seg in segments if float(seg['start_time']) <= start_time
+                                    and float(seg['end_time']) >= end_time), None)
+            if speaker_segment:
+                speaker_label = speaker_segment['speaker_label']
+                if speaker_label not in speaker_mapping:
+                    speaker_mapping[speaker_label] = f"Speaker {len(speaker_mapping) + 1}"
+                if speaker_mapping[speaker_label] != current_speaker:
+                    if current_text:
+                        transcriptions.append({'speaker': current_speaker, 'text': ' '.join(current_text)})
+                        current_text = []
+                    current_speaker = speaker_mapping[speaker_label]
+            current_text.append(item['alternatives'][0]['content'])
+        elif item['type'] == 'punctuation':
+            current_text[-1] += item['alternatives'][0]['content']
+    if current_text:
+        transcriptions.append({'speaker': current_speaker, 'text': ' '.join(current_text)})
+    return transcriptions
+
+
+def bench_speaker_assignment(sizes=(1_000, 10_000, 100_000, 1_000_000), legacy_limit=20_000):
+    """Scaling of word-to-speaker assignment; the legacy scan is only run on small inputs."""
+    from transcription_diarization import extract_transcriptions_with_speakers
+
+    results = []
+    for n_words in sizes:
+        for item_labels in (False, True):
+            transcript = synthetic_transcript(n_words, item_labels=item_labels)
+            start_time = time.perf_counter()
+            transcriptions = extract_transcriptions_with_speakers(transcript)
+            result = {'words': n_words, 'item_labels': item_labels,
+                      'indexed_s': round(time.perf_counter() - start_time, 4)}
+            if n_words <= legacy_limit and not item_labels:
+                start_time = time.perf_counter()
+                legacy = _legacy_extract_transcriptions(transcript)
+                result['legacy_s'] = round(time.perf_counter() - start_time, 4)
+                result['identical'] = legacy == transcriptions
+            results.append(result)
+    return results
+
+
+def bench_transcribe_jobs(n_jobs=50, failure_rate=0.1, malformed_rate=0.05, n_cancelled=2, seed=0):
+    """Run n_jobs concurrent jobs of mixed length through one TranscribeJobManager on a fake client.
+
+    Time is scaled down: a 60 s recording is transcribed in 3 s with 0.5 s queueing, and the
+    poll bounds are scaled to match. Some jobs fail, some complete without a transcript URI and
+    n_cancelled are cancelled by their caller; every other future must still resolve with its
+    own URI or error, else this raises.
+    """
+    from concurrent.futures import wait
+    from fake_backends import FakeTranscribeClient
+    from transcribe_jobs import TranscribeJobManager, TranscriptionError
+
+    rng = random.Random(seed)
+    durations = {f"s3://bench/audio_{i}.wav": rng.uniform(10, 120) for i in range(n_jobs)}
+    client = FakeTranscribeClient(queue_time=0.5, realtime_factor=0.05, audio_durations=durations,
+                                  failure_rate=failure_rate, malformed_rate=malformed_rate, seed=seed)
+    manager = TranscribeJobManager(lambda: client, min_interval=0.1, max_interval=1.5,
+                                   realtime_factor=0.05, startup=0.5, timeout=30)
+
+    start_time = time.perf_counter()
+    futures, resolved = {}, {}
+    for i, (uri, duration) in enumerate(durations.items()):
+        job_name = f"bench_job_{i}"
+        futures[job_name] = manager.submit(job_name, uri, audio_duration=duration)
+        futures[job_name].add_done_callback(lambda _, job_name=job_name: resolved.setdefault(job_name, time.monotonic()))
+    cancelled = set(list(futures)[:n_cancelled])
+    for job_name in cancelled:
+        futures[job_name].cancel()
+    _, pending = wait([futures[name] for name in futures if name not in cancelled], timeout=60)
+    wall_time = time.perf_counter() - start_time
+
+    mismatches = [f"{len(pending)} futures never resolved"] if pending else []
+    for job_name, future in futures.items():
+        if not future.done():
+            continue
+        job = client.jobs[job_name]
+        if job_name in cancelled:
+            expected = 'cancelled'
+        elif job['fails']:
+            expected = TranscriptionError
+        elif job['malformed']:
+            expected = KeyError
+        else:
+            expected = f"{client.transcript_uri_prefix}/{job_name}.json"
+        if future.cancelled():
+            outcome = 'cancelled'
+        elif future.exception() is not None:
+            outcome = type(future.exception())
+        else:
+            outcome = future.result()
+        if outcome != expected:
+            mismatches.append(f"{job_name}: expected {expected}, got {outcome}")
+    if mismatches:
+        raise AssertionError("Transcribe job futures did not resolve as expected:\n" + "\n".join(mismatches))
+
+    finished = [name for name in futures if name not in cancelled]
+    failed = sum(1 for name in finished if futures[name].exception() is not None)
+    # How long after the fake job actually finished the caller learned about it
+    lateness = sorted(resolved[name] - client.jobs[name]['completes'] for name in finished)
+    return [{
+        'jobs': n_jobs,
+        'failed': failed,
+        'cancelled': len(cancelled),
+        'all_resolved_as_expected': True,
+        'wall_time_s': round(wall_time, 3),
+        'longest_job_s': round(max(job['completes'] - job['started'] for job in client.jobs.values()) + 0.5, 3),
+        'polls': client.calls['get_transcription_job'],
+        'polls_per_job': round(client.calls['get_transcription_job'] / n_jobs, 2),
+        'median_lateness_s': round(lateness[len(lateness) // 2], 3),
+        'max_lateness_s': round(lateness[-1], 3),
+    }]
+
+
+def synthetic_conversation(duration, n_speakers=4, seed=0):
+    """Ground-truth words (start, end, speaker, text) of alternating turns separated by pauses."""
+    rng = random.Random(seed)
+    words, t, speaker = [], 0.0, 0
+    while t < duration:
+        speaker = (speaker + rng.randrange(1, n_speakers)) % n_speakers
+        for _ in range(rng.randint(3, 40)):
+            end = t + rng.uniform(0.15, 0.45)
+            if end >= duration:
+                break
+            words.append((t, end, speaker, f"word{len(words)}"))
+            t = end + rng.uniform(0.02, 0.12)
+        t += rng.uniform(0.4, 2.5)
+    return words
+
+
+def write_synthetic_wav(wav_path, words, duration, sample_rate=16000, seed=0, voiced=False):
+    """Noise bursts where words are spoken and near-silence elsewhere, written block by block.
+
+    With voiced, words are harmonic tones instead, pitched by their speaker (the third field of
+    each word), so every speaker has a voice of their own.
+    """
+    import wave
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    starts = np.array([w[0] for w in words])
+    ends = np.array([w[1] for w in words])
+    block_seconds = 60
+    with wave.open(wav_path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        for block_start in np.arange(0, duration, block_seconds):
+            times = block_start + np.arange(int(min(block_seconds, duration - block_start) * sample_rate)) / sample_rate
+            i = np.searchsorted(starts, times, side='right') - 1
+            speaking = (i >= 0) & (times < ends[np.maximum(i, 0)])
+            if voiced:
+                pitch = 110 * 1.5 ** np.array([w[2] for w in words])[np.maximum(i, 0)]
+                voice = sum(np.sin(2 * np.pi * k * pitch * times) / k for k in range(1, 6))
+                samples = rng.normal(0, 30, len(times)) + speaking * 4000 * voice
+            else:
+                samples = rng.normal(0, 30, len(times)) + speaking * rng.normal(0, 6000, len(times))
+            wav_file.writeframes(np.clip(samples, -32768, 32767).astype(np.int16).tobytes())
+
+
+def fake_chunk_transcript(words, audio_start, audio_end, rng, n_speakers):
+    """Transcribe-shaped JSON for one chunk, with chunk-local times and shuffled spk_N labels."""
+    local_labels = list(range(n_speakers))
+    rng.shuffle(local_labels)
+    items, segments = [], []
+    for start, end, speaker, text in words:
+        if audio_start <= start and end <= audio_end:
+            label = f"spk_{local_labels[speaker]}"
+            start_time, end_time = f"{start - audio_start:.3f}", f"{end - audio_start:.3f}"
+            items.append({'type': 'pronunciation', 'start_time': start_time, 'end_time': end_time,
+                          'alternatives': [{'content': text}]})
+            if segments and segments[-1]['speaker_label'] == label:
+                segments[-1]['end_time'] = end_time
+            else:
+                segments.append({'speaker_label': label, 'start_time': start_time, 'end_time': end_time})
+    return {'results': {'speaker_labels': {'segments': segments}, 'items': items}}
+
+
+def bench_chunked_transcription(hours=2.0, chunk_counts=(1, 2, 4, 8, 16), n_speakers=4,
+                                queue_time=0.5, realtime_factor=0.003, seed=0):
+    """Wall time and speaker-stitching accuracy of chunked transcription versus chunk count.
+
+    The fake backend needs queue_time plus realtime_factor seconds per second of chunk audio,
+    i.e. real Transcribe speed scaled down about 100x. Speakers have synthetic voices, so those
+    silent in an overlap are matched by voice print.
+    """
+    from collections import Counter
+    import chunked_transcription as ct
+
+    duration = hours * 3600
+    words = synthetic_conversation(duration, n_speakers, seed)
+    work_dir = tempfile.mkdtemp(prefix='bench_chunks_')
+    try:
+        wav_path = os.path.join(work_dir, 'conversation.wav')
+        write_synthetic_wav(wav_path, words, duration, seed=seed, voiced=True)
+        energies = ct.frame_energies(wav_path)
+
+        results = []
+        for n_chunks in chunk_counts:
+            chunks_dir = tempfile.mkdtemp(dir=work_dir)
+            rng = random.Random(seed)
+            start_time = time.perf_counter()
+            ranges = ct.chunk_ranges(ct.find_split_points(energies, duration / n_chunks), duration)
+            chunk_paths = ct.split_wav(wav_path, ranges, chunks_dir)
+            chunk_words = [fake_chunk_transcript(words, audio_start, keep_end, rng, n_speakers)
+                           for audio_start, _, keep_end in ranges]
+
+            def transcribe(chunk_path, job_name):
+                i = chunk_paths.index(chunk_path)
+                audio_start, _, keep_end = ranges[i]
+                time.sleep(queue_time + (keep_end - audio_start) * realtime_factor)
+                return chunk_words[i]
+
+            chunk_transcripts = ct.transcribe_chunks(chunk_paths, transcribe, max_workers=max(chunk_counts))
+            stitched = ct.stitch_transcripts(chunk_transcripts, ranges, wav_path=wav_path)
+            wall_time = time.perf_counter() - start_time
+
+            # Accuracy under the best one-to-one-ish mapping of global labels to true speakers
+            truth = {f"{start:.3f}": speaker for start, _, speaker, _ in words}
+            pairs = Counter((item.get('speaker_label'), truth.get(item['start_time']))
+                            for item in stitched['results']['items'] if item['type'] == 'pronunciation')
+            best = Counter()
+            for (label, speaker), count in pairs.items():
+                best[label] = max(best[label], count)
+            results.append({
+                'hours': hours,
+                'chunks': len(ranges),
+                'wall_time_s': round(wall_time, 3),
+                'words': sum(pairs.values()),
+                'global_speakers': len(best),
+                'speaker_accuracy': round(sum(best.values()) / max(1, sum(pairs.values())), 4),
+            })
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_s3_upload(size_mb=256, chunk_sizes_mb=(8, 16), concurrencies=(1, 4, 10),
+                    request_latency=0.02, connection_mbps=20.0):
+    """Upload throughput through upload_to_s3 for several TransferConfig settings.
+
+    The fake S3 limits each connection to connection_mbps MB/s, so throughput scales with
+    concurrency until parts run out.
+    """
+    from boto3.s3.transfer import TransferConfig
+    import aws_clients
+    from fake_backends import FakeS3Client
+    from transcription_diarization import upload_to_s3
+
+    s3_client = FakeS3Client(request_latency=request_latency, connection_bandwidth=connection_mbps * 2**20)
+    aws_clients.set_client('s3', s3_client)
+    work_dir = tempfile.mkdtemp(prefix='bench_upload_')
+    try:
+        file_path = os.path.join(work_dir, 'audio.bin')
+        with open(file_path, 'wb') as file:
+            for _ in range(size_mb):
+                file.write(os.urandom(2**20))
+
+        results = []
+        for chunk_size_mb in chunk_sizes_mb:
+            for concurrency in concurrencies:
+                transfer_config = TransferConfig(multipart_threshold=chunk_size_mb * 2**20,
+                                                 multipart_chunksize=chunk_size_mb * 2**20,
+                                                 max_concurrency=concurrency)
+                progress_calls = []
+                start_time = time.perf_counter()
+                upload_to_s3(file_path, 'bench', f"audio_{chunk_size_mb}_{concurrency}", transfer_config=transfer_config,
+                             progress_callback=lambda sent, total: progress_calls.append(sent))
+                wall_time = time.perf_counter() - start_time
+                results.append({
+                    'size_mb': size_mb,
+                    'chunk_mb': chunk_size_mb,
+                    'concurrency': concurrency,
+                    'wall_time_s': round(wall_time, 3),
+                    'throughput_mb_s': round(size_mb / wall_time, 1),
+                    'progress_updates': len(progress_calls),
+                })
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def use_scratch_indexes(directory):
+    """Build the indexes processing generates in directory instead of knowledge/, so an index
+    made from fake embeddings never replaces the one the app loads."""
+    import processing
+    processing.TEXT_INDEX_PATH = os.path.join(directory, 'faiss_index_Text_db')
+    processing.KNOWLEDGE_INDEX_PATH = os.path.join(directory, 'faiss_index_Knowledge_db')
+
+
+# Budget for 'import processing' on a warm disk cache, excluding the interpreter start itself
+COLD_START_TARGET_S = 5.0
+
+
+_COLD_START_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import processing
+import_s = time.perf_counter() - start
+from benchmark import use_scratch_indexes
+from fake_backends import HashedEmbeddings
+use_scratch_indexes(sys.argv[1])
+processing.set_embedding_model(HashedEmbeddings())
+start = time.perf_counter()
+processing.get_combined_retriever()
+first_retrieval_s = time.perf_counter() - start
+print(json.dumps({'import_s': import_s, 'index_load_s': first_retrieval_s}))
+"""
+
+
+def bench_cold_start(runs=3):
+    """Time 'import processing' and the first lazy knowledge index load in fresh interpreters."""
+    import subprocess
+    import sys
+
+    # Shared by the runs, so the first builds the text index and the others load it
+    index_dir = tempfile.mkdtemp(prefix='bench_indexes_')
+    results = []
+    try:
+        for run in range(runs):
+            output = subprocess.run([sys.executable, '-c', _COLD_START_SCRIPT, index_dir], capture_output=True,
+                                    text=True, check=True)
+            timings = json.loads(output.stdout.strip().splitlines()[-1])
+            results.append({
+                'run': run,
+                'import_s': round(timings['import_s'], 3),
+                'index_load_s': round(timings['index_load_s'], 3),
+                'import_target_s': COLD_START_TARGET_S,
+                'within_target': timings['import_s'] <= COLD_START_TARGET_S,
+            })
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+    return results
+
+
+RETRIEVAL_QUERIES = [
+    "signs of anxious preoccupied attachment in conversation",
+    "fear of rejection and need for reassurance",
+    "dismissive avoidant emotional distance",
+    "extraversion and sociability in speech",
+    "neuroticism emotional instability",
+    "narcissistic grandiosity and need for admiration",
+    "borderline emotional dysregulation",
+    "obsessional perfectionism and control",
+]
+
+
+def _run_retrieval(layout, n_queries, embedding_latency, repeats, index_dir, queue):
+    import processing
+    from fake_backends import HashedEmbeddings
+
+    use_scratch_indexes(index_dir)
+    embeddings = HashedEmbeddings(latency=embedding_latency)
+    processing.set_embedding_model(embeddings)
+    queries = (RETRIEVAL_QUERIES * (n_queries // len(RETRIEVAL_QUERIES) + 1))[:n_queries]
+
+    start_time = time.perf_counter()
+    if layout == 'merged':
+        knowledge_index = processing.get_knowledge_index()
+    else:
+        retriever = processing.get_combined_retriever()
+    load_s = time.perf_counter() - start_time
+
+    embeddings.calls = 0
+    latencies = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        if layout == 'merged':
+            knowledge_index.search(queries, processing.RETRIEVAL_QUOTAS)
+        else:
+            for query in queries:
+                retriever.invoke(query)
+        latencies.append(time.perf_counter() - start_time)
+    queue.put({
+        'layout': layout,
+        'queries': n_queries,
+        'load_s': round(load_s, 3),
+        'median_latency_ms': round(sorted(latencies)[len(latencies) // 2] * 1000, 2),
+        'embedding_calls_per_run': embeddings.calls // repeats,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    })
+
+
+def bench_retrieval(n_queries=5, embedding_latency=0.05, repeats=10):
+    """Merged knowledge index versus the three-retriever layout, each in a fresh process.
+
+    embedding_latency stands in for the OpenAI embeddings round-trip per call.
+    """
+    import processing
+    from fake_backends import HashedEmbeddings
+
+    # Both layouts' indexes are built up front, so load_s measures loading them as the app would
+    index_dir = tempfile.mkdtemp(prefix='bench_indexes_')
+    use_scratch_indexes(index_dir)
+    processing.set_embedding_model(HashedEmbeddings())
+    processing.get_combined_retriever()
+    processing.get_knowledge_index()
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for layout in ('combined', 'merged'):
+            queue = context.Queue()
+            process = context.Process(target=_run_retrieval,
+                                      args=(layout, n_queries, embedding_latency, repeats, index_dir, queue))
+            process.start()
+            process.join()
+            if not queue.empty():
+                results.append(queue.get())
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+    return results
+
+
+# Fixed transcripts, each with the search queries the query-generation step would produce for it
+SAMPLE_TRANSCRIPTS = [
+    ("[1. Speaker 1 | text: I keep checking my phone when she doesn't answer, I just need to know we're okay.]\n\n"
+     "[2. Speaker 2 | text: You always do this. I need some space, I can handle things on my own.]\n",
+     ["anxious preoccupied attachment need for reassurance", "dismissive avoidant need for space and self-reliance",
+      "neuroticism worry and emotional instability", "fear of abandonment in relationships",
+      "avoidance of intimacy and emotional distance", "anxious attachment checking behaviour"]),
+    ("[1. Speaker 1 | text: Honestly, nobody in that office is as capable as I am. They should be grateful I even show up.]\n\n"
+     "[2. Speaker 2 | text: I think the team did a great job, and I enjoyed organising the party for everyone.]\n",
+     ["narcissistic grandiosity and entitlement", "need for admiration and superiority",
+      "extraversion and enjoyment of social events", "agreeableness and warmth towards others",
+      "narcissistic personality traits", "conscientiousness and organisation"]),
+    ("[1. Speaker 1 | text: Everything has to be exactly in order before I can start, otherwise I can't focus.]\n\n"
+     "[2. Speaker 2 | text: One minute I love him, the next I can't stand him. I don't know who I am anymore.]\n\n"
+     "[3. Speaker 3 | text: I'd rather not talk about it. People are usually out to get you anyway.]\n",
+     ["obsessional perfectionism and need for control", "borderline emotional dysregulation and identity disturbance",
+      "paranoid mistrust of others", "schizoid withdrawal and detachment",
+      "fearful avoidant attachment ambivalence", "conscientiousness orderliness"]),
+]
+
+
+def bench_prompt_tokens():
+    """Prompt tokens with the raw multi-query results versus the deduplicated, budgeted context."""
+    import processing
+    from fake_backends import HashedEmbeddings
+    from knowledge_index import format_context
+    from llm_loader import count_tokens
+
+    index_dir = tempfile.mkdtemp(prefix='bench_indexes_')
+    use_scratch_indexes(index_dir)
+    processing.set_embedding_model(HashedEmbeddings())
+    knowledge_index = processing.get_knowledge_index()
+    tasks = [processing.load_text(f"tasks/{name}.txt") for name in
+             ("General_tasks_description", "General_Impression_task", "Attachments_task", "BigFive_task", "Personalities_task")]
+
+    results = []
+    try:
+        for i, (transcript, queries) in enumerate(SAMPLE_TRANSCRIPTS, 1):
+            raw_docs = [doc for docs in knowledge_index.search(queries, processing.RETRIEVAL_QUOTAS) for doc in docs]
+            before = str(raw_docs)
+            after = format_context(knowledge_index.select_context(queries, processing.RETRIEVAL_QUOTAS,
+                                                                  processing.KNOWLEDGE_TOKEN_BUDGET, count_tokens))
+            results.append({
+                'transcript': i,
+                'documents_before': len(raw_docs),
+                'knowledge_tokens_before': count_tokens(before),
+                'knowledge_tokens_after': count_tokens(after),
+                'prompt_tokens_before': processing.prompt_tokens(processing.build_prompt(*tasks, before, transcript)),
+                'prompt_tokens_after': processing.prompt_tokens(processing.build_prompt(*tasks, after, transcript)),
+            })
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+    return results
+
+
+SAMPLE_WORDS = ("i think we should talk about what happened yesterday because honestly it still bothers me "
+                "and you never really listen when i try to explain how i feel about the way things are going").split()
+
+
+def synthetic_formatted_transcript(n_turns, n_speakers=3, words_per_turn=80, seed=0):
+    """A diarize_audio-style '[i. Speaker N | text: ...]' transcript."""
+    rng = random.Random(seed)
+    turns = []
+    for i in range(1, n_turns + 1):
+        text = " ".join(rng.choice(SAMPLE_WORDS) for _ in range(words_per_turn))
+        turns.append(f"[{i}. Speaker {rng.randrange(n_speakers) + 1} | text: {text}.]\n")
+    return "\n".join(turns)
+
+
+def use_fake_models(llm_latency=0.5, per_token_delay=0.0005):
+    """Point processing at a fake chat model and hashed embeddings; returns the fake model.
+
+    The indexes built from the hashed embeddings go to a temp directory removed at exit.
+    """
+    import atexit
+    import processing
+    from fake_backends import FakeChatModel, HashedEmbeddings
+
+    llm = FakeChatModel(latency=llm_latency, per_token_delay=per_token_delay)
+    index_dir = tempfile.mkdtemp(prefix='bench_indexes_')
+    atexit.register(shutil.rmtree, index_dir, True)
+    use_scratch_indexes(index_dir)
+    processing.set_embedding_model(HashedEmbeddings())
+    processing.query_generation_chain = processing.prompt_template | llm
+    return llm
+
+
+def bench_map_reduce(window_counts=(1, 2, 4, 8, 16), max_workers=4, window_tokens=2000, turns_per_window=15):
+    """Map-reduce wall time versus number of windows, against the fake chat model."""
+    import processing
+
+    llm = use_fake_models()
+    results = []
+    for n_windows in window_counts:
+        transcript = synthetic_formatted_transcript(n_windows * turns_per_window, seed=n_windows)
+        llm.calls = 0
+        start_time = time.perf_counter()
+        analysis = processing.process_input(transcript, llm, mode='map_reduce', window_tokens=window_tokens,
+                                            max_workers=max_workers)
+        results.append({
+            'windows': len(processing.split_windows(transcript, window_tokens)),
+            'max_workers': max_workers,
+            'llm_calls': llm.calls,
+            'speakers': len(analysis),
+            'wall_time_s': round(time.perf_counter() - start_time, 3),
+        })
+    return results
+
+
+def bench_split_tasks(n_turns=40, per_token_delay=0.002, repeats=3):
+    """End-to-end latency of one combined prompt versus four concurrent per-task calls.
+
+    per_token_delay makes output length dominate, as with a real model generating the JSON.
+    """
+    import processing
+
+    llm = use_fake_models(llm_latency=0.3, per_token_delay=per_token_delay)
+    transcript = synthetic_formatted_transcript(n_turns)
+    tasks = processing.load_tasks()
+
+    results = []
+    for split_tasks in (False, True):
+        timings = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            if split_tasks:
+                _, stage_timings = processing.analyze_tasks_parallel(transcript, llm, tasks)
+            else:
+                processing.process_input(transcript, llm, mode='single')
+                stage_timings = {}
+            stage_timings['total'] = time.perf_counter() - start_time
+            timings.append(stage_timings)
+        median = {stage: round(sorted(t[stage] for t in timings)[len(timings) // 2], 3) for stage in timings[0]}
+        results.append({'split_tasks': split_tasks, **median})
+    results.append({'speedup': round(results[0]['total'] / results[1]['total'], 2)})
+    return results
+
+
+def bench_streaming(speaker_counts=(1, 2, 3), per_token_delay=0.002, turns_per_speaker=10):
+    """Time to first rendered speaker with streaming versus waiting for the whole response."""
+    import processing
+
+    llm = use_fake_models(llm_latency=0.3, per_token_delay=per_token_delay)
+    results = []
+    for n_speakers in speaker_counts:
+        transcript = synthetic_formatted_transcript(n_speakers * turns_per_speaker, n_speakers=n_speakers)
+
+        start_time = time.perf_counter()
+        processing.process_input(transcript, llm, mode='single')
+        blocking = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        first_speaker = None
+        for partial_results, _ in processing.process_input_stream(transcript, llm, mode='single'):
+            if partial_results and first_speaker is None:
+                first_speaker = time.perf_counter() - start_time
+        streamed = time.perf_counter() - start_time
+
+        results.append({
+            'speakers': n_speakers,
+            'blocking_total_s': round(blocking, 3),
+            'stream_first_speaker_s': round(first_speaker, 3),
+            'stream_total_s': round(streamed, 3),
+            'first_speaker_speedup': round(blocking / first_speaker, 2),
+        })
+    return results
+
+
+def bench_llm_cache(runs=3, n_turns=30):
+    """Repeated analyses of one transcript with the disk response cache, cold then warm."""
+    import tempfile
+    import processing
+    from llm_cache import LLMResponseCache
+
+    llm = use_fake_models(llm_latency=0.3, per_token_delay=0.0005)
+    transcript = synthetic_formatted_transcript(n_turns)
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        llm.cache = LLMResponseCache(cache_dir=cache_dir)
+        for streaming in (False, True):
+            for run in range(runs):
+                llm.calls = 0
+                start_time = time.perf_counter()
+                if streaming:
+                    for _ in processing.process_input_stream(transcript, llm, mode='single'):
+                        pass
+                else:
+                    processing.process_input(transcript, llm, mode='single')
+                results.append({'streaming': streaming, 'run': run, 'llm_calls': llm.calls,
+                                'seconds': round(time.perf_counter() - start_time, 3)})
+        results.append(llm.cache.stats())
+    return results
+
+
+def bench_semantic_cache(n_base=5, variants=8, embedding_latency=0.05, llm_latency=0.3, threshold=None):
+    """Per-request retrieval latency (p50/p95) in each retrieval mode.
+
+    Requests are variants of a few base transcripts (a different closing turn each), the kind
+    of near-repeats the semantic cache is meant to catch; the ideal hit rate is 1 - 1/variants.
+    The semantic row also reports the lowest similarity between variants of one transcript and
+    the highest between different transcripts; a usable threshold lies between the two. The
+    synthetic transcripts share one small vocabulary, so the hashed embeddings of unrelated
+    ones are already ~0.99 similar. threshold defaults to SEMANTIC_CACHE_THRESHOLD.
+    """
+    import numpy as np
+    import processing
+    from fake_backends import HashedEmbeddings
+
+    use_fake_models(llm_latency=llm_latency)
+    rng = random.Random(1)
+    requests = []
+    for base in range(n_base):
+        transcript = synthetic_formatted_transcript(30, seed=base)
+        for variant in range(variants):
+            extra = " ".join(rng.choice(SAMPLE_WORDS) for _ in range(20))
+            requests.append((base, f"{transcript}\n[31. Speaker 1 | text: {extra}.]\n"))
+    rng.shuffle(requests)
+    threshold = threshold or processing.semantic_cache.threshold
+    processing.semantic_cache.threshold = threshold
+
+    vectors = np.array(HashedEmbeddings().embed_documents(
+        [processing.truncate_tokens(request, processing.SEMANTIC_CACHE_INPUT_TOKENS) for _, request in requests]))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    similarities = vectors @ vectors.T
+    bases = np.array([base for base, _ in requests])
+    same_base = (bases[:, None] == bases[None, :]) & ~np.eye(len(requests), dtype=bool)
+    other_base = bases[:, None] != bases[None, :]
+
+    results = []
+    for mode in ('generated', 'semantic', 'canonical'):
+        processing.set_embedding_model(HashedEmbeddings(latency=embedding_latency))
+        processing.get_knowledge_index()
+        latencies = []
+        for _, request in requests:
+            start_time = time.perf_counter()
+            processing.retrieve_knowledge(request, mode=mode)
+            latencies.append(time.perf_counter() - start_time)
+        latencies.sort()
+        result = {
+            'mode': mode,
+            'requests': len(requests),
+            'p50_ms': round(1000 * latencies[len(latencies) // 2], 1),
+            'p95_ms': round(1000 * latencies[int(len(latencies) * 0.95)], 1),
+        }
+        if mode == 'semantic':
+            result['threshold'] = threshold
+            result['hit_rate'] = round(processing.semantic_cache.stats()['hit_rate'], 3)
+            result['same_transcript_min_similarity'] = round(float(similarities[same_base].min()), 4)
+            result['other_transcript_max_similarity'] = round(float(similarities[other_base].max()), 4)
+        results.append(result)
+    return results
+
+
+def _legacy_build_prompt(general_task, general_impression_task, attachments_task, bigfive_task,
+                        personalities_task, retrieved_knowledge, truncated_input):
+    # The single-string layout used before the static prefix, with the knowledge inside the task text
+    return f"""
+{general_task}
+Genral Impression Task:
+{general_impression_task}
+Attachment Styles Task:
+{attachments_task}
+Big Five Traits Task:
+{bigfive_task}
+Personality Disorders Task:
+{personalities_task}
+Retrieved Knowledge: {retrieved_knowledge}
+Input: {truncated_input}
+Please provide a comprehensive analysis for each speaker, including:
+1. General impressions (answer the sections provided in the General Impression Task.)
+2. Attachment styles (use the format from the Attachment Styles Task)
+3. Big Five traits (use the format from the Big Five Traits Task)
+4. Personality disorders (use the format from the Personality Disorders Task)
+Respond with a JSON object containing an array of speaker analyses under the key 'speaker_analyses'. Each speaker analysis should include all four aspects mentioned above, however, General impressions must not be in json or dict format.
+Analysis:"""
+
+
+def bench_prefix_cache(repeats=2, per_input_token_delay=0.0001):
+    """Cached input tokens and latency with the old single-string prompt versus the static prefix.
+
+    Requests cycle through the sample transcripts' retrieved knowledge, each with a different
+    transcript; the last layout uses the fixed canonical knowledge instead.
+    """
+    import processing
+    from fake_backends import FakeChatModel
+    from knowledge_index import format_context
+    from llm_loader import PromptCacheUsage, count_tokens
+
+    use_fake_models()
+    knowledge_index = processing.get_knowledge_index()
+    tasks = processing.load_tasks()
+    requests = []
+    for _ in range(repeats):
+        for i, (transcript, queries) in enumerate(SAMPLE_TRANSCRIPTS):
+            knowledge = format_context(knowledge_index.select_context(
+                queries, processing.RETRIEVAL_QUOTAS, processing.KNOWLEDGE_TOKEN_BUDGET, count_tokens))
+            requests.append((knowledge, synthetic_formatted_transcript(20, seed=len(requests)) + transcript))
+
+    canonical = processing.canonical_context()
+    results = []
+    for layout, build, fixed_knowledge in (('legacy', _legacy_build_prompt, False),
+                                           ('static_prefix', processing.build_prompt, False),
+                                           ('static_prefix_canonical', processing.build_prompt, True)):
+        llm = FakeChatModel(prefix_cache=True, latency=0.1, per_input_token_delay=per_input_token_delay)
+        usage = PromptCacheUsage()
+        start_time = time.perf_counter()
+        for knowledge, transcript in requests:
+            usage.record(llm.invoke(build(*tasks, canonical if fixed_knowledge else knowledge, transcript)))
+        stats = usage.stats()
+        results.append({
+            'layout': layout,
+            'requests': len(requests),
+            'input_tokens': stats['input_tokens'],
+            'cached_tokens': stats['cached_tokens'],
+            'cached_share': round(stats['cached_share'], 3),
+            'seconds': round(time.perf_counter() - start_time, 3),
+        })
+    return results
+
+
+def use_fake_aws(queue_time=1.0, realtime_factor=0.05, audio_seconds=60.0, s3_latency=0.05, n_speakers=2,
+                 words_per_second=2.5, stored_bytes=None):
+    """Install fake S3/Transcribe clients and transcript downloads; returns the Transcribe client.
+
+    Uploaded WAV files are transcribed for their real duration, anything else for audio_seconds.
+    The shared job manager's polling bounds are scaled down to the fake job timings.
+    """
+    import aws_clients
+    import transcription_diarization
+    from fake_backends import FakeS3Client, FakeTranscribeClient, FakeTranscriptAdapter
+
+    s3_client = FakeS3Client(request_latency=s3_latency, connection_bandwidth=50 * 2**20, stored_bytes=stored_bytes)
+    transcribe_client = FakeTranscribeClient(queue_time=queue_time, realtime_factor=realtime_factor,
+                                             default_duration=audio_seconds, s3_client=s3_client)
+    aws_clients.set_client('s3', s3_client)
+    aws_clients.set_client('transcribe', transcribe_client)
+    transcription_diarization.http_session.mount('fake://', FakeTranscriptAdapter(transcribe_client, n_speakers,
+                                                                                  words_per_second=words_per_second))
+    manager = transcription_diarization.transcribe_job_manager
+    manager.min_interval, manager.max_interval = 0.1, 1.0
+    manager.startup, manager.realtime_factor = queue_time, realtime_factor
+    return transcribe_client
+
+
+def bench_load(user_counts=(1, 5, 10, 20), audio_seconds=60.0):
+    """Simulated concurrent users through AnalysisPipeline, against fake AWS and OpenAI backends.
+
+    'sequential' runs the users one after another, as a single Gradio worker would; 'pipeline'
+    runs them all at once with the per-stage pools and admission limits.
+    """
+    import asyncio
+    import numpy as np
+    from pipeline import AnalysisPipeline
+
+    use_fake_aws(audio_seconds=audio_seconds)
+    llm = use_fake_models(llm_latency=0.5, per_token_delay=0.0002)
+
+    async def user(pipeline, video_path, arrival):
+        # Latency counts from the moment all users arrive, including time spent waiting in line
+        async for _ in pipeline.run(video_path):
+            pass
+        return time.perf_counter() - arrival
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        videos = []
+        for i in range(max(user_counts)):
+            path = os.path.join(tmp_dir, f"user_{i}.wav")
+            words = [(t, t + 0.3) for t in np.arange(0.0, audio_seconds - 1, 0.5)]
+            write_synthetic_wav(path, words, audio_seconds, seed=i)
+            videos.append(path)
+
+        for n_users in user_counts:
+            for mode in ('sequential', 'pipeline'):
+                pipeline = AnalysisPipeline(llm, use_cache=False)
+
+                async def run_users():
+                    arrival = time.perf_counter()
+                    if mode == 'sequential':
+                        return [await user(pipeline, video, arrival) for video in videos[:n_users]]
+                    return await asyncio.gather(*(user(pipeline, video, arrival) for video in videos[:n_users]))
+
+                start_time = time.perf_counter()
+                latencies = sorted(asyncio.run(run_users()))
+                wall_time = time.perf_counter() - start_time
+                pipeline.shutdown()
+                results.append({
+                    'users': n_users,
+                    'mode': mode,
+                    'wall_s': round(wall_time, 2),
+                    'analyses_per_min': round(60 * n_users / wall_time, 1),
+                    'p50_latency_s': round(latencies[len(latencies) // 2], 2),
+                    'p95_latency_s': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+                    'stages': pipeline.stats(),
+                })
+    return results
+
+
+def bench_rate_limits(n_requests=60, n_threads=16, requests_per_minute=600, tokens_per_minute=3_000_000,
+                      error_rate=0.1, duplicate_share=0.25, llm_latency=0.2):
+    """A burst of interactive and batch calls against a local OpenAI endpoint that enforces rate limits.
+
+    'direct' is ChatOpenAI without retries (each 429 became the empty fallback analysis), 'client'
+    uses the OpenAI client's own retries, 'scheduler' goes through ScheduledChatModel. Every
+    other call is batch priority, and duplicate_share of them repeat an earlier prompt.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from langchain_openai import ChatOpenAI
+    from fake_backends import FakeChatModel, FakeOpenAIServer
+    from llm_loader import MAX_OUTPUT_TOKENS
+    from llm_scheduler import BATCH, INTERACTIVE, LLMScheduler, ScheduledChatModel
+
+    rng = random.Random(0)
+    prompts = []
+    for i in range(n_requests):
+        if prompts and rng.random() < duplicate_share:
+            prompts.append(rng.choice(prompts))
+        else:
+            prompts.append(f"Input: [1. Speaker {i % 3 + 1} | text: {' '.join(rng.choice(SAMPLE_WORDS) for _ in range(200))}]")
+    priorities = [INTERACTIVE if i % 2 == 0 else BATCH for i in range(n_requests)]
+
+    results = []
+    for mode in ('direct', 'client', 'scheduler'):
+        server = FakeOpenAIServer(FakeChatModel(latency=llm_latency), requests_per_minute=requests_per_minute,
+                                  tokens_per_minute=tokens_per_minute, window=1.0, error_rate=error_rate)
+        with server:
+            chat_model = ChatOpenAI(model_name="gpt-4o-mini", openai_api_key="fake", base_url=server.base_url,
+                                    max_tokens=MAX_OUTPUT_TOKENS, max_retries=2 if mode == 'client' else 0)
+            scheduler = LLMScheduler(requests_per_minute, tokens_per_minute, burst_seconds=1.0, base_delay=0.1,
+                                     seed=0)
+            models = {priority: ScheduledChatModel(model=chat_model, scheduler=scheduler, priority=priority,
+                                                   max_output_tokens=MAX_OUTPUT_TOKENS)
+                      for priority in (INTERACTIVE, BATCH)}
+
+            def call(i):
+                started = time.perf_counter()
+                try:
+                    (models[priorities[i]] if mode == 'scheduler' else chat_model).invoke(prompts[i])
+                    failed = False
+                except Exception:
+                    failed = True
+                return priorities[i], failed, time.perf_counter() - started
+
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                outcomes = list(executor.map(call, range(n_requests)))
+            wall_time = time.perf_counter() - start_time
+
+        def p50(priority):
+            latencies = sorted(latency for p, failed, latency in outcomes if p == priority and not failed)
+            return round(latencies[len(latencies) // 2], 2) if latencies else None
+
+        results.append({
+            'mode': mode,
+            'failed': sum(failed for _, failed, _ in outcomes),
+            'wall_s': round(wall_time, 2),
+            'server_requests': server.counts['requests'],
+            'server_429s': server.counts['rate_limited'],
+            'p50_interactive_s': p50(INTERACTIVE),
+            'p50_batch_s': p50(BATCH),
+            **({'scheduler': scheduler.stats()} if mode == 'scheduler' else {}),
+        })
+    return results
+
+
+# Offline end-to-end profiles; 'huge' is long enough to take the chunked transcription path
+E2E_PROFILES = {
+    'small': {'audio_seconds': 2 * 60, 'speakers': 2},
+    'medium': {'audio_seconds': 15 * 60, 'speakers': 3},
+    'huge': {'audio_seconds': 2 * 3600, 'speakers': 4},
+}
+# A stage regresses when it is this much slower than the baseline, and by more than the noise floor
+E2E_TOLERANCE = 1.25
+E2E_NOISE_FLOOR_S = 0.05
+
+
+def _run_end_to_end(profile, audio_path, index_dir, queue):
+    import asyncio
+    import contextlib
+    import processing
+    from instrumentation import RunMetrics
+    from pipeline import AnalysisPipeline
+
+    settings = E2E_PROFILES[profile]
+    duration = settings['audio_seconds']
+    # Remote services answer quickly, so the timings are dominated by this project's own code
+    use_fake_aws(queue_time=0.2, realtime_factor=0.002, s3_latency=0.0, n_speakers=settings['speakers'],
+                 stored_bytes=64 * 2**10)
+    llm = use_fake_models(llm_latency=0.1, per_token_delay=0.0)
+    use_scratch_indexes(index_dir)
+    processing.get_knowledge_index()  # index loading is measured by the coldstart benchmark
+    pipeline = AnalysisPipeline(llm, use_cache=False, checkpoints=False, metrics_dir=None)
+    metrics = RunMetrics(profile)
+    rss_before = peak_rss_mb()
+
+    async def run():
+        transcription, results = "", {}
+        async for _, transcription, results, _ in pipeline.run(audio_path, metrics=metrics):
+            pass
+        return transcription, results
+
+    start_time = time.perf_counter()
+    # The pipeline prints whole transcripts and model outputs
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        transcription, results = asyncio.run(run())
+    wall_time = time.perf_counter() - start_time
+    pipeline.shutdown()
+
+    stages = metrics.to_dict()['stages']
+    queue.put({
+        'profile': profile,
+        'audio_min': round(duration / 60, 1),
+        'speakers': len(results),
+        'turns': transcription.count('| text: '),
+        'transcript_kb': round(len(transcription.encode()) / 2**10, 1),
+        'wall_s': round(wall_time, 3),
+        'audio_x_realtime': round(duration / wall_time, 1),
+        'startup_rss_mb': round(rss_before, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'stages': {stage: round(totals['seconds'], 3) for stage, totals in stages.items()},
+        'llm_calls': llm.calls,
+    })
+
+
+def compare_to_baseline(results, baseline, tolerance=E2E_TOLERANCE, noise_floor=E2E_NOISE_FLOOR_S):
+    """Add each result's time ratios to the matching baseline profile, and the stages that regressed."""
+    baseline_results = {result['profile']: result for result in baseline['results']}
+    for result in results:
+        previous = baseline_results.get(result['profile'])
+        if 'error' in result:
+            result['regressions'] = ['crashed']
+            continue
+        if previous is None:
+            result['vs_baseline'] = None  # not in the baseline, so nothing to compare against
+            continue
+        pairs = {'wall': (result['wall_s'], previous['wall_s'])}
+        pairs.update({stage: (seconds, previous['stages'][stage])
+                      for stage, seconds in result['stages'].items() if previous['stages'].get(stage)})
+        result['vs_baseline'] = {name: round(now / before, 2) for name, (now, before) in pairs.items()}
+        result['regressions'] = [name for name, (now, before) in pairs.items()
+                                 if now > before * tolerance and now - before > noise_floor]
+        if result['peak_rss_mb'] > previous['peak_rss_mb'] * tolerance:
+            result['regressions'].append('peak_rss_mb')
+    return results
+
+
+def bench_end_to_end(profiles=tuple(E2E_PROFILES), baseline_path=None, save_baseline=None):
+    """Whole analyses against fake S3, Transcribe, OpenAI and embeddings, one fresh process per profile.
+
+    Reports per-stage seconds from the run's instrumentation, throughput as audio duration over
+    wall time, and peak RSS. save_baseline writes the results to a JSON file; baseline_path
+    compares against such a file and lists the stages that got slower. A profile whose process
+    crashed is reported with its exit code instead of being left out.
+    """
+    import platform
+    import numpy as np
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for profile in profiles:
+            # Written here so generating the audio does not count towards the run's peak memory
+            duration = E2E_PROFILES[profile]['audio_seconds']
+            audio_path = os.path.join(tmp_dir, f"{profile}.wav")
+            write_synthetic_wav(audio_path, [(t, t + 0.3) for t in np.arange(0.0, duration - 1, 0.5)], duration)
+            queue = context.Queue()
+            process = context.Process(target=_run_end_to_end, args=(profile, audio_path, tmp_dir, queue))
+            process.start()
+            process.join()
+            os.remove(audio_path)
+            if process.exitcode == 0 and not queue.empty():
+                results.append(queue.get())
+            else:
+                results.append({'profile': profile, 'error': f"benchmark process exited with code {process.exitcode}"})
+
+    crashed = [result['profile'] for result in results if 'error' in result]
+    if save_baseline and crashed:
+        raise RuntimeError(f"Not saving a baseline, profiles crashed: {', '.join(crashed)}")
+    if save_baseline:
+        machine = {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()}
+        with open(save_baseline, 'w', encoding='utf-8') as file:
+            json.dump({'machine': machine, 'saved': time.time(), 'results': results}, file, indent=2)
+    if baseline_path:
+        with open(baseline_path, 'r', encoding='utf-8') as file:
+            compare_to_baseline(results, json.load(file))
+    return results
+
+
+def bench_local_rtf(audio_path, models=('tiny', 'base', 'small'), compute_types=('int8',), cpu_threads=0,
+                    thresholds=None, expected_speakers=None):
+    """Real-time factor of the local transcription backend on the CPU, per model and compute type.
+
+    models are faster-whisper size names or directories of local CTranslate2 model files; audio_path
+    should be a recording with speech (any format ffmpeg reads). RTF is transcription plus speaker
+    clustering time over audio duration, so below 1.0 is faster than real time. Each of thresholds
+    (speaker distance thresholds, default SPEAKER_DISTANCE_THRESHOLD) is a separate run; with
+    expected_speakers, the number of people in the recording, each reports whether it found them all.
+    """
+    from instrumentation import RunMetrics
+    from transcription_backends import SPEAKER_DISTANCE_THRESHOLD, LocalWhisperBackend
+    from transcription_diarization import audio_duration, convert_to_wav, extract_transcriptions_with_speakers
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wav_path = convert_to_wav(audio_path, output_dir=tmp_dir, audio_format='wav')
+        duration = audio_duration(wav_path)
+        for model in models:
+            for compute_type in compute_types:
+                # One backend per model, so the model is loaded once for all thresholds
+                backend = LocalWhisperBackend(model, compute_type=compute_type, cpu_threads=cpu_threads)
+                for threshold in thresholds or (SPEAKER_DISTANCE_THRESHOLD,):
+                    backend.distance_threshold = threshold
+                    try:
+                        start_time = time.perf_counter()
+                        backend.load()
+                        load_time = time.perf_counter() - start_time
+                        metrics = RunMetrics()
+                        with metrics.activate():
+                            start_time = time.perf_counter()
+                            transcript = backend.transcribe(wav_path, tmp_dir, backend.settings(wav_path), 'rtf')
+                            elapsed = time.perf_counter() - start_time
+                    except Exception as e:
+                        results.append({'model': model, 'compute_type': compute_type, 'threshold': threshold,
+                                        'error': f"{type(e).__name__}: {e}"})
+                        continue
+                    stages = metrics.to_dict()['stages']
+                    turns = extract_transcriptions_with_speakers(transcript)
+                    result = {
+                        'model': model,
+                        'compute_type': compute_type,
+                        'threshold': threshold,
+                        'audio_s': round(duration, 1),
+                        'load_s': round(load_time, 2),
+                        'transcribe_s': stages['transcribe_local']['seconds'],
+                        'cluster_s': stages.get('cluster_speakers', {}).get('seconds', 0.0),
+                        'rtf': round(elapsed / duration, 3),
+                        'words': sum(len(turn['text'].split()) for turn in turns),
+                        'turns': len(turns),
+                        'speakers': len({turn['speaker'] for turn in turns}),
+                        'peak_rss_mb': round(peak_rss_mb(), 1),
+                    }
+                    if expected_speakers:
+                        result['speakers_correct'] = result['speakers'] == expected_speakers
+                    results.append(result)
+    return results
+
+
+def bench_transcript(sizes=(100_000, 1_000_000), token_budget=16000, window_tokens=2000, repeats=5):
+    """Columnar Transcript versus the formatted transcript string: memory, slicing and serialization.
+
+    The string side is what the pipeline did before: truncate_text and split_windows re-splitting
+    the formatted text, and selecting a speaker's turns with the turn regex. Times are medians.
+    """
+    import statistics
+    import sys
+    import tracemalloc
+    from processing import TURN_PATTERN, split_turns, split_windows, truncate_text
+    from transcript import Transcript
+
+    def median_time(fn):
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start_time)
+        return round(statistics.median(times), 5)
+
+    results = []
+    for n_words in sizes:
+        transcript_data = synthetic_transcript(n_words, item_labels=True)
+        start_time = time.perf_counter()
+        transcript = Transcript.from_transcribe(transcript_data)
+        build_time = time.perf_counter() - start_time
+        # The Transcribe JSON is the only other place word times and confidences are kept
+        encoded = json.dumps(transcript_data)
+        tracemalloc.start()
+        decoded = json.loads(encoded)
+        json_objects_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del encoded, decoded
+        formatted = transcript.render()
+        turns = split_turns(formatted)
+        string_bytes = sys.getsizeof(formatted) + sys.getsizeof(turns) + sum(map(sys.getsizeof, turns))
+
+        middle = float(transcript.start_times[len(transcript) // 2])
+        speaker = transcript.speaker_names[1]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            npz_path, json_path = os.path.join(tmp_dir, 'transcript.npz'), os.path.join(tmp_dir, 'transcript.json')
+            save_npz = median_time(lambda: transcript.save(npz_path))
+
+            def save_json():
+                with open(json_path, 'w', encoding='utf-8') as file:
+                    json.dump(transcript_data, file)
+
+            def load_json():
+                with open(json_path, 'r', encoding='utf-8') as file:
+                    return Transcript.from_transcribe(json.load(file))
+
+            save_json_s = median_time(save_json)
+            load_npz = median_time(lambda: Transcript.load(npz_path))
+            load_json_s = median_time(load_json)
+            loaded = Transcript.load(npz_path)
+            sizes_on_disk = {'npz_mb': round(os.path.getsize(npz_path) / 2**20, 1),
+                             'json_mb': round(os.path.getsize(json_path) / 2**20, 1)}
+
+        results.append({
+            'words': n_words,
+            'turns': len(turns),
+            'build_s': round(build_time, 3),
+            'parse_s': median_time(lambda: Transcript.parse(formatted)),
+            'string_mb': round(string_bytes / 2**20, 1),
+            'json_objects_mb': round(json_objects_bytes / 2**20, 1),
+            'columnar_mb': round(transcript.nbytes() / 2**20, 1),
+            'head_tokens_s': {'string': median_time(lambda: truncate_text(formatted, token_budget)),
+                              'columnar': median_time(lambda: truncate_text(transcript, token_budget))},
+            'windows_s': {'string': median_time(lambda: split_windows(formatted, window_tokens)),
+                          'columnar': median_time(lambda: split_windows(transcript, window_tokens))},
+            'speaker_s': {'string': median_time(lambda: [turn for turn in split_turns(formatted)
+                                                         if TURN_PATTERN.match(turn).group(2) == speaker]),
+                          'columnar': median_time(lambda: transcript.for_speaker(speaker))},
+            'ten_minutes_s': median_time(lambda: transcript.between(middle, middle + 600)),
+            'render_s': median_time(transcript.render),
+            'save_s': {'npz': save_npz, 'json': save_json_s},
+            'load_s': {'npz': load_npz, 'json': load_json_s},
+            **sizes_on_disk,
+            'round_trip': loaded.render() == formatted,
+        })
+    return results
+
+
+# Defects injected into fake analysis responses, in the proportions they are drawn
+OUTPUT_DEFECTS = {'clean': 4, 'fence': 2, 'prose': 1, 'trailing comma': 1, 'string numbers': 1, 'fractional scores': 1,
+                  'missing field': 1, 'missing section': 1, 'invalid section': 1, 'truncated': 2, 'no json': 1}
+
+
+def malformed_output(analysis, defect, rng):
+    """A fake model response (a {"speaker_analyses": [...]} dict) rendered with one defect."""
+    data = json.loads(json.dumps(analysis))
+    speaker = rng.choice(data['speaker_analyses'])
+    section = rng.choice(['Attachment Styles', 'Big Five Traits', 'Personality Disorders'])
+    if defect == 'string numbers':
+        speaker[section] = {key: f"{value}/10" if isinstance(value, int) else value
+                            for key, value in speaker[section].items()}
+    elif defect == 'fractional scores':
+        speaker['Big Five Traits'] = {key: value + 0.4 if isinstance(value, int) else value
+                                      for key, value in speaker['Big Five Traits'].items()}
+    elif defect == 'missing field':
+        del speaker[section][rng.choice([key for key in speaker[section] if key != 'Explanation'])]
+    elif defect == 'missing section':
+        del speaker[section]
+    elif defect == 'invalid section':
+        speaker[section] = "see above"
+    content = json.dumps(data, indent=2)
+    if defect == 'fence':
+        content = f"```json\n{content}\n```"
+    elif defect == 'prose':
+        content = f"Here is the analysis of each speaker:\n{content}\nLet me know if you need more detail."
+    elif defect == 'trailing comma':
+        content = content.replace('"\n      }', '",\n      }')
+    elif defect == 'truncated':
+        content = content[:rng.randrange(len(content) // 4, len(content) - 10)]
+    elif defect == 'no json':
+        content = "I'm sorry, but I can't provide a diagnosis from this transcript."
+    return content
+
+
+def _legacy_parse_speakers(content):
+    """What processing did before schema-guided parsing: fences stripped by hand, json.loads,
+    then fixed display keys read with .get(); any error cost the whole response."""
+    from output_parser import SpeakerAnalysis
+
+    if content.startswith("```json"):
+        content = content.split("```json", 1)[1]
+    if content.endswith("```"):
+        content = content.rsplit("```", 1)[0]
+    analyses = []
+    for obj in json.loads(content.strip()).get('speaker_analyses', []):
+        values = {'speaker': str(obj.get('Speaker', 'Unknown Speaker')),
+                  'general_impression': str(obj.get('General Impression', 'No general impression provided'))}
+        for name, field in SpeakerAnalysis.model_fields.items():
+            if name in values:
+                continue
+            section = obj.get(field.alias, {})
+            # The old parser looked for 'FearfulAvoidant' while the prompt asks for 'Fearful-Avoidant'
+            keys = {subname: 'FearfulAvoidant' if subname == 'fearful_avoidant' else subfield.alias
+                    for subname, subfield in field.annotation.model_fields.items()}
+            section_values = {subname: section.get(key, field.annotation.model_fields[subname].default)
+                              for subname, key in keys.items()}
+            # Lax pydantic rules as before: numeric strings pass, "7/10", None and 3.4 for an int fail
+            for subname, value in section_values.items():
+                annotation = field.annotation.model_fields[subname].annotation
+                if annotation is int and (value is None or (isinstance(value, float) and not value.is_integer())):
+                    raise ValueError(f"invalid {subname}")
+                if annotation in (int, float) and isinstance(value, str):
+                    float(value)
+            values[name] = field.annotation(**section_values)
+        analyses.append(SpeakerAnalysis(**values))
+    return analyses
+
+
+def bench_output_parsing(n_outputs=300, n_speakers=3, seed=0):
+    """Parse time and model calls for a corpus of malformed analysis responses.
+
+    Responses are the fake model's answers with the defects of OUTPUT_DEFECTS injected, plus
+    any raw outputs recorded in run checkpoints (parsed only, as their prompts are not kept).
+    The old parser needs a full re-run whenever it fails; the new one repairs locally, asks
+    again only for broken sections or the speakers after a truncation, and re-runs only when
+    there is no JSON at all. 'silently_wrong' counts old parses that succeeded with values that
+    differ from the clean response (missing keys read as 0); 'correct' counts new results,
+    after any follow-up calls, that match it.
+    """
+    import glob
+    import processing
+    from checkpoints import CHECKPOINT_DIR
+    from instrumentation import RunMetrics
+    from output_parser import output_parser, repair_json
+
+    llm = use_fake_models(llm_latency=0.0, per_token_delay=0.0)
+    rng = random.Random(seed)
+    defects = rng.choices(list(OUTPUT_DEFECTS), weights=list(OUTPUT_DEFECTS.values()), k=n_outputs)
+    tasks = processing.load_tasks()
+
+    old = {'failed': 0, 'silently_wrong': 0, 'full_rerun_tokens': 0, 'parse_s': 0.0}
+    new = {'valid_json': 0, 'repaired_locally': 0, 'reasked': 0, 'full_reruns': 0, 'correct': 0, 'parse_s': 0.0}
+    metrics = RunMetrics()
+    by_defect = {}
+    for i, defect in enumerate(defects):
+        transcript = synthetic_formatted_transcript(4 * n_speakers, n_speakers=n_speakers, words_per_turn=20, seed=i)
+        prompt = processing.build_prompt(*tasks, "", transcript)
+        clean = llm.respond("\n".join(message.content for message in prompt))
+        expected = [output_parser.parse_speaker_analysis(obj) for obj in json.loads(clean)['speaker_analyses']]
+        content = malformed_output(json.loads(clean), defect, rng)
+
+        start_time = time.perf_counter()
+        try:
+            legacy = _legacy_parse_speakers(content)
+        except Exception:
+            legacy = None
+        old['parse_s'] += time.perf_counter() - start_time
+        if legacy is None:
+            old_outcome = 'full_rerun'
+            old['failed'] += 1
+            old['full_rerun_tokens'] += len(clean) // 4
+        else:
+            old_outcome = 'parsed' if legacy == expected else 'silently_wrong'
+            old['silently_wrong'] += legacy != expected
+
+        start_time = time.perf_counter()
+        try:
+            speakers, broken, truncated = output_parser.check(content)
+            [output_parser.parse_speaker_analysis(obj) for obj in speakers]
+            outcome = 'reasked' if broken or truncated else 'repaired_locally'
+        except ValueError:
+            outcome = 'full_reruns'
+        parse_seconds = time.perf_counter() - start_time
+        new['parse_s'] += parse_seconds
+        if outcome == 'repaired_locally':
+            try:
+                json.loads(content)
+                outcome = 'valid_json'
+            except json.JSONDecodeError:
+                pass
+        new[outcome] += 1
+        with metrics.activate():
+            final = processing.analyses_to_results(processing.complete_speaker_analyses(prompt, llm, content))
+        new['correct'] += [processing.speaker_result(analysis) for analysis in expected] == list(final.values())
+        counts = by_defect.setdefault(defect, {'responses': 0, 'old': {}, 'new': {}, 'new_parse_s': 0.0})
+        counts['responses'] += 1
+        counts['old'][old_outcome] = counts['old'].get(old_outcome, 0) + 1
+        counts['new'][outcome] = counts['new'].get(outcome, 0) + 1
+        counts['new_parse_s'] += parse_seconds
+
+    followups = {stage: {'calls': metrics.stages[stage]['calls'],
+                         'completion_tokens': metrics.stages[stage]['completion_tokens']}
+                 for stage in ('section_reask', 'continuation', 'full_reask') if stage in metrics.stages}
+    results = [
+        {'parser': 'old', 'responses': n_outputs, 'parse_ms': round(1000 * old['parse_s'] / n_outputs, 3),
+         'full_reruns': old['failed'], 'rerun_completion_tokens': old['full_rerun_tokens'],
+         'silently_wrong': old['silently_wrong']},
+        {'parser': 'new', 'responses': n_outputs, 'parse_ms': round(1000 * new['parse_s'] / n_outputs, 3),
+         **{key: new[key] for key in ('valid_json', 'repaired_locally', 'reasked', 'full_reruns')},
+         'followups': followups, 'correct': new['correct']},
+    ]
+    for defect, counts in by_defect.items():
+        parse_ms = round(1000 * counts.pop('new_parse_s') / counts['responses'], 3)
+        results.append({'defect': defect, **counts, 'new_parse_ms': parse_ms})
+
+    recorded = {'outputs': 0, 'clean': 0, 'repaired': 0, 'unusable': 0}
+    for path in glob.glob(os.path.join(CHECKPOINT_DIR, '*', 'raw_llm_output.json')):
+        with open(path, 'r', encoding='utf-8') as file:
+            content = json.load(file)['value']
+        recorded['outputs'] += 1
+        try:
+            json.loads(content)
+            recorded['clean'] += 1
+        except json.JSONDecodeError:
+            try:
+                repair_json(content)
+                recorded['repaired'] += 1
+            except ValueError:
+                recorded['unusable'] += 1
+    if recorded['outputs']:
+        results.append({'recorded': recorded})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Performance benchmarks for the analysis pipeline")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    audio_parser = subparsers.add_parser('audio', help="Audio extraction: wall time, peak RSS, output size")
+    audio_parser.add_argument('video_path')
+
+    speakers_parser = subparsers.add_parser('speakers', help="Word-to-speaker assignment on synthetic transcripts")
+    speakers_parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+
+    jobs_parser = subparsers.add_parser('jobs', help="Concurrent Transcribe job polling against a fake client")
+    jobs_parser.add_argument('--jobs', type=int, default=50)
+
+    chunks_parser = subparsers.add_parser('chunks', help="Chunked transcription wall time versus chunk count")
+    chunks_parser.add_argument('--hours', type=float, default=2.0)
+    chunks_parser.add_argument('--chunks', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+
+    upload_parser = subparsers.add_parser('upload', help="Multipart S3 upload throughput against a fake S3")
+    upload_parser.add_argument('--size-mb', type=int, default=256)
+
+    subparsers.add_parser('coldstart', help="Import time of processing and first knowledge index load")
+
+    retrieval_parser = subparsers.add_parser('retrieval', help="Merged knowledge index versus three retrievers")
+    retrieval_parser.add_argument('--queries', type=int, default=5)
+
+    subparsers.add_parser('prompt', help="Prompt tokens before/after context deduplication and budgeting")
+
+    mapreduce_parser = subparsers.add_parser('mapreduce', help="Map-reduce analysis wall time versus window count")
+    mapreduce_parser.add_argument('--workers', type=int, default=4)
+
+    subparsers.add_parser('tasks', help="One combined analysis prompt versus concurrent per-task calls")
+
+    stream_parser = subparsers.add_parser('stream', help="Time to first speaker with streamed LLM output")
+    stream_parser.add_argument('--speakers', type=int, nargs='+', default=[1, 2, 3])
+
+    subparsers.add_parser('llmcache', help="Repeated analyses with the LLM response cache")
+
+    subparsers.add_parser('semantic', help="Retrieval latency with and without the semantic cache")
+
+    subparsers.add_parser('prefix', help="Provider prompt-cache hits with the static prompt prefix")
+
+    load_parser = subparsers.add_parser('load', help="Concurrent users through the async analysis pipeline")
+    load_parser.add_argument('--users', type=int, nargs='+', default=[1, 5, 10, 20])
+
+    ratelimit_parser = subparsers.add_parser('ratelimit', help="Rate-limited endpoint with and without the scheduler")
+    ratelimit_parser.add_argument('--requests', type=int, default=60)
+
+    e2e_parser = subparsers.add_parser('e2e', help="Offline end-to-end analyses with per-stage timings and baselines")
+    e2e_parser.add_argument('--profiles', nargs='+', choices=list(E2E_PROFILES), default=list(E2E_PROFILES))
+    e2e_parser.add_argument('--baseline', help="Compare against results saved with --save-baseline, such as benchmarks/e2e_baseline.json")
+    e2e_parser.add_argument('--save-baseline', help="Write these results to a JSON baseline file")
+
+    rtf_parser = subparsers.add_parser('rtf', help="Real-time factor of the local CPU transcription backend")
+    rtf_parser.add_argument('audio_path', help="Recording with speech, in any format ffmpeg reads")
+    rtf_parser.add_argument('--models', nargs='+', default=['tiny', 'base', 'small'],
+                            help="faster-whisper model names or local model directories")
+    rtf_parser.add_argument('--compute-types', nargs='+', default=['int8'])
+    rtf_parser.add_argument('--threads', type=int, default=0, help="CPU threads (0: CTranslate2's default)")
+    rtf_parser.add_argument('--thresholds', nargs='+', type=float,
+                            help="Speaker distance thresholds to try (default SPEAKER_DISTANCE_THRESHOLD)")
+    rtf_parser.add_argument('--speakers', type=int, help="Number of people in the recording, to check the count")
+
+    transcript_parser = subparsers.add_parser('transcript', help="Columnar transcript versus the formatted string")
+    transcript_parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+
+    parse_parser = subparsers.add_parser('parse', help="Malformed model outputs: parse time, re-asks and full re-runs")
+    parse_parser.add_argument('--outputs', type=int, default=300)
+
+    args = parser.parse_args()
+    if args.benchmark == 'audio':
+        results = bench_audio_extraction(args.video_path)
+    elif args.benchmark == 'speakers':
+        results = bench_speaker_assignment(args.sizes)
+    elif args.benchmark == 'jobs':
+        results = bench_transcribe_jobs(args.jobs)
+    elif args.benchmark == 'chunks':
+        results = bench_chunked_transcription(args.hours, args.chunks)
+    elif args.benchmark == 'upload':
+        results = bench_s3_upload(args.size_mb)
+    elif args.benchmark == 'coldstart':
+        results = bench_cold_start()
+    elif args.benchmark == 'retrieval':
+        results = bench_retrieval(args.queries)
+    elif args.benchmark == 'prompt':
+        results = bench_prompt_tokens()
+    elif args.benchmark == 'mapreduce':
+        results = bench_map_reduce(max_workers=args.workers)
+    elif args.benchmark == 'tasks':
+        results = bench_split_tasks()
+    elif args.benchmark == 'stream':
+        results = bench_streaming(args.speakers)
+    elif args.benchmark == 'llmcache':
+        results = bench_llm_cache()
+    elif args.benchmark == 'semantic':
+        results = bench_semantic_cache()
+    elif args.benchmark == 'prefix':
+        results = bench_prefix_cache()
+    elif args.benchmark == 'load':
+        results = bench_load(args.users)
+    elif args.benchmark == 'ratelimit':
+        results = bench_rate_limits(args.requests)
+    elif args.benchmark == 'e2e':
+        results = bench_end_to_end(args.profiles, args.baseline, args.save_baseline)
+    elif args.benchmark == 'rtf':
+        results = bench_local_rtf(args.audio_path, args.models, args.compute_types, args.threads, args.thresholds,
+                                  args.speakers)
+    elif args.benchmark == 'transcript':
+        results = bench_transcript(args.sizes)
+    elif args.benchmark == 'parse':
+        results = bench_output_parsing(args.outputs)
+
+    for result in results:
+        print(json.dumps(result))
+    if args.benchmark == 'e2e' and any('error' in result for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import json
+import os
+import shutil
+import threading
+import time
+from transcript_cache import hash_file
+
+CHECKPOINT_DIR = os.path.join('.cache', 'runs')
+# Runs untouched for longer than this are deleted, finished or not
+CHECKPOINT_RETENTION = 7 * 24 * 3600
+# File artifacts (extracted audio, chunk files) of unfinished runs are deleted sooner, as they are large
+ARTIFACT_RETENTION = 24 * 3600
+COMPLETE_MARKER = 'complete'
+
+
+def run_id_for(video_path):
+    """Run ID derived from the video's content, so a retry of the same upload finds its checkpoints."""
+    return hash_file(video_path)[:24]
+
+
+class RunCheckpoint:
+    """Stage outputs of one analysis run, stored as JSON files under root/<run_id>/.
+
+    save() writes through a temp file and os.replace, so a stage is either fully recorded or
+    absent and a retry resumes after the last completed stage. Large artifacts (extracted
+    audio, chunk files) live in the same directory and are removed by finish() once the run
+    succeeds; the small JSON stages stay until the retention period expires.
+    """
+
+    def __init__(self, run_id, root=CHECKPOINT_DIR):
+        self.run_id = run_id
+        self.dir = os.path.join(root, run_id)
+        os.makedirs(self.dir, exist_ok=True)
+        os.utime(self.dir)  # the retention clock restarts whenever a run is resumed
+
+    def _path(self, stage):
+        return os.path.join(self.dir, f"{stage}.json")
+
+    def has(self, stage):
+        return os.path.exists(self._path(stage))
+
+    def load(self, stage, default=None):
+        try:
+            with open(self._path(stage), 'r', encoding='utf-8') as file:
+                return json.load(file)['value']
+        except (OSError, ValueError, KeyError):
+            return default
+
+    def save(self, stage, value):
+        path = self._path(stage)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'value': value, 'saved': time.time()}, file)
+        os.replace(tmp_path, path)
+        return value
+
+    def discard(self, *stages):
+        for stage in stages:
+            try:
+                os.remove(self._path(stage))
+            except FileNotFoundError:
+                pass
+
+    def load_file(self, stage):
+        """Path of a file artifact recorded by save_file, if it still exists."""
+        path = self.load(stage)
+        return path if path and os.path.exists(path) else None
+
+    def save_file(self, stage, path):
+        # The file is complete by the time it is recorded, so an interrupted write is never reused
+        return self.save(stage, os.path.abspath(path))
+
+    @property
+    def complete(self):
+        return self.has(COMPLETE_MARKER)
+
+    def remove_files(self):
+        """Delete the run's file artifacts, keeping the JSON stages."""
+        _remove_artifacts(self.dir)
+
+    def finish(self):
+        """Mark the run complete and delete its file artifacts, keeping the JSON stages."""
+        self.remove_files()
+        self.save(COMPLETE_MARKER, True)
+
+
+class RunLock:
+    """Exclusive hold on a run ID, so two analyses of the same video never share a run directory.
+
+    The lock is a <run_id>.lock file next to the run directories, created with O_EXCL and holding
+    the owner's pid. A lock left behind by a process that no longer exists is taken over.
+    """
+
+    def __init__(self, run_id, root=CHECKPOINT_DIR):
+        self.path = os.path.join(root, f"{run_id}.lock")
+
+    def acquire(self):
+        """Take the lock if it is free; returns whether it was taken."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if self._stale():
+                self.release()
+            return False  # taken over, if stale, on the next attempt
+        with os.fdopen(fd, 'w') as file:
+            file.write(str(os.getpid()))
+        return True
+
+    def _stale(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                pid = int(file.read())
+        except (OSError, ValueError):
+            return False  # gone already, or its owner is still writing the pid
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    def release(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def locked(root, run_id):
+    return os.path.exists(os.path.join(root, f"{run_id}.lock"))
+
+
+def _remove_artifacts(run_dir, older_than=None):
+    for name in os.listdir(run_dir):
+        path = os.path.join(run_dir, name)
+        if name.endswith('.json') or (older_than is not None and os.stat(path).st_mtime >= older_than):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+
+def purge_expired_runs(root=CHECKPOINT_DIR, retention=CHECKPOINT_RETENTION,
+                       artifact_retention=ARTIFACT_RETENTION):
+    """Delete run directories not touched within retention seconds, and file artifacts older than
+    artifact_retention from the others; runs in progress are left alone. Returns how many runs
+    were removed."""
+    if not os.path.isdir(root):
+        return 0
+    now = time.time()
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if not os.path.isdir(path) or locked(root, name):
+                continue
+            if os.stat(path).st_mtime < now - retention:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+            else:
+                _remove_artifacts(path, older_than=now - artifact_retention)
+        except OSError:
+            continue
+    return removed
@@ -0,0 +1,257 @@
+import os
+import wave
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from instrumentation import with_current_run
+from transcription_backends import MIN_EMBEDDING_SECONDS, SPEAKER_DISTANCE_THRESHOLD, voice_embedding
+from transcription_diarization import transcribe_file, word_speaker_labels
+
+# Recordings longer than this are transcribed in parallel chunks
+LONG_RECORDING_SECONDS = 20 * 60
+CHUNK_SECONDS = 10 * 60
+# Each chunk also covers this much audio before its start, used to align speaker labels
+CHUNK_OVERLAP_SECONDS = 60
+# Chunk boundaries move to the quietest point within this distance of the target
+SILENCE_SEARCH_SECONDS = 30
+ENERGY_HOP_SECONDS = 0.1
+# Overlap words from neighbouring chunks match if their start times differ by less than this
+WORD_MATCH_TOLERANCE = 0.25
+MAX_PARALLEL_CHUNKS = 8
+# A speaker's voice print in a chunk is taken from at most this much of their speech
+VOICE_PRINT_SECONDS = 30
+# More global speakers than this in one recording are reported as a likely alignment problem;
+# they are kept, since merging them would give one person's speech to another
+EXPECTED_MAX_SPEAKERS = 10
+
+
+def frame_energies(wav_path, hop_seconds=ENERGY_HOP_SECONDS):
+    """RMS energy per hop of a 16-bit PCM WAV, read block by block to keep memory bounded."""
+    with wave.open(wav_path, 'rb') as wav_file:
+        channels = wav_file.getnchannels()
+        hop_frames = max(1, int(wav_file.getframerate() * hop_seconds))
+        energies = []
+        while True:
+            block = wav_file.readframes(hop_frames * 600)
+            if not block:
+                break
+            samples = np.frombuffer(block, dtype=np.int16).astype(np.float32)
+            samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+            usable = len(samples) // hop_frames * hop_frames
+            if usable:
+                energies.append(np.sqrt((samples[:usable].reshape(-1, hop_frames) ** 2).mean(axis=1)))
+            if len(samples) > usable:
+                energies.append(np.sqrt(np.array([(samples[usable:] ** 2).mean()])))
+    return np.concatenate(energies) if energies else np.zeros(0, dtype=np.float32)
+
+
+def find_split_points(energies, chunk_seconds=CHUNK_SECONDS, search_seconds=SILENCE_SEARCH_SECONDS,
+                      hop_seconds=ENERGY_HOP_SECONDS):
+    """Chunk boundaries (seconds) placed at the quietest half second near every chunk_seconds."""
+    duration = len(energies) * hop_seconds
+    smoothing = max(1, int(0.5 / hop_seconds))
+    smoothed = np.convolve(energies, np.ones(smoothing) / smoothing, mode='same')
+
+    split_points = []
+    target = chunk_seconds
+    while target < duration - search_seconds:
+        lo = int((target - search_seconds) / hop_seconds)
+        hi = int(min(target + search_seconds, duration) / hop_seconds)
+        split_points.append((lo + int(np.argmin(smoothed[lo:hi]))) * hop_seconds)
+        target = split_points[-1] + chunk_seconds
+    return split_points
+
+
+def chunk_ranges(split_points, duration, overlap=CHUNK_OVERLAP_SECONDS):
+    """(audio_start, keep_start, keep_end) per chunk; audio before keep_start is overlap only."""
+    boundaries = [0.0] + list(split_points) + [duration]
+    return [(max(0.0, start - overlap), start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+def split_wav(wav_path, ranges, output_dir):
+    chunk_paths = []
+    with wave.open(wav_path, 'rb') as wav_file:
+        params = wav_file.getparams()
+        for i, (audio_start, _, keep_end) in enumerate(ranges):
+            wav_file.setpos(int(audio_start * params.framerate))
+            n_frames = int((keep_end - audio_start) * params.framerate)
+            chunk_path = os.path.join(output_dir, f"chunk_{i:03d}.wav")
+            with wave.open(chunk_path, 'wb') as chunk_file:
+                chunk_file.setparams(params)
+                chunk_file.writeframes(wav_file.readframes(n_frames))
+            chunk_paths.append(chunk_path)
+    return chunk_paths
+
+
+def transcribe_chunks(chunk_paths, transcribe=transcribe_file, job_prefix='chunk', max_workers=MAX_PARALLEL_CHUNKS):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(with_current_run(transcribe), path, f"{job_prefix}_{i:03d}") for i, path in enumerate(chunk_paths)]
+        return [future.result() for future in futures]
+
+
+def _chunk_words(transcript_data, offset):
+    """Pronunciations of one chunk shifted to global time, each with its trailing punctuation."""
+    items = transcript_data['results']['items']
+    segments = transcript_data['results'].get('speaker_labels', {}).get('segments', [])
+    pronunciations = [item for item in items if item['type'] == 'pronunciation']
+    labels = word_speaker_labels(segments, pronunciations)
+
+    words = []
+    label_iter = iter(labels)
+    for item in items:
+        if item['type'] == 'pronunciation':
+            words.append({'start': float(item['start_time']) + offset, 'end': float(item['end_time']) + offset,
+                          'label': next(label_iter), 'item': item, 'punctuation': []})
+        elif item['type'] == 'punctuation' and words:
+            words[-1]['punctuation'].append(item)
+    return words
+
+
+def _voice_prints(wav_file, words, keep_start, keep_end, max_seconds=VOICE_PRINT_SECONDS):
+    """Voice embedding per label from its first max_seconds of words in [keep_start, keep_end).
+
+    Only the words' audio is read, so the whole recording never has to be in memory. Labels
+    with less than MIN_EMBEDDING_SECONDS of speech get no print.
+    """
+    rate, channels = wav_file.getframerate(), wav_file.getnchannels()
+    spans = {}
+    for word in words:
+        if word['label'] is None or not keep_start <= word['start'] < keep_end:
+            continue
+        label_spans = spans.setdefault(word['label'], [])
+        if sum(end - start for start, end in label_spans) < max_seconds:
+            label_spans.append((word['start'], word['end']))
+
+    prints = {}
+    for label, label_spans in spans.items():
+        if sum(end - start for start, end in label_spans) < MIN_EMBEDDING_SECONDS:
+            continue
+        samples = []
+        for start, end in label_spans:
+            wav_file.setpos(min(int(start * rate), wav_file.getnframes()))
+            block = np.frombuffer(wav_file.readframes(max(1, int((end - start) * rate))), dtype=np.int16)
+            samples.append(block[:len(block) // channels * channels].reshape(-1, channels).mean(axis=1))
+        vector = voice_embedding((np.concatenate(samples) / 32768.0).astype(np.float32), rate)
+        prints[label] = vector / max(np.linalg.norm(vector), 1e-8)
+    return prints
+
+
+def align_speakers(previous_words, words, keep_start, overlap, next_global_id, local_prints=None,
+                   global_prints=None, max_distance=SPEAKER_DISTANCE_THRESHOLD):
+    """Map this chunk's local spk_N labels onto global labels by voting over the overlap region.
+
+    previous_words already carry global labels. Words in the overlap are paired by start time,
+    and local labels are assigned greedily to the global label they co-occur with most.
+    A label silent in the overlap reuses a global label only if their voice prints are within
+    max_distance cosine distance (local_prints are normalized voice_embedding vectors, global_prints
+    sums of them); without such evidence it gets a fresh global id rather than someone else's.
+    """
+    overlap_start = keep_start - overlap
+    previous = [w for w in previous_words if overlap_start <= w['start'] < keep_start and w['label'] is not None]
+    previous_starts = np.array([w['start'] for w in previous])
+
+    votes = Counter()
+    if len(previous):
+        for word in words:
+            if word['start'] >= keep_start or word['label'] is None:
+                continue
+            i = int(np.searchsorted(previous_starts, word['start']))
+            candidates = [j for j in (i - 1, i) if 0 <= j < len(previous)]
+            j = min(candidates, key=lambda j: abs(previous_starts[j] - word['start']))
+            if abs(previous_starts[j] - word['start']) < WORD_MATCH_TOLERANCE:
+                votes[(word['label'], previous[j]['label'])] += 1
+
+    mapping, used = {}, set()
+    for (local_label, global_label), _ in votes.most_common():
+        if local_label not in mapping and global_label not in used:
+            mapping[local_label] = global_label
+            used.add(global_label)
+
+    unmatched = sorted({w['label'] for w in words if w['label'] is not None} - set(mapping))
+    if local_prints and global_prints:
+        # Closest pairs first, so each known voice goes to the label that sounds most like it
+        pairs = sorted((1 - float(local_prints[local_label] @ global_print) / max(np.linalg.norm(global_print), 1e-8),
+                        local_label, global_label)
+                       for local_label in unmatched if local_label in local_prints
+                       for global_label, global_print in global_prints.items() if global_label not in used)
+        for distance, local_label, global_label in pairs:
+            if distance > max_distance:
+                break
+            if local_label not in mapping and global_label not in used:
+                mapping[local_label] = global_label
+                used.add(global_label)
+    for local_label in unmatched:
+        if local_label not in mapping:
+            mapping[local_label] = f"spk_{next_global_id}"
+            next_global_id += 1
+    return mapping, next_global_id
+
+
+def stitch_transcripts(chunk_transcripts, ranges, overlap=CHUNK_OVERLAP_SECONDS, wav_path=None,
+                       max_distance=SPEAKER_DISTANCE_THRESHOLD):
+    """Merge per-chunk Transcribe results into one transcript with globally consistent speakers.
+
+    The result has the Transcribe JSON shape with a speaker_label on every pronunciation, so
+    extract_transcriptions_with_speakers can format it as usual. Each chunk's job finds at most
+    MaxSpeakerLabels speakers, but the recording as a whole has no limit: with wav_path, speakers
+    silent in an overlap are recognised by voice, and any other new label stays a new speaker.
+    More than EXPECTED_MAX_SPEAKERS only prints a warning.
+    """
+    chunk_words = [_chunk_words(transcript_data, audio_start)
+                   for transcript_data, (audio_start, _, _) in zip(chunk_transcripts, ranges)]
+    chunk_prints = [None] * len(chunk_words)
+    if wav_path:
+        with wave.open(wav_path, 'rb') as wav_file:
+            chunk_prints = [_voice_prints(wav_file, words, keep_start, keep_end)
+                            for words, (_, keep_start, keep_end) in zip(chunk_words, ranges)]
+
+    items, segments = [], []
+    previous_words = []
+    next_global_id = 0
+    global_prints = {}
+    for words, local_prints, (audio_start, keep_start, keep_end) in zip(chunk_words, chunk_prints, ranges):
+        mapping, next_global_id = align_speakers(previous_words, words, keep_start, overlap, next_global_id,
+                                                 local_prints, global_prints, max_distance)
+        for local_label, vector in (local_prints or {}).items():
+            global_prints[mapping[local_label]] = global_prints.get(mapping[local_label], 0) + vector
+        for word in words:
+            word['label'] = mapping.get(word['label'])
+
+        for word in words:
+            if not keep_start <= word['start'] < keep_end:
+                continue
+            item = dict(word['item'], start_time=f"{word['start']:.3f}", end_time=f"{word['end']:.3f}")
+            if word['label'] is not None:
+                item['speaker_label'] = word['label']
+                if segments and segments[-1]['speaker_label'] == word['label']:
+                    segments[-1]['end_time'] = item['end_time']
+                else:
+                    segments.append({'speaker_label': word['label'], 'start_time': item['start_time'],
+                                     'end_time': item['end_time']})
+            items.append(item)
+            items.extend(word['punctuation'])
+        previous_words = words
+
+    if any('speaker_label' not in item for item in items if item['type'] == 'pronunciation'):
+        # Some words had no speaker; drop the per-item labels so the segment lookup decides
+        for item in items:
+            item.pop('speaker_label', None)
+    if next_global_id > EXPECTED_MAX_SPEAKERS:
+        print(f"Warning: stitched transcript has {next_global_id} speakers, more than the "
+              f"{EXPECTED_MAX_SPEAKERS} expected; some may be one person split across chunks")
+    return {'results': {'speaker_labels': {'segments': segments}, 'items': items}}
+
+
+def transcribe_long_audio(wav_path, output_dir, transcribe=transcribe_file, chunk_seconds=CHUNK_SECONDS,
+                          overlap=CHUNK_OVERLAP_SECONDS, max_workers=MAX_PARALLEL_CHUNKS, job_prefix='chunk'):
+    """Split a long WAV at silences, transcribe the overlapping chunks in parallel and stitch them."""
+    energies = frame_energies(wav_path)
+    duration = len(energies) * ENERGY_HOP_SECONDS
+    ranges = chunk_ranges(find_split_points(energies, chunk_seconds), duration, overlap)
+    print(f"Transcribing {duration:.0f}s of audio in {len(ranges)} chunks")
+
+    chunk_paths = split_wav(wav_path, ranges, output_dir)
+    chunk_transcripts = transcribe_chunks(chunk_paths, transcribe, job_prefix, max_workers)
+    if any(transcript_data is None for transcript_data in chunk_transcripts):
+        return None
+    return stitch_transcripts(chunk_transcripts, ranges, overlap, wav_path)
@@ -0,0 +1,528 @@
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import wave
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from requests import Response
+from requests.adapters import BaseAdapter
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.pydantic_v1 import Field
+
+# Local stand-ins for the AWS clients and OpenAI models used by this project, for benchmarks and
+# offline runs. They implement only the calls this project makes, with the real response shapes.
+
+
+class FakeS3Client:
+    """Stores uploads in memory and simulates multipart transfer timing.
+
+    Each part costs request_latency plus its size over connection_bandwidth (bytes/s), and parts
+    run concurrently up to the TransferConfig's max_concurrency, like boto3's transfer manager.
+    With stored_bytes set, only that many leading bytes of each object are kept (enough for an
+    audio header), so large uploads do not inflate memory measurements.
+    """
+
+    def __init__(self, request_latency=0.0, connection_bandwidth=None, stored_bytes=None):
+        self.request_latency = request_latency
+        self.connection_bandwidth = connection_bandwidth
+        self.stored_bytes = stored_bytes
+        self.objects = {}
+        self.sizes = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _transfer(self, stream, bucket_name, key, Config=None, Callback=None):
+        chunk_size = Config.multipart_chunksize if Config else 8 * 2**20
+        threshold = Config.multipart_threshold if Config else 8 * 2**20
+        max_concurrency = Config.max_concurrency if Config else 10
+        sizes = []
+
+        def send_part(data):
+            duration = self.request_latency
+            if self.connection_bandwidth:
+                duration += len(data) / self.connection_bandwidth
+            time.sleep(duration)
+            with self._lock:
+                self.requests += 1
+                sizes.append(len(data))
+            if Callback:
+                Callback(len(data))
+            return data if self.stored_bytes is None else data[:self.stored_bytes]
+
+        first = stream.read(threshold)
+        if len(first) < threshold:
+            parts = [send_part(first)]
+        else:
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                futures = []
+                data = first
+                while data:
+                    for i in range(0, len(data), chunk_size):
+                        futures.append(executor.submit(send_part, data[i:i + chunk_size]))
+                    data = stream.read(chunk_size)
+                parts = [future.result() for future in futures]
+        body = b''.join(parts)
+        with self._lock:
+            self.objects[(bucket_name, key)] = body if self.stored_bytes is None else body[:self.stored_bytes]
+            self.sizes[(bucket_name, key)] = sum(sizes)
+
+    def upload_file(self, file_path, bucket_name, key, Config=None, Callback=None, **kwargs):
+        with open(file_path, 'rb') as file:
+            self._transfer(file, bucket_name, key, Config, Callback)
+
+    def upload_fileobj(self, fileobj, bucket_name, key, Config=None, Callback=None, **kwargs):
+        self._transfer(fileobj, bucket_name, key, Config, Callback)
+
+
+class FakeTranscribeClient:
+    """Jobs complete after queue_time + audio_duration * realtime_factor seconds of wall time.
+
+    audio_durations maps media URIs to their duration; with an s3_client, WAV media uploaded to it
+    are measured from their header; anything else uses default_duration. failure_rate makes a
+    random share of jobs end in FAILED, and malformed_rate a share report COMPLETED without a
+    Transcript.
+    """
+
+    def __init__(self, queue_time=0.5, realtime_factor=0.05, default_duration=60.0, audio_durations=None,
+                 failure_rate=0.0, api_latency=0.0, transcript_uri_prefix='fake://transcripts', seed=0,
+                 s3_client=None, malformed_rate=0.0):
+        self.s3_client = s3_client
+        self.queue_time = queue_time
+        self.realtime_factor = realtime_factor
+        self.default_duration = default_duration
+        self.audio_durations = audio_durations or {}
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.api_latency = api_latency
+        self.transcript_uri_prefix = transcript_uri_prefix
+        self.jobs = {}
+        self.calls = {'start_transcription_job': 0, 'get_transcription_job': 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def duration_for(self, media_uri):
+        if media_uri in self.audio_durations:
+            return self.audio_durations[media_uri]
+        if self.s3_client is not None and media_uri.startswith('s3://'):
+            bucket_name, key = media_uri[len('s3://'):].split('/', 1)
+            data = self.s3_client.objects.get((bucket_name, key))
+            try:
+                with wave.open(io.BytesIO(data), 'rb') as wav_file:
+                    return wav_file.getnframes() / wav_file.getframerate()
+            except Exception:
+                pass
+        return self.default_duration
+
+    def start_transcription_job(self, TranscriptionJobName, Media, MediaFormat, **kwargs):
+        time.sleep(self.api_latency)
+        duration = self.duration_for(Media['MediaFileUri'])
+        now = time.monotonic()
+        with self._lock:
+            self.calls['start_transcription_job'] += 1
+            if TranscriptionJobName in self.jobs:
+                raise ValueError(f"Job {TranscriptionJobName} already exists")
+            self.jobs[TranscriptionJobName] = {
+                'media_uri': Media['MediaFileUri'],
+                'duration': duration,
+                'created': now,
+                'started': now + self.queue_time,
+                'completes': now + self.queue_time + duration * self.realtime_factor,
+                'fails': self._rng.random() < self.failure_rate,
+                'malformed': self.malformed_rate > 0 and self._rng.random() < self.malformed_rate,
+            }
+
+    def get_transcription_job(self, TranscriptionJobName):
+        time.sleep(self.api_latency)
+        with self._lock:
+            self.calls['get_transcription_job'] += 1
+            job = self.jobs[TranscriptionJobName]
+        now = time.monotonic()
+        # Timestamps are datetimes, as boto3 returns them
+        timestamp = lambda moment: datetime.now(timezone.utc) - timedelta(seconds=now - moment)
+        transcription_job = {'TranscriptionJobName': TranscriptionJobName, 'CreationTime': timestamp(job['created'])}
+        if now >= job['started']:
+            transcription_job['StartTime'] = timestamp(job['started'])
+        if now >= job['completes']:
+            transcription_job['CompletionTime'] = timestamp(job['completes'])
+        if now < job['started']:
+            transcription_job['TranscriptionJobStatus'] = 'QUEUED'
+        elif now < job['completes']:
+            transcription_job['TranscriptionJobStatus'] = 'IN_PROGRESS'
+        elif job['fails']:
+            transcription_job['TranscriptionJobStatus'] = 'FAILED'
+            transcription_job['FailureReason'] = 'Simulated failure'
+        else:
+            transcription_job['TranscriptionJobStatus'] = 'COMPLETED'
+            transcription_job['LanguageCode'] = 'en-US'
+            if job['malformed']:
+                return {'TranscriptionJob': transcription_job}
+            transcription_job['Transcript'] = {
+                'TranscriptFileUri': f"{self.transcript_uri_prefix}/{TranscriptionJobName}.json"
+            }
+        return {'TranscriptionJob': transcription_job}
+
+
+FAKE_WORDS = ("i think we should talk about what happened yesterday because honestly it still bothers me "
+              "and you never really listen when i try to explain how i feel about the way things are going").split()
+
+
+def fake_transcript_json(duration, n_speakers=2, words_per_second=2.5, seed=""):
+    """Transcribe-shaped JSON for duration seconds of conversation, with speaker segments."""
+    rng = _stable_random("transcript", seed)
+    items, segments = [], []
+    t = 0.0
+    while t < duration:
+        label = f"spk_{rng.randrange(n_speakers)}"
+        segment_start = t
+        for _ in range(rng.randint(5, 25)):
+            end = t + 1 / words_per_second * (0.6 + 0.4 * rng.random())
+            items.append({'type': 'pronunciation', 'start_time': f"{t:.3f}", 'end_time': f"{end:.3f}",
+                          'alternatives': [{'content': rng.choice(FAKE_WORDS)}]})
+            t = end
+        items.append({'type': 'punctuation', 'alternatives': [{'content': '.'}]})
+        segments.append({'speaker_label': label, 'start_time': f"{segment_start:.3f}", 'end_time': f"{t:.3f}"})
+        t += 0.3
+    return {'results': {'speaker_labels': {'segments': segments}, 'items': items}}
+
+
+class FakeTranscriptAdapter(BaseAdapter):
+    """Serves the fake:// transcript URLs of a FakeTranscribeClient's completed jobs.
+
+    Mount it on transcription_diarization.http_session with session.mount('fake://', adapter).
+    Each transcript is generated from the job's audio duration and is stable per job name.
+    """
+
+    def __init__(self, transcribe_client, n_speakers=2, latency=0.0, words_per_second=2.5):
+        super().__init__()
+        self.transcribe_client = transcribe_client
+        self.n_speakers = n_speakers
+        self.latency = latency
+        self.words_per_second = words_per_second
+
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        job_name = request.url.rsplit('/', 1)[-1].rsplit('.json', 1)[0]
+        response = Response()
+        response.url = request.url
+        response.request = request
+        job = self.transcribe_client.jobs.get(job_name)
+        if job is None:
+            response.status_code = 404
+            response._content = b'{}'
+            return response
+        transcript = fake_transcript_json(job['duration'], self.n_speakers, self.words_per_second, seed=job_name)
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps(transcript).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+class HashedEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings: each word is hashed to a signed dimension.
+
+    The default size matches OpenAI's ada-002 vectors, so the pre-built knowledge indexes load
+    unchanged. Texts sharing words get similar vectors, which is enough for retrieval benchmarks.
+    """
+
+    def __init__(self, size=1536, latency=0.0):
+        self.size = size
+        self.latency = latency
+        self.calls = 0
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'little')
+            vector[digest % self.size] += 1.0 if digest >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def _stable_random(*parts):
+    seed = int.from_bytes(hashlib.blake2b("|".join(parts).encode(), digest_size=8).digest(), 'little')
+    return random.Random(seed)
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic stand-in for the ChatOpenAI model from llm_loader.
+
+    Query-generation prompts get a fixed list of search queries; analysis prompts get a
+    well-formed 'speaker_analyses' JSON with one entry per 'Speaker N' in the Input section and
+    scores derived from a hash of the prompt. Follow-ups asking again for some sections of one
+    speaker, or for the speakers after a truncated answer, get only those. Each call sleeps
+    latency plus per_token_delay for every (approximate) output token, so concurrency effects are
+    measurable. Streaming delivers the same response stream_chunk_tokens tokens at a time, paced
+    by per_token_delay.
+
+    With prefix_cache set, it mimics OpenAI prompt caching: the longest prefix shared with an
+    earlier prompt counts as cached once it reaches 1024 tokens, in 128-token steps. Cached
+    input tokens cost cached_input_discount of per_input_token_delay, and every response reports
+    token_usage with prompt_tokens_details.cached_tokens like the OpenAI API.
+    """
+
+    latency: float = 0.0
+    per_token_delay: float = 0.0
+    explanation_words: int = 40
+    stream_chunk_tokens: int = 4
+    prefix_cache: bool = False
+    per_input_token_delay: float = 0.0
+    cached_input_discount: float = 0.1
+    seen_prompts: list = Field(default_factory=list)
+    model_name: str = "fake-chat"
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def respond(self, prompt):
+        if prompt.startswith("Generate multiple search queries"):
+            return "\n".join([
+                "1. attachment style indicators in conversation",
+                "2. big five personality traits in speech",
+                "3. personality disorder markers in dialogue",
+                "4. emotional regulation and relationships",
+            ])
+
+        transcript = prompt.rsplit("\nInput: ", 1)[-1].split("\nPlease provide", 1)[0]
+        speakers = list(dict.fromkeys(re.findall(r"Speaker \d+", transcript))) or ["Speaker 1"]
+        # Follow-ups from processing.complete_speaker_analyses ask for some speakers or sections only
+        reask = re.search(r"Please provide only the (.+?) section\(s\) for (.+?) again", prompt)
+        continuation = re.search(r"remaining speakers only, continuing after (.+?)\. Respond", prompt)
+        if reask:
+            speakers = [reask.group(2)]
+        elif continuation:
+            done = set(re.findall(r"Speaker \d+", continuation.group(1)))
+            speakers = [speaker for speaker in speakers if speaker not in done]
+        analyses = [self._analysis(speaker, transcript) for speaker in speakers]
+        # Single-task prompts only get their own section back
+        task = re.search(r"Please provide the (.+?) analysis for each speaker", prompt)
+        sections = re.findall(r"'(.+?)'", reask.group(1)) if reask else [task.group(1)] if task else None
+        if sections:
+            analyses = [{"Speaker": a["Speaker"], **{section: a.get(section, {}) for section in sections}}
+                        for a in analyses]
+        return json.dumps({"speaker_analyses": analyses})
+
+    def _analysis(self, speaker, transcript):
+        rng = _stable_random(speaker, transcript)
+        words = lambda: " ".join(rng.choice(["calm", "warm", "guarded", "direct", "anxious", "open"])
+                                 for _ in range(self.explanation_words))
+        probabilities = [rng.random() for _ in range(4)]
+        total = sum(probabilities)
+        return {
+            "Speaker": speaker,
+            "General Impression": words(),
+            "Attachment Styles": {
+                "Secured": probabilities[0] / total, "Anxious-Preoccupied": probabilities[1] / total,
+                "Dismissive-Avoidant": probabilities[2] / total, "FearfulAvoidant": probabilities[3] / total,
+                "Avoidance": rng.randint(0, 10), "Self": rng.randint(0, 10),
+                "Anxiety": rng.randint(0, 10), "Others": rng.randint(0, 10),
+                "Explanation": words(),
+            },
+            "Big Five Traits": {
+                "Extraversion": rng.randint(0, 10), "Agreeableness": rng.randint(0, 10),
+                "Conscientiousness": rng.randint(0, 10), "Neuroticism": rng.randint(0, 10),
+                "Openness": rng.randint(0, 10), "Explanation": words(),
+            },
+            "Personality Disorders": {
+                **{name: rng.randint(0, 5) for name in [
+                    "Depressed", "Paranoid", "Schizoid-Schizotypal", "Antisocial-Psychopathic",
+                    "Borderline-Dysregulated", "Narcissistic", "Anxious-Avoidant", "Dependent-Victimized",
+                    "Obsessional"]},
+                "Explanation": words(),
+            },
+        }
+
+    def _usage(self, prompt, content):
+        """OpenAI-style token usage for prompt, updating the simulated prefix cache."""
+        prompt_tokens = len(prompt) // 4
+        cached_tokens = 0
+        if self.prefix_cache:
+            shared = max((len(os.path.commonprefix([prompt, seen])) for seen in self.seen_prompts), default=0)
+            shared_tokens = shared // 4
+            if shared_tokens >= 1024:
+                cached_tokens = shared_tokens // 128 * 128
+            self.seen_prompts.append(prompt)
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(content) // 4,
+            'total_tokens': prompt_tokens + len(content) // 4,
+            'prompt_tokens_details': {'cached_tokens': cached_tokens},
+        }
+
+    def _prefill_time(self, token_usage):
+        cached_tokens = token_usage['prompt_tokens_details']['cached_tokens']
+        uncached_tokens = token_usage['prompt_tokens'] - cached_tokens
+        return self.per_input_token_delay * (uncached_tokens + self.cached_input_discount * cached_tokens)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        prompt = "\n".join(message.content for message in messages)
+        content = self.respond(prompt)
+        token_usage = self._usage(prompt, content)
+        time.sleep(self.latency + self._prefill_time(token_usage) + self.per_token_delay * (len(content) // 4))
+        message = AIMessage(content=content, response_metadata={'token_usage': token_usage})
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={'token_usage': token_usage})
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        prompt = "\n".join(message.content for message in messages)
+        content = self.respond(prompt)
+        token_usage = self._usage(prompt, content)
+        time.sleep(self.latency + self._prefill_time(token_usage))
+        chunk_chars = 4 * self.stream_chunk_tokens
+        for i in range(0, len(content), chunk_chars):
+            time.sleep(self.per_token_delay * self.stream_chunk_tokens)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=content[i:i + chunk_chars]))
+        # Like OpenAI with stream_options.include_usage, usage arrives in a final empty chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", response_metadata={'token_usage': token_usage}))
+
+
+class FakeOpenAIServer:
+    """Local HTTP endpoint speaking the OpenAI chat completions API, answered by a FakeChatModel.
+
+    Point ChatOpenAI (or load_model) at base_url. Like OpenAI's limiter, requests and tokens
+    (prompt plus max_tokens) are metered with buckets refilled per minute; window is how many
+    seconds of budget a bucket holds. Requests over budget get a 429 with retry-after, and
+    error_rate turns a random share of the remaining requests into 429s as well.
+    """
+
+    def __init__(self, chat_model=None, requests_per_minute=None, tokens_per_minute=None, window=60.0,
+                 error_rate=0.0, seed=0):
+        self.chat_model = chat_model or FakeChatModel()
+        self.limits = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.window = window
+        self.error_rate = error_rate
+        self.levels = {name: limit * window / 60 for name, limit in self.limits.items() if limit}
+        self.updated = time.monotonic()
+        self.counts = {'requests': 0, 'completed': 0, 'rate_limited': 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _admit(self, tokens):
+        """Seconds to wait before retrying, or None if the request is within budget."""
+        with self._lock:
+            self.counts['requests'] += 1
+            now = time.monotonic()
+            for name, limit in self.limits.items():
+                if limit:
+                    capacity = limit * self.window / 60
+                    self.levels[name] = min(capacity, self.levels[name] + (now - self.updated) * limit / 60)
+            self.updated = now
+            cost = {'requests': 1, 'tokens': tokens}
+            for name, level in self.levels.items():
+                if level < cost[name]:
+                    self.counts['rate_limited'] += 1
+                    return (cost[name] - level) * 60 / self.limits[name]
+            if self._rng.random() < self.error_rate:
+                self.counts['rate_limited'] += 1
+                return 1.0
+            for name in self.levels:
+                self.levels[name] -= cost[name]
+            return None
+
+    def _completion(self, body):
+        prompt = "\n".join(message['content'] for message in body['messages'])
+        content = self.chat_model.respond(prompt)
+        token_usage = self.chat_model._usage(prompt, content)
+        time.sleep(self.chat_model.latency + self.chat_model._prefill_time(token_usage))
+        return content, token_usage
+
+    def start(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                prompt_tokens = sum(len(message['content']) for message in body['messages']) // 4
+                wait = server._admit(prompt_tokens + (body.get('max_tokens') or 0))
+                if wait is not None:
+                    error = {'message': "Rate limit reached", 'type': 'requests', 'param': None,
+                             'code': 'rate_limit_exceeded'}
+                    self._send_json(429, {'error': error}, {'retry-after-ms': str(int(wait * 1000))})
+                    return
+
+                content, token_usage = server._completion(body)
+                response = {'id': f"chatcmpl-{server.counts['requests']}", 'created': int(time.time()),
+                            'model': body.get('model', 'fake-chat')}
+                if not body.get('stream'):
+                    message = {'role': 'assistant', 'content': content}
+                    self._send_json(200, {**response, 'object': 'chat.completion', 'usage': token_usage,
+                                          'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop',
+                                                       'logprobs': None}]})
+                else:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.end_headers()
+
+                    def send_chunk(choices, **extra):
+                        chunk = {**response, 'object': 'chat.completion.chunk', 'choices': choices, **extra}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                        self.wfile.flush()
+
+                    chunk_chars = 4 * server.chat_model.stream_chunk_tokens
+                    for i in range(0, len(content), chunk_chars):
+                        time.sleep(server.chat_model.per_token_delay * server.chat_model.stream_chunk_tokens)
+                        send_chunk([{'index': 0, 'delta': {'content': content[i:i + chunk_chars]},
+                                     'finish_reason': None}])
+                    send_chunk([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+                    if (body.get('stream_options') or {}).get('include_usage'):
+                        send_chunk([], usage=token_usage)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                with server._lock:
+                    server.counts['completed'] += 1
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
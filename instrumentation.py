@@ -0,0 +1,232 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_DIR = os.path.join('.cache', 'metrics')
+# Saved run metrics older than this are deleted
+METRICS_RETENTION = 30 * 24 * 3600
+METRICS_PREFIX = 'analyzer'
+# Counters a stage may report besides its duration, with their Prometheus help text
+COUNTERS = {
+    'bytes': "Bytes read, written or transferred",
+    'audio_seconds': "Seconds of audio processed",
+    'prompt_tokens': "Prompt tokens sent to the model",
+    'cached_tokens': "Prompt tokens served from the provider's prompt cache",
+    'completion_tokens': "Completion tokens generated by the model",
+    'cache_hits': "Model calls answered from the local response cache",
+    'cost_usd': "Estimated cost in US dollars",
+}
+
+current_run = ContextVar('current_run', default=None)
+
+
+def _empty_stage():
+    return {'calls': 0, 'seconds': 0.0, **{name: 0 for name in COUNTERS}}
+
+
+class RunMetrics:
+    """Durations, bytes, tokens and cost per pipeline stage for one analysis run.
+
+    Stages report through record() and timed(), which add to whichever run is active in the
+    current context; activate() or bind() make this run the active one. A stage reported
+    several times (one LLM call per window, say) accumulates calls and totals.
+    """
+
+    def __init__(self, run_id=None):
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self.elapsed = None
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds=0.0, calls=1, **counters):
+        with self._lock:
+            totals = self.stages.setdefault(stage, _empty_stage())
+            totals['calls'] += calls
+            totals['seconds'] += seconds
+            for name, value in counters.items():
+                totals[name] += value or 0
+
+    @contextmanager
+    def activate(self):
+        token = current_run.set(self)
+        try:
+            yield self
+        finally:
+            current_run.reset(token)
+
+    def bind(self, fn):
+        """fn wrapped to run with this run active, for use on another thread."""
+        def run(*args, **kwargs):
+            with self.activate():
+                return fn(*args, **kwargs)
+        return run
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+        registry.count_run()
+        return self
+
+    def to_dict(self):
+        with self._lock:
+            stages = {stage: {name: round(value, 6) if isinstance(value, float) else value
+                              for name, value in totals.items() if value or name in ('calls', 'seconds')}
+                      for stage, totals in self.stages.items()}
+        return {
+            'run_id': self.run_id,
+            'started': self.started,
+            'elapsed_s': round(self.elapsed if self.elapsed is not None else time.time() - self.started, 3),
+            'cost_usd': round(sum(totals.get('cost_usd', 0) for totals in stages.values()), 6),
+            'stages': stages,
+        }
+
+    def save(self, directory=METRICS_DIR):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}-{self.run_id}.json")
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.to_dict(), file, indent=2)
+        return path
+
+    def summary(self):
+        """One line per stage, in the order the stages first reported, and the estimated cost."""
+        data = self.to_dict()
+        lines = []
+        for stage, totals in data['stages'].items():
+            line = f"{stage}: {totals['seconds']:.2f} s"
+            if totals['calls'] > 1:
+                line += f" over {totals['calls']} calls"
+            if totals.get('bytes'):
+                size = totals['bytes']
+                line += f", {size / 2**20:.1f} MB" if size >= 2**20 else f", {size / 2**10:.0f} KB"
+            if totals.get('audio_seconds'):
+                line += f", {totals['audio_seconds']:.0f} s of audio"
+            if totals.get('prompt_tokens') or totals.get('completion_tokens'):
+                line += f", {totals.get('prompt_tokens', 0)} prompt / {totals.get('completion_tokens', 0)} completion tokens"
+                if totals.get('cached_tokens'):
+                    line += f" ({totals['cached_tokens']} cached)"
+            if totals.get('cache_hits'):
+                line += f", {totals['cache_hits']} cached responses"
+            if totals.get('cost_usd'):
+                line += f", ${totals['cost_usd']:.4f}"
+            lines.append(line)
+        lines.append(f"Estimated cost: ${data['cost_usd']:.4f}")
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """Process-wide stage totals across all runs, rendered in the Prometheus text format."""
+
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.stages = {}
+        self.runs = 0
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, calls=1, **counters):
+        with self._lock:
+            totals = self.stages.setdefault(stage, _empty_stage())
+            totals['calls'] += calls
+            totals['seconds'] += seconds
+            for name, value in counters.items():
+                totals[name] += value or 0
+
+    def count_run(self):
+        with self._lock:
+            self.runs += 1
+
+    def prometheus_text(self):
+        with self._lock:
+            stages = {stage: dict(totals) for stage, totals in self.stages.items()}
+            runs = self.runs
+        lines = [f"# HELP {self.prefix}_runs_total Analysis runs completed",
+                 f"# TYPE {self.prefix}_runs_total counter",
+                 f"{self.prefix}_runs_total {runs}",
+                 f"# HELP {self.prefix}_stage_seconds Time spent in each pipeline stage",
+                 f"# TYPE {self.prefix}_stage_seconds summary"]
+        for stage, totals in stages.items():
+            lines.append(f'{self.prefix}_stage_seconds_sum{{stage="{stage}"}} {totals["seconds"]:.6f}')
+            lines.append(f'{self.prefix}_stage_seconds_count{{stage="{stage}"}} {totals["calls"]}')
+        for name, help_text in COUNTERS.items():
+            metric = f"{self.prefix}_stage_{name}_total"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{stage}"}} {totals[name]:g}' for stage, totals in stages.items() if totals[name]]
+        return "\n".join(lines) + "\n"
+
+
+def record(stage, seconds=0.0, calls=1, **counters):
+    """Report a stage to the process-wide registry and to the active run, if any."""
+    registry.observe(stage, seconds, calls, **counters)
+    run = current_run.get()
+    if run is not None:
+        run.record(stage, seconds, calls, **counters)
+
+
+@contextmanager
+def timed(stage, calls=1, **counters):
+    """Time the block as stage; the yielded dict collects counters known only inside it."""
+    counters = dict(counters)
+    start_time = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        record(stage, time.perf_counter() - start_time, calls, **counters)
+
+
+def with_current_run(fn):
+    """fn wrapped to run in a copy of the caller's context, so worker threads report to the same run."""
+    context = copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+def purge_expired_metrics(directory=METRICS_DIR, retention=METRICS_RETENTION):
+    """Delete saved run metrics older than retention seconds; returns how many were removed."""
+    if not os.path.isdir(directory):
+        return 0
+    expired_before = time.time() - retention
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.endswith('.json') and os.stat(path).st_mtime < expired_before:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """Serve registry.prometheus_text() at http://host:port/metrics from a daemon thread.
+
+    Only local clients can connect by default; pass host='0.0.0.0' for a scraper on another machine.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = registry.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,187 @@
+import os
+import pickle
+from typing import Dict, List
+import faiss
+import numpy as np
+from langchain.schema import Document
+
+INDEX_FILE = "index.faiss"
+DOCUMENTS_FILE = "documents.pkl"
+HASH_FILE = "source_hash.txt"
+# Results fetched by the shared search before falling back to a per-source filtered search
+OVERFETCH_FACTOR = 4
+# Context selection: relevance/diversity trade-off and the cosine similarity treated as duplicate
+MMR_LAMBDA = 0.7
+DUPLICATE_THRESHOLD = 0.95
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def format_document(document):
+    return f"[{document.metadata.get('source', 'knowledge')}] {document.page_content}"
+
+
+def format_context(documents):
+    return "\n\n".join(format_document(document) for document in documents)
+
+
+class KnowledgeIndex:
+    """All knowledge sources in one FAISS index, with a 'source' metadata field per document.
+
+    Documents of each source occupy a contiguous id range, so a single batched search over all
+    query vectors can be split into per-source top-k results afterwards. A source that does not
+    fill its quota from the shared results is searched again restricted to its id range, which
+    keeps the results identical to searching each source's own index.
+    """
+
+    def __init__(self, index, documents, sources, bounds, embedding_model):
+        self.index = index
+        self.documents = documents
+        self.sources = sources
+        self.bounds = np.asarray(bounds, dtype=np.int64)
+        self.embedding_model = embedding_model
+
+    @classmethod
+    def from_stores(cls, stores, embedding_model):
+        """Merge LangChain FAISS stores ({source: store}) without re-embedding their documents."""
+        vectors, documents, sources, bounds = [], [], [], [0]
+        for source, store in stores.items():
+            vectors.append(store.index.reconstruct_n(0, store.index.ntotal))
+            for i in range(store.index.ntotal):
+                document = store.docstore.search(store.index_to_docstore_id[i])
+                metadata = dict(document.metadata)
+                if 'source' in metadata:
+                    metadata['file'] = metadata.pop('source')
+                metadata['source'] = source
+                documents.append(Document(page_content=document.page_content, metadata=metadata))
+            sources.append(source)
+            bounds.append(len(documents))
+
+        matrix = np.vstack(vectors).astype(np.float32)
+        index = faiss.IndexFlatL2(matrix.shape[1])
+        index.add(matrix)
+        return cls(index, documents, sources, bounds, embedding_model)
+
+    def save(self, path, source_hash):
+        os.makedirs(path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(path, INDEX_FILE))
+        with open(os.path.join(path, DOCUMENTS_FILE), 'wb') as file:
+            pickle.dump({'documents': self.documents, 'sources': self.sources, 'bounds': self.bounds.tolist()}, file)
+        with open(os.path.join(path, HASH_FILE), 'w', encoding='utf-8') as file:
+            file.write(source_hash)
+
+    @staticmethod
+    def saved_hash(path):
+        try:
+            with open(os.path.join(path, HASH_FILE), 'r', encoding='utf-8') as file:
+                return file.read().strip()
+        except OSError:
+            return None
+
+    @classmethod
+    def load(cls, path, embedding_model, mmap=True):
+        # Memory-mapping leaves the vectors in the page cache, shared by every worker process
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        index = faiss.read_index(os.path.join(path, INDEX_FILE), flags)
+        with open(os.path.join(path, DOCUMENTS_FILE), 'rb') as file:
+            data = pickle.load(file)
+        return cls(index, data['documents'], data['sources'], data['bounds'], embedding_model)
+
+    def search(self, queries: List[str], quotas: Dict[str, int]) -> List[List[Document]]:
+        """Top quotas[source] documents per source for every query, embedded in one batch call."""
+        if not queries:
+            return []
+        vectors = self.embed(queries)
+        return [[self.documents[i] for i in ids] for ids in self.search_ids(vectors, quotas)]
+
+    def embed(self, queries):
+        return np.asarray(self.embedding_model.embed_documents(queries), dtype=np.float32)
+
+    def search_ids(self, vectors, quotas):
+        k = min(self.index.ntotal, OVERFETCH_FACTOR * sum(quotas.values()))
+        _, ids = self.index.search(vectors, k)
+        id_sources = np.searchsorted(self.bounds, ids, side='right') - 1
+
+        results = []
+        for row, (query_ids, query_sources) in enumerate(zip(ids, id_sources)):
+            hits = []
+            for source_index, source in enumerate(self.sources):
+                quota = quotas.get(source, 0)
+                if not quota:
+                    continue
+                source_hits = query_ids[(query_sources == source_index) & (query_ids >= 0)][:quota]
+                if len(source_hits) < quota:
+                    source_hits = self._search_source(vectors[row:row + 1], source_index, quota)
+                hits.extend(int(i) for i in source_hits)
+            results.append(hits)
+        return results
+
+    def select_context(self, queries, quotas, token_budget, count_tokens, lambda_mult=MMR_LAMBDA,
+                       duplicate_threshold=DUPLICATE_THRESHOLD, vectors=None, document_filter=None):
+        """Deduplicated, MMR-ranked documents for all queries that fit within token_budget.
+
+        Hits of every query are pooled; repeated ids, identical texts and near-duplicates (cosine
+        similarity above duplicate_threshold) are dropped. The rest are ordered by maximal
+        marginal relevance and packed greedily, skipping documents that would overflow the budget.
+        Pass vectors to reuse query embeddings, and document_filter to keep only matching documents.
+        """
+        if not queries:
+            return []
+        if vectors is None:
+            vectors = self.embed(queries)
+        ids = self.select_ids(vectors, quotas, token_budget, count_tokens, lambda_mult, duplicate_threshold,
+                              document_filter)
+        return [self.documents[i] for i in ids]
+
+    def select_ids(self, vectors, quotas, token_budget, count_tokens, lambda_mult=MMR_LAMBDA,
+                   duplicate_threshold=DUPLICATE_THRESHOLD, document_filter=None):
+        """Document ids chosen by select_context for already embedded queries, in context order."""
+        if len(vectors) == 0:
+            return []
+        candidate_ids = list(dict.fromkeys(i for ids in self.search_ids(vectors, quotas) for i in ids))
+        if document_filter is not None:
+            candidate_ids = [i for i in candidate_ids if document_filter(self.documents[i])]
+        if not candidate_ids:
+            return []
+        query_vectors = _normalize(vectors)
+        doc_vectors = _normalize(np.vstack([self.index.reconstruct(i) for i in candidate_ids]))
+
+        relevance = (doc_vectors @ query_vectors.T).max(axis=1)
+        similarity = doc_vectors @ doc_vectors.T
+
+        # Exact and near-duplicate removal, keeping the more relevant copy
+        kept, seen_texts = [], set()
+        for position in np.argsort(-relevance):
+            text = self.documents[candidate_ids[position]].page_content
+            if text in seen_texts or any(similarity[position, other] > duplicate_threshold for other in kept):
+                continue
+            seen_texts.add(text)
+            kept.append(position)
+
+        # Maximal marginal relevance ordering
+        ordered, remaining = [], list(kept)
+        while remaining:
+            if ordered:
+                redundancy = similarity[np.ix_(remaining, ordered)].max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining))
+            scores = lambda_mult * relevance[remaining] - (1 - lambda_mult) * redundancy
+            ordered.append(remaining.pop(int(np.argmax(scores))))
+
+        selected, used_tokens = [], 0
+        for position in ordered:
+            document = self.documents[candidate_ids[position]]
+            tokens = count_tokens(format_document(document))
+            if used_tokens + tokens <= token_budget:
+                selected.append(candidate_ids[position])
+                used_tokens += tokens
+        return selected
+
+    def _search_source(self, vector, source_index, k):
+        lo, hi = int(self.bounds[source_index]), int(self.bounds[source_index + 1])
+        params = faiss.SearchParameters(sel=faiss.IDSelectorRange(lo, hi))
+        _, ids = self.index.search(vector, min(k, hi - lo), params=params)
+        return [i for i in ids[0] if i >= 0]
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration
+
+LLM_CACHE_DIR = os.path.join('.cache', 'llm')
+LLM_CACHE_MAX_BYTES = 256 * 2**20
+LLM_CACHE_TTL = 30 * 24 * 3600
+# Set LLM_CACHE=0 to send every request to the model
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE', '1') != '0'
+
+
+class LLMResponseCache(BaseCache):
+    """Disk cache of chat model responses, plugged into LangChain's model cache hook.
+
+    Keys hash the llm_string LangChain builds from the model name and sampling parameters
+    together with the serialized prompt messages. Entries older than ttl seconds are ignored,
+    and the least recently used ones are evicted once the cache grows past max_bytes.
+    The time a response took to generate is stored with it, so hits report the latency saved.
+    """
+
+    def __init__(self, cache_dir=LLM_CACHE_DIR, max_bytes=LLM_CACHE_MAX_BYTES, ttl=LLM_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self._pending = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def key_for(self, prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    @contextmanager
+    def bypass(self):
+        """Skip the cache (both lookups and writes) for calls made by this thread inside the block."""
+        self._local.bypass = True
+        try:
+            yield
+        finally:
+            self._local.bypass = False
+
+    def _bypassed(self):
+        return getattr(self._local, 'bypass', False)
+
+    def lookup(self, prompt, llm_string):
+        if self._bypassed():
+            return None
+        key = self.key_for(prompt, llm_string)
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    entry = json.load(file)
+                if time.time() - entry['created'] > self.ttl:
+                    os.remove(path)
+                    raise ValueError("expired")
+                os.utime(path)  # mark as recently used
+                self.hits += 1
+                self.latency_saved += entry.get('latency', 0.0)
+                generations = [loads(generation) for generation in entry['generations']]
+                for generation in generations:
+                    generation.message.response_metadata['llm_cache_hit'] = True
+                return generations
+            except (OSError, ValueError, KeyError):
+                self.misses += 1
+                self._pending[key] = time.monotonic()
+                return None
+
+    def update(self, prompt, llm_string, return_val):
+        if self._bypassed():
+            return
+        key = self.key_for(prompt, llm_string)
+        with self._lock:
+            started = self._pending.pop(key, None)
+        entry = {
+            'generations': [dumps(generation) for generation in return_val],
+            'latency': time.monotonic() - started if started is not None else 0.0,
+            'created': time.time(),
+        }
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def forget(self, prompt, llm_string):
+        """Drop the pending miss of a call that failed, as update() is never called for it."""
+        with self._lock:
+            self._pending.pop(self.key_for(prompt, llm_string), None)
+
+    def clear(self, **kwargs):
+        with self._lock:
+            for _, _, name in self._entries():
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total_bytes = sum(size for _, size, _ in entries)
+            expired_before = time.time() - self.ttl
+            for mtime, size, name in entries:
+                # mtime is the last use, so anything untouched for ttl is necessarily expired
+                if total_bytes <= self.max_bytes and mtime >= expired_before:
+                    break
+                os.remove(os.path.join(self.cache_dir, name))
+                total_bytes -= size
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'latency_saved_s': round(self.latency_saved, 3),
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+
+def stream_with_cache(llm, prompt, **kwargs):
+    """llm.stream(prompt, **kwargs) that also reads and fills the model's LLMResponseCache.
+
+    LangChain only consults the cache on invoke; a hit here is replayed as a single chunk and a
+    miss is cached once the stream completes. Call parameters such as response_format are part
+    of the key, as they are on invoke.
+    """
+    cache = llm.cache if isinstance(llm.cache, LLMResponseCache) else None
+    if cache is None:
+        yield from llm.stream(prompt, **kwargs)
+        return
+
+    messages = llm._convert_input(prompt).to_messages()
+    prompt_key, llm_string = dumps(messages), llm._get_llm_string(**kwargs)
+    cached = cache.lookup(prompt_key, llm_string)
+    if cached:
+        yield AIMessageChunk(content=cached[0].message.content, response_metadata={'llm_cache_hit': True})
+        return
+
+    content = ""
+    try:
+        for chunk in llm.stream(prompt, **kwargs):
+            content += chunk.content
+            yield chunk
+        cache.update(prompt_key, llm_string, [ChatGeneration(message=AIMessage(content=content))])
+    finally:
+        cache.forget(prompt_key, llm_string)  # a no-op once update() has run
+
+
+llm_response_cache = LLMResponseCache()
@@ -1,17 +1,149 @@
+import os
+import threading
+from functools import lru_cache
 from langchain_openai import ChatOpenAI
-from tiktoken import encoding_for_model
+from llm_cache import llm_response_cache, LLM_CACHE_ENABLED
+from llm_scheduler import INTERACTIVE, LLMScheduler, ScheduledChatModel
+from tiktoken import encoding_for_model, get_encoding
 
 model = "gpt-4o-mini"
 
-def load_model(openai_api_key):
-    return ChatOpenAI(
+# Completion tokens requested from the model; reserved when budgeting the prompt
+MAX_OUTPUT_TOKENS = 4096
+
+# Context window (prompt + completion tokens) per model
+CONTEXT_WINDOWS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_WINDOW = 16385
+
+# USD per million tokens: (input, cached input, output)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4-turbo": (10.00, 10.00, 30.00),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+}
+
+# Account rate limits for the model; override with LLM_RPM / LLM_TPM to match your usage tier
+LLM_RPM = int(os.environ.get('LLM_RPM', 500))
+LLM_TPM = int(os.environ.get('LLM_TPM', 200000))
+
+def load_model(openai_api_key, use_cache=LLM_CACHE_ENABLED, priority=INTERACTIVE, base_url=None):
+    # Retries are left to the shared scheduler, which also spaces calls out under the rate limits
+    chat_model = ChatOpenAI(
         model_name=model,
         openai_api_key=openai_api_key,
+        base_url=base_url,
         temperature=0.01,
-        max_tokens=4096,
-        top_p=0.9
+        max_tokens=MAX_OUTPUT_TOKENS,
+        top_p=0.9,
+        stream_usage=True,
+        max_retries=0,
+        cache=False
+    )
+    # Identical prompts with identical sampling parameters are answered from the disk cache
+    return ScheduledChatModel(
+        model=chat_model,
+        scheduler=llm_scheduler,
+        priority=priority,
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        cache=llm_response_cache if use_cache else False
     )
 
+@lru_cache(maxsize=None)
+def get_encoder(model=model):
+    # Building an encoder parses its whole BPE table, so do it once per model
+    try:
+        return encoding_for_model(model)
+    except KeyError:
+        return get_encoding("o200k_base")
+
 def count_tokens(text, model=model):
-    encoder = encoding_for_model(model)
-    return len(encoder.encode(text))
\ No newline at end of file
+    return len(get_encoder(model).encode(text, disallowed_special=()))
+
+def truncate_tokens(text, max_tokens, model=model):
+    encoder = get_encoder(model)
+    tokens = encoder.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoder.decode(tokens[:max_tokens])
+
+def context_window(model=model):
+    return CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+# Shared by every model load_model returns, so UI and batch calls draw on one budget
+llm_scheduler = LLMScheduler(LLM_RPM, LLM_TPM, count_tokens=count_tokens)
+
+
+def token_usage(message):
+    """(input_tokens, cached_tokens, output_tokens) the provider reported for a response, or None.
+
+    Reads the usage OpenAI returns with each response (prompt_tokens_details.cached_tokens, or
+    the input_token_details LangChain fills in on newer versions). Responses replayed from the
+    local response cache carry the usage of their original call and give None.
+    """
+    if message.response_metadata.get('llm_cache_hit'):
+        return None
+    reported = message.response_metadata.get('token_usage') or {}
+    usage_metadata = getattr(message, 'usage_metadata', None) or {}
+    input_tokens = reported.get('prompt_tokens', usage_metadata.get('input_tokens'))
+    if input_tokens is None:
+        return None
+    cached_tokens = (reported.get('prompt_tokens_details') or {}).get('cached_tokens')
+    if cached_tokens is None:
+        cached_tokens = (usage_metadata.get('input_token_details') or {}).get('cache_read', 0)
+    output_tokens = reported.get('completion_tokens', usage_metadata.get('output_tokens', 0))
+    return input_tokens, cached_tokens or 0, output_tokens or 0
+
+def usage_cost(input_tokens, cached_tokens, output_tokens, model=model):
+    input_price, cached_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0, 0.0))
+    return ((input_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + output_tokens * output_price) / 1e6
+
+def usage_counters(message):
+    """Instrumentation counters (tokens and estimated cost) for one model response."""
+    usage = token_usage(message)
+    if usage is None:
+        return {'cache_hits': 1} if message.response_metadata.get('llm_cache_hit') else {}
+    input_tokens, cached_tokens, output_tokens = usage
+    return {'prompt_tokens': input_tokens, 'cached_tokens': cached_tokens, 'completion_tokens': output_tokens,
+            'cost_usd': usage_cost(input_tokens, cached_tokens, output_tokens)}
+
+
+class PromptCacheUsage:
+    """Input tokens reported by the provider, split into prompt-cache hits and the rest.
+
+    record() reads the usage with token_usage(), so responses replayed from the local response
+    cache are skipped.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, message):
+        usage = token_usage(message)
+        if usage is None:
+            return
+        input_tokens, cached_tokens, _ = usage
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += input_tokens
+            self.cached_tokens += cached_tokens
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'input_tokens': self.input_tokens,
+            'cached_tokens': self.cached_tokens,
+            'uncached_tokens': self.input_tokens - self.cached_tokens,
+            'cached_share': self.cached_tokens / self.input_tokens if self.input_tokens else 0.0,
+        }
+
+
+prompt_cache_usage = PromptCacheUsage()
@@ -0,0 +1,249 @@
+import copy
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.load import dumps
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from llm_cache import LLMResponseCache
+
+# Lower values are served first
+INTERACTIVE = 0
+BATCH = 1
+
+LLM_MAX_RETRIES = 6
+LLM_RETRY_BASE_DELAY = 1.0
+LLM_RETRY_MAX_DELAY = 60.0
+TRANSIENT_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                    openai.InternalServerError)
+
+
+class TokenBucket:
+    """Refills per_minute units per minute, holding at most burst_seconds worth of them."""
+
+    def __init__(self, per_minute, burst_seconds=60.0):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # A request larger than the whole bucket waits for a full bucket rather than forever
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+def retry_after(error):
+    """Seconds the provider asked us to wait in a 429 response, or None."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        if 'retry-after-ms' in response.headers:
+            return float(response.headers['retry-after-ms']) / 1000
+        if 'retry-after' in response.headers:
+            return float(response.headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class LLMScheduler:
+    """Admits model calls under requests-per-minute and tokens-per-minute budgets.
+
+    Callers wait in one queue ordered by priority (INTERACTIVE before BATCH), then arrival, and
+    the head of the queue goes as soon as both token buckets can pay for it. A call is charged
+    its prompt tokens plus its max output tokens, as OpenAI's limiter does. Rate-limit and
+    transient API errors are retried with full-jitter exponential backoff (or the provider's
+    retry-after), and a 429 also pauses every other caller for that long. Calls sharing a key
+    while one of them is in flight are coalesced into that one call.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, count_tokens=None, burst_seconds=60.0,
+                 max_retries=LLM_MAX_RETRIES, base_delay=LLM_RETRY_BASE_DELAY, max_delay=LLM_RETRY_MAX_DELAY,
+                 seed=None):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds)
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds)
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = random.Random(seed)
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._paused_until = 0.0
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # calls: requests sent, retries included; errors: sent requests that raised; failed: calls
+        # given up on, after their last retry or on an error that is not retried
+        self.counts = {'calls': 0, 'errors': 0, 'retries': 0, 'rate_limited': 0, 'coalesced': 0, 'failed': 0}
+        self.waited = {INTERACTIVE: 0.0, BATCH: 0.0}
+
+    def estimate_tokens(self, messages, max_output_tokens=0):
+        return sum(self.count_tokens(message.content if isinstance(message.content, str) else str(message.content))
+                   for message in messages) + (max_output_tokens or 0)
+
+    def acquire(self, tokens, priority=INTERACTIVE):
+        """Block until this call may be sent."""
+        ticket = (priority, next(self._sequence))
+        queued = time.monotonic()
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    timeout = None  # not at the head: woken when the head leaves
+                    if self._waiting[0] == ticket:
+                        now = time.monotonic()
+                        self.requests.refill(now)
+                        self.tokens.refill(now)
+                        timeout = max(self._paused_until - now, self.requests.wait_time(1),
+                                      self.tokens.wait_time(tokens))
+                        if timeout <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(tokens)
+                            self.counts['calls'] += 1
+                            break
+                    self._condition.wait(timeout)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                self.waited[priority] = self.waited.get(priority, 0.0) + time.monotonic() - queued
+
+    def _backoff(self, error, attempt):
+        """Delay before retry number attempt, or raise error if it should not be retried."""
+        with self._condition:
+            self.counts['errors'] += 1
+        if not isinstance(error, TRANSIENT_ERRORS) or attempt > self.max_retries:
+            self.counts['failed'] += 1
+            raise error
+        if getattr(error, 'code', None) == 'insufficient_quota':
+            self.counts['failed'] += 1
+            raise error  # a 429 that no amount of waiting fixes
+        delay = retry_after(error) if isinstance(error, openai.RateLimitError) else None
+        if delay is None:
+            delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        with self._condition:
+            self.counts['retries'] += 1
+            if isinstance(error, openai.RateLimitError):
+                self.counts['rate_limited'] += 1
+                # The limit is shared by every caller, so everyone backs off
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._condition.notify_all()
+        return delay
+
+    def _call(self, fn, tokens, priority):
+        for attempt in itertools.count(1):
+            self.acquire(tokens, priority)
+            try:
+                return fn()
+            except Exception as e:
+                time.sleep(self._backoff(e, attempt))
+
+    def call(self, fn, tokens, priority=INTERACTIVE, key=None):
+        """fn() within the budgets, retried on transient errors; concurrent calls with the same key share one result."""
+        if key is None:
+            return self._call(fn, tokens, priority)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.counts['coalesced'] += 1
+        if not leader:
+            return copy.deepcopy(future.result())
+        try:
+            result = self._call(fn, tokens, priority)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def stream(self, start, tokens, priority=INTERACTIVE):
+        """Iterate start() within the budgets; retried while nothing has been yielded yet."""
+        for attempt in itertools.count(1):
+            self.acquire(tokens, priority)
+            started = False
+            try:
+                for item in start():
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                if started:
+                    with self._condition:
+                        self.counts['errors'] += 1
+                        self.counts['failed'] += 1
+                    raise  # the caller has already consumed part of this response
+                time.sleep(self._backoff(e, attempt))
+
+    def stats(self):
+        return {**self.counts, 'waited_s': {('interactive' if priority == INTERACTIVE else 'batch'): round(seconds, 3)
+                                            for priority, seconds in self.waited.items()}}
+
+
+class ScheduledChatModel(BaseChatModel):
+    """Chat model that sends every call of the wrapped model through an LLMScheduler.
+
+    It reports the wrapped model's llm_string, so response cache entries are shared with it,
+    and cache hits never reach the scheduler. with_priority() returns a copy sharing the
+    same scheduler, e.g. for batch jobs that should yield to interactive requests.
+    """
+
+    model: BaseChatModel
+    scheduler: Any
+    priority: int = INTERACTIVE
+    max_output_tokens: int = 0
+
+    @property
+    def _llm_type(self):
+        return f"scheduled-{self.model._llm_type}"
+
+    @property
+    def _identifying_params(self):
+        return self.model._identifying_params
+
+    def _get_llm_string(self, stop=None, **kwargs):
+        return self.model._get_llm_string(stop=stop, **kwargs)
+
+    def with_priority(self, priority):
+        return self.copy(update={'priority': priority})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self.scheduler.estimate_tokens(messages, self.max_output_tokens)
+        prompt, llm_string = dumps(messages), self._get_llm_string(stop=stop, **kwargs)
+        key = hashlib.sha256(f"{llm_string}\n{prompt}".encode()).hexdigest()
+
+        try:
+            result = self.scheduler.call(lambda: self.model.generate([messages], stop=stop, **kwargs),
+                                         tokens, self.priority, key)
+        except BaseException:
+            # LangChain fills the cache only after a success, so the miss it looked up ends here
+            if isinstance(self.cache, LLMResponseCache):
+                self.cache.forget(prompt, llm_string)
+            raise
+        return ChatResult(generations=result.generations[0], llm_output=result.llm_output)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self.scheduler.estimate_tokens(messages, self.max_output_tokens)
+        for chunk in self.scheduler.stream(lambda: self.model.stream(messages, stop=stop, **kwargs),
+                                           tokens, self.priority):
+            yield ChatGenerationChunk(message=chunk)
@@ -1,105 +1,442 @@
 from typing import List, Optional
-from pydantic import BaseModel, Field
+from pydantic import AliasChoices, BaseModel, ConfigDict, Field, ValidationError, field_validator
 import json
+import re
 
-class AttachmentStyle(BaseModel):
-    secured: float = 0.0
-    anxious_preoccupied: float = 0.0
-    dismissive_avoidant: float = 0.0
-    fearful_avoidant: float = 0.0
-    avoidance: int = 0
-    self_model: int = 0
-    anxiety: int = 0
-    others_model: int = 0
-    explanation: str = "No explanation provided"
-
-class BigFiveTraits(BaseModel):
-    extraversion: int = 0
-    agreeableness: int = 0
-    conscientiousness: int = 0
-    neuroticism: int = 0
-    openness: int = 0
-    explanation: str = "No explanation provided"
-
-class PersonalityDisorder(BaseModel):
-    depressed: int = 0
-    paranoid: int = 0
-    schizoid_schizotypal: int = 0
-    antisocial_psychopathic: int = 0
-    borderline_dysregulated: int = 0
-    narcissistic: int = 0
-    anxious_avoidant: int = 0
-    dependent_victimized: int = 0
-    obsessional: int = 0
-    explanation: str = "No explanation provided"
-
-class SpeakerAnalysis(BaseModel):
-    speaker: str = "Unknown Speaker"
-    general_impression: str = "No general impression provided"
-    attachment_style: AttachmentStyle = AttachmentStyle()
-    big_five_traits: BigFiveTraits = BigFiveTraits()
-    personality_disorder: PersonalityDisorder = PersonalityDisorder()
+NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+
+class AnalysisModel(BaseModel):
+    """Base of the analysis models. Fields are read by the display keys the prompt asks for
+    (their aliases) or by field name, and loosely typed answers are coerced while validating:
+    null, "" and "N/A" give the default, numbers in strings ("7/10") are read, floats are
+    rounded for integer scores and a dict or list given for a text field is written out as lines."""
+
+    model_config = ConfigDict(populate_by_name=True)
+
+    @field_validator('*', mode='before')
+    @classmethod
+    def coerce(cls, value, info):
+        field = cls.model_fields[info.field_name]
+        if value is None or (isinstance(value, str) and value.strip() in ("", "N/A")):
+            return field.default
+        if field.annotation is str:
+            if isinstance(value, dict):
+                return "\n".join(f"{key}: {item}" for key, item in value.items())
+            if isinstance(value, list):
+                return "\n".join(map(str, value))
+            return value if isinstance(value, str) else str(value)
+        if field.annotation in (int, float):
+            if isinstance(value, str):
+                match = NUMBER.search(value)
+                if not match:
+                    raise ValueError(f"no number in {value!r}")
+                value = float(match.group())
+            if field.annotation is int and isinstance(value, float):
+                return round(value)
+        return value
+
+class AttachmentStyle(AnalysisModel):
+    secured: float = Field(0.0, alias="Secured")
+    anxious_preoccupied: float = Field(0.0, alias="Anxious-Preoccupied")
+    dismissive_avoidant: float = Field(0.0, alias="Dismissive-Avoidant")
+    # Earlier prompts and outputs spell it without the hyphen
+    fearful_avoidant: float = Field(0.0, alias="Fearful-Avoidant",
+                                    validation_alias=AliasChoices("Fearful-Avoidant", "FearfulAvoidant",
+                                                                  "fearful_avoidant"))
+    avoidance: int = Field(0, alias="Avoidance")
+    self_model: int = Field(0, alias="Self")
+    anxiety: int = Field(0, alias="Anxiety")
+    others_model: int = Field(0, alias="Others")
+    explanation: str = Field("No explanation provided", alias="Explanation")
+
+class BigFiveTraits(AnalysisModel):
+    extraversion: int = Field(0, alias="Extraversion")
+    agreeableness: int = Field(0, alias="Agreeableness")
+    conscientiousness: int = Field(0, alias="Conscientiousness")
+    neuroticism: int = Field(0, alias="Neuroticism")
+    openness: int = Field(0, alias="Openness")
+    explanation: str = Field("No explanation provided", alias="Explanation")
+
+class PersonalityDisorder(AnalysisModel):
+    depressed: int = Field(0, alias="Depressed")
+    paranoid: int = Field(0, alias="Paranoid")
+    schizoid_schizotypal: int = Field(0, alias="Schizoid-Schizotypal")
+    antisocial_psychopathic: int = Field(0, alias="Antisocial-Psychopathic")
+    borderline_dysregulated: int = Field(0, alias="Borderline-Dysregulated")
+    narcissistic: int = Field(0, alias="Narcissistic")
+    anxious_avoidant: int = Field(0, alias="Anxious-Avoidant")
+    dependent_victimized: int = Field(0, alias="Dependent-Victimized")
+    obsessional: int = Field(0, alias="Obsessional")
+    explanation: str = Field("No explanation provided", alias="Explanation")
+
+class SpeakerAnalysis(AnalysisModel):
+    speaker: str = Field("Unknown Speaker", alias="Speaker")
+    general_impression: str = Field("No general impression provided", alias="General Impression")
+    attachment_style: AttachmentStyle = Field(AttachmentStyle(), alias="Attachment Styles")
+    big_five_traits: BigFiveTraits = Field(BigFiveTraits(), alias="Big Five Traits")
+    personality_disorder: PersonalityDisorder = Field(PersonalityDisorder(), alias="Personality Disorders")
+
+# Sections of a speaker analysis, by the keys the prompts ask for
+SECTIONS = ("General Impression", "Attachment Styles", "Big Five Traits", "Personality Disorders")
+SECTION_FIELDS = {field.alias: name for name, field in SpeakerAnalysis.model_fields.items()}
+
+JSON_TYPES = {str: "string", int: "integer", float: "number"}
+
+def _field_schema(annotation):
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        properties = {field.alias: _field_schema(field.annotation) for field in annotation.model_fields.values()}
+        return {"type": "object", "properties": properties, "required": list(properties),
+                "additionalProperties": False}
+    return {"type": JSON_TYPES[annotation]}
+
+def analysis_schema(sections=SECTIONS):
+    """JSON schema of a {"speaker_analyses": [...]} answer holding the given sections, derived from
+    SpeakerAnalysis. Every key is required and no others are allowed, as OpenAI's strict mode needs."""
+    fields = SpeakerAnalysis.model_fields
+    properties = {"Speaker": _field_schema(str)}
+    properties.update((section, _field_schema(fields[SECTION_FIELDS[section]].annotation)) for section in sections)
+    speaker = {"type": "object", "properties": properties, "required": list(properties),
+               "additionalProperties": False}
+    return {"type": "object", "properties": {"speaker_analyses": {"type": "array", "items": speaker}},
+            "required": ["speaker_analyses"], "additionalProperties": False}
+
+def response_format(sections=SECTIONS):
+    """OpenAI response_format asking for structured output that matches analysis_schema(sections)."""
+    return {"type": "json_schema",
+            "json_schema": {"name": "speaker_analyses", "strict": True, "schema": analysis_schema(sections)}}
+
+def _field_keys(name, field):
+    # Every key a field is accepted under
+    alias = field.validation_alias
+    return set(alias.choices if isinstance(alias, AliasChoices) else [field.alias]) | {name}
+
+SECTION_KEYS = {
+    section: [_field_keys(name, field) for name, field in
+              SpeakerAnalysis.model_fields[SECTION_FIELDS[section]].annotation.model_fields.items()]
+    for section in SECTIONS if section != "General Impression"
+}
+
+# A closing fence starts its own line; JSON strings cannot hold a raw newline, so ``` inside one never matches
+FENCED_BLOCK = re.compile(r"```(?:json)?\s*(.*?)(?:\n\s*```|$)", re.S)
+# A string (group 1 is its closing quote, empty if the text ends inside it), a bracket or comma,
+# or a run of anything else (numbers, literals, whitespace, colons)
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*("?)|[{}\[\],]|[^"{}\[\],]+', re.S)
+
+def repair_json(text):
+    """Parse a model's JSON object, fixing what models commonly get wrong: markdown fences, prose
+    around the object, trailing commas and truncation (open strings and containers are closed, or
+    the text is cut back to the last complete value).
+
+    Returns (data, defects, open_depth): defects lists what was repaired, and open_depth is how many
+    containers were still open where the recovered text ends (0 if it was complete). Raises
+    ValueError if no object can be recovered.
+    """
+    # The object itself is usually fine, and only wrapped in a fence or prose. It is parsed before
+    # looking for fences, since a string value may contain ``` itself
+    start, end = text.find("{"), text.rfind("}") + 1
+    if 0 <= start < end:
+        try:
+            data = json.loads(text[start:end])
+        except json.JSONDecodeError:
+            pass
+        else:
+            if "```" in text[:start]:
+                return data, ["fence"], 0
+            defects = ["prose"] if text[:start].strip() else []
+            if text[end:].strip():
+                defects.append("trailing text")
+            return data, defects, 0
+
+    defects = []
+    fence = text.find("```")
+    if fence >= 0 and not 0 <= start < fence:
+        text = FENCED_BLOCK.search(text, fence).group(1)
+        defects.append("fence")
+    start = text.find("{")
+    if start < 0:
+        raise ValueError("No JSON object in the model output")
+    if text[:start].strip():
+        defects.append("prose")
+
+    out, stack, in_string = [], [], False
+    # (tokens in out, closers of the open containers) at each point where everything before is complete
+    boundaries = []
+    end = len(text)
+    for match in JSON_TOKEN.finditer(text, start):
+        token = match.group()
+        if token[0] == '"':
+            # Only the last string can lack its closing quote
+            in_string = not match.group(1)
+        elif token in "{[":
+            stack.append("}" if token == "{" else "]")
+            out.append(token)
+            boundaries.append((len(out), "".join(reversed(stack))))
+            continue
+        elif token in "}]":
+            while out and not out[-1].strip():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+                if "trailing comma" not in defects:
+                    defects.append("trailing comma")
+            if stack:
+                stack.pop()
+            out.append(token)
+            if not stack:
+                end = match.end()
+                break
+            continue
+        elif token == ",":
+            boundaries.append((len(out), "".join(reversed(stack))))
+        out.append(token)
+
+    if not stack:
+        if text[end:].strip():
+            defects.append("trailing text")
+        return json.loads("".join(out)), defects, 0
+
+    defects.append("truncated")
+    closers = "".join(reversed(stack))
+    head = "".join(out) + '"' if in_string else "".join(out).rstrip().rstrip(",")
+    candidates = [(head, closers)]
+    for length, boundary_closers in reversed(boundaries[-50:]):
+        candidates.append(("".join(out[:length]).rstrip().rstrip(","), boundary_closers))
+    for head, closers in candidates:
+        try:
+            return json.loads(head + closers), defects, len(closers)
+        except json.JSONDecodeError:
+            continue
+    raise ValueError("Truncated JSON could not be recovered")
 
 class OutputParser:
-    def parse(self, text: str) -> List[SpeakerAnalysis]:
+    def load_response(self, text: str) -> dict:
+        """The JSON object of a model response: plain json.loads when it is well formed, else repair_json."""
         try:
             data = json.loads(text)
-            if "speaker_analyses" in data and isinstance(data["speaker_analyses"], list):
-                return [self.parse_speaker_analysis(item) for item in data["speaker_analyses"]]
+        except json.JSONDecodeError:
+            data, defects, _ = repair_json(text)
+            print(f"Repaired model output: {', '.join(defects)}")
+        if not isinstance(data, dict):
+            raise ValueError("Model output is not a JSON object")
+        return data
+
+    def parse(self, text: str) -> List[SpeakerAnalysis]:
+        data = self.load_response(text)
+        if not isinstance(data.get("speaker_analyses"), list):
+            raise ValueError("Invalid JSON structure: missing or invalid 'speaker_analyses' key")
+        return [self.parse_speaker_analysis(item) for item in data["speaker_analyses"]]
+
+    def broken_sections(self, obj: dict, sections=SECTIONS) -> List[str]:
+        """The sections of one speaker analysis that are missing, lack keys or fail validation."""
+        present = []
+        for section in sections:
+            value = obj.get(section)
+            if section == "General Impression":
+                complete = isinstance(value, (str, dict)) and bool(value)
             else:
-                raise ValueError("Invalid JSON structure: missing or invalid 'speaker_analyses' key")
+                complete = isinstance(value, dict) and all(keys & value.keys() for keys in SECTION_KEYS[section])
+            if complete:
+                present.append(section)
+        # One validation pass for the whole speaker; sections are only checked one by one if it fails
+        try:
+            SpeakerAnalysis.model_validate({section: obj[section] for section in present})
+        except ValidationError:
+            present = [section for section in present if self._valid_section(section, obj[section])]
+        return [section for section in sections if section not in present]
+
+    def _valid_section(self, section, value):
+        try:
+            SpeakerAnalysis.model_validate({section: value})
+            return True
+        except ValidationError:
+            return False
+
+    def check(self, text: str, sections=SECTIONS):
+        """Repair and check a response for the given sections.
+
+        Returns (speaker_analyses, broken, truncated): the speaker dicts that were received whole,
+        {index: [sections]} for those with missing or malformed sections, and whether the output
+        stopped before the end of the array. A speaker cut off by truncation is left out, since
+        its last section cannot be trusted. Raises ValueError if there is no usable JSON at all.
+        """
+        try:
+            data, open_depth = json.loads(text), 0
         except json.JSONDecodeError:
-            raise ValueError(f"Invalid JSON: {text}")
-        except Exception as e:
-            raise ValueError(f"Error parsing output: {str(e)}")
+            data, defects, open_depth = repair_json(text)
+            print(f"Repaired model output: {', '.join(defects)}")
+        speaker_analyses = data.get("speaker_analyses") if isinstance(data, dict) else None
+        if not isinstance(speaker_analyses, list):
+            raise ValueError("Invalid JSON structure: missing or invalid 'speaker_analyses' key")
+        # Depth 1 is the outer object, 2 the array and 3 a speaker analysis
+        if open_depth >= 3 and speaker_analyses:
+            speaker_analyses.pop()
+        speaker_analyses = [obj for obj in speaker_analyses if isinstance(obj, dict)]
+        broken = {}
+        for index, obj in enumerate(speaker_analyses):
+            missing = self.broken_sections(obj, sections)
+            if missing:
+                broken[index] = missing
+        return speaker_analyses, broken, open_depth >= 2
 
     def parse_speaker_analysis(self, obj: dict) -> SpeakerAnalysis:
-        attachment_styles = obj.get("Attachment Styles", {})
-        big_five_traits = obj.get("Big Five Traits", {})
-        personality_disorders = obj.get("Personality Disorders", {})
-    
-        # Handle general_impression as a string
-        general_impression = obj.get("General Impression", {})
-        if isinstance(general_impression, dict):
-            # Convert the dictionary to a formatted string
-            general_impression_str = "\n".join([f"{key}: {value}" for key, value in general_impression.items()])
-        else:
-            general_impression_str = str(general_impression)
-    
-        return SpeakerAnalysis(
-            speaker=str(obj.get("Speaker", "Unknown Speaker")),  # Convert to string
-            general_impression=general_impression_str,
-            attachment_style=AttachmentStyle(
-                secured=attachment_styles.get("Secured", 0.0),
-                anxious_preoccupied=attachment_styles.get("Anxious-Preoccupied", 0.0),
-                dismissive_avoidant=attachment_styles.get("Dismissive-Avoidant", 0.0),
-                fearful_avoidant=attachment_styles.get("FearfulAvoidant", 0.0),
-                avoidance=attachment_styles.get("Avoidance", 0),
-                self_model=attachment_styles.get("Self", 0),
-                anxiety=attachment_styles.get("Anxiety", 0),
-                others_model=attachment_styles.get("Others", 0),
-                explanation=attachment_styles.get("Explanation", "No explanation provided")
-            ),
-            big_five_traits=BigFiveTraits(
-                extraversion=big_five_traits.get("Extraversion", 0),
-                agreeableness=big_five_traits.get("Agreeableness", 0),
-                conscientiousness=big_five_traits.get("Conscientiousness", 0),
-                neuroticism=big_five_traits.get("Neuroticism", 0),
-                openness=big_five_traits.get("Openness", 0),
-                explanation=big_five_traits.get("Explanation", "No explanation provided")
-            ),
-            personality_disorder=PersonalityDisorder(
-                depressed=personality_disorders.get("Depressed", 0),
-                paranoid=personality_disorders.get("Paranoid", 0),
-                schizoid_schizotypal=personality_disorders.get("Schizoid-Schizotypal", 0),
-                antisocial_psychopathic=personality_disorders.get("Antisocial-Psychopathic", 0),
-                borderline_dysregulated=personality_disorders.get("Borderline-Dysregulated", 0),
-                narcissistic=personality_disorders.get("Narcissistic", 0),
-                anxious_avoidant=personality_disorders.get("Anxious-Avoidant", 0),
-                dependent_victimized=personality_disorders.get("Dependent-Victimized", 0),
-                obsessional=personality_disorders.get("Obsessional", 0),
-                explanation=personality_disorders.get("Explanation", "No explanation provided")
-            )
-        )
-
-output_parser = OutputParser()
\ No newline at end of file
+        """Validate one speaker analysis in a single pass; if that fails, every section that is
+        valid on its own is kept and the others fall back to their defaults."""
+        try:
+            return SpeakerAnalysis.model_validate(obj)
+        except ValidationError as e:
+            error = e
+        if not isinstance(obj, dict):
+            print(f"Invalid speaker analysis, using defaults: {error}")
+            return SpeakerAnalysis()
+        values = {}
+        for name, field in SpeakerAnalysis.model_fields.items():
+            try:
+                values[name] = getattr(SpeakerAnalysis.model_validate({field.alias: obj.get(field.alias)}), name)
+            except ValidationError:
+                print(f"Invalid {field.alias} section, using defaults")
+        return SpeakerAnalysis(**values)
+
+output_parser = OutputParser()
+
+class StreamingSpeakerParser:
+    """Incremental parser for a streamed {"speaker_analyses": [...]} response.
+
+    feed() takes the next chunk of model output and returns the events it completes:
+    ("section", index, key, value) whenever a top-level field of speaker_analyses[index] closes,
+    and ("speaker", index, obj) when the whole speaker object closes. Text before the array
+    (markdown fences, the opening brace) is skipped.
+    """
+
+    ARRAY_START = re.compile(r'"speaker_analyses"\s*:\s*\[')
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.in_array = False
+        self.finished = False
+        self.in_string = False
+        self.escape = False
+        self.depth = 0
+        self.element_start = None
+        self.index = 0
+        self.emitted_keys = set()
+
+    def feed(self, chunk: str):
+        self.buffer += chunk
+        events = []
+        if not self.in_array:
+            match = self.ARRAY_START.search(self.buffer)
+            if not match:
+                return events
+            self.in_array = True
+            self.position = match.end()
+
+        while self.position < len(self.buffer) and not self.finished:
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.element_start = self.position
+                    self.emitted_keys = set()
+            elif char in "}]":
+                if self.depth == 0:
+                    self.finished = True
+                    break
+                self.depth -= 1
+                if self.depth == 1:
+                    events.extend(self._section_events(self.position + 1))
+                elif self.depth == 0 and self.element_start is not None:
+                    events.extend(self._speaker_events(self.position + 1))
+            elif char == "," and self.depth == 1:
+                events.extend(self._section_events(self.position))
+            self.position += 1
+        return events
+
+    def _section_events(self, end):
+        # Everything up to end is a complete prefix of the speaker object; close it and parse
+        try:
+            partial = json.loads(self.buffer[self.element_start:end] + "}")
+        except json.JSONDecodeError:
+            return []
+        events = []
+        for key, value in partial.items():
+            if key not in self.emitted_keys:
+                self.emitted_keys.add(key)
+                events.append(("section", self.index, key, value))
+        return events
+
+    def _speaker_events(self, end):
+        try:
+            speaker = json.loads(self.buffer[self.element_start:end])
+        except json.JSONDecodeError:
+            # A trailing comma or similar slip should not cost the whole speaker
+            try:
+                speaker, _, _ = repair_json(self.buffer[self.element_start:end])
+            except ValueError:
+                speaker = None
+        events = []
+        if isinstance(speaker, dict):
+            for key, value in speaker.items():
+                if key not in self.emitted_keys:
+                    events.append(("section", self.index, key, value))
+            events.append(("speaker", self.index, speaker))
+        self.index += 1
+        self.element_start = None
+        return events
+
+# At most this many distinct partial explanations are kept when analyses are merged
+MAX_MERGED_TEXTS = 3
+
+def _merge_texts(weighted_texts, default):
+    texts = {}
+    for text, weight in weighted_texts:
+        if text and text != default:
+            texts[text] = texts.get(text, 0) + weight
+    ranked = sorted(texts, key=texts.get, reverse=True)[:MAX_MERGED_TEXTS]
+    return "\n\n".join(ranked) if ranked else default
+
+def _merge_section(weighted_sections):
+    section_type = type(weighted_sections[0][0])
+    total_weight = sum(weight for _, weight in weighted_sections) or 1
+    values = {}
+    for name, field in section_type.model_fields.items():
+        if name == "explanation":
+            values[name] = _merge_texts([(section.explanation, weight) for section, weight in weighted_sections],
+                                        field.default)
+            continue
+        average = sum(getattr(section, name) * weight for section, weight in weighted_sections) / total_weight
+        values[name] = round(average) if field.annotation is int else average
+    return section_type(**values)
+
+def merge_speaker_analyses(weighted_analyses) -> SpeakerAnalysis:
+    """Combine partial analyses of one speaker, e.g. from separate transcript windows.
+
+    weighted_analyses is a list of (SpeakerAnalysis, weight) pairs, the weight typically being how
+    much the speaker said in that window. Scores are weighted averages (integers rounded),
+    attachment probabilities are renormalised to sum to 1, and the most heavily weighted
+    distinct explanations and impressions are kept.
+    """
+    attachment_style = _merge_section([(a.attachment_style, w) for a, w in weighted_analyses])
+    probabilities = ["secured", "anxious_preoccupied", "dismissive_avoidant", "fearful_avoidant"]
+    total_probability = sum(getattr(attachment_style, name) for name in probabilities)
+    if total_probability > 0:
+        for name in probabilities:
+            setattr(attachment_style, name, getattr(attachment_style, name) / total_probability)
+
+    return SpeakerAnalysis(
+        speaker=weighted_analyses[0][0].speaker,
+        general_impression=_merge_texts([(a.general_impression, w) for a, w in weighted_analyses],
+                                        SpeakerAnalysis.model_fields["general_impression"].default),
+        attachment_style=attachment_style,
+        big_five_traits=_merge_section([(a.big_five_traits, w) for a, w in weighted_analyses]),
+        personality_disorder=_merge_section([(a.personality_disorder, w) for a, w in weighted_analyses])
+    )
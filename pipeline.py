@@ -0,0 +1,215 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import METRICS_DIR, METRICS_RETENTION, RunMetrics, purge_expired_metrics
+from checkpoints import (CHECKPOINT_DIR, CHECKPOINT_RETENTION, COMPLETE_MARKER, RunCheckpoint, RunLock,
+                         purge_expired_runs, run_id_for)
+from processing import (ANALYSIS_CHECKPOINT_STAGES, MAP_MAX_WORKERS, MAP_WINDOW_TOKENS, SPLIT_TASKS,
+                        process_input_stream)
+from transcription_backends import get_backend
+from transcription_diarization import AUDIO_FORMAT, FAILED_TRANSCRIPTIONS, convert_to_wav, transcribe_audio_file
+from visualization import create_charts
+
+CPU_WORKERS = os.cpu_count() or 2
+# Requests admitted into each stage at once; the others wait for a slot in that stage only
+STAGE_LIMITS = {
+    'extract': CPU_WORKERS,  # ffmpeg
+    'transcribe': 32,        # S3 upload and Transcribe job, mostly waiting
+    'whisper': 1,            # local transcription, each run already uses every core
+    'analyze': 8,            # concurrent LLM calls
+    'charts': CPU_WORKERS,   # plotly figures
+}
+STAGE_POOLS = {'extract': 'cpu', 'transcribe': 'io', 'whisper': 'cpu', 'analyze': 'io', 'charts': 'cpu'}
+# Pipeline stage that runs each transcription backend
+BACKEND_STAGES = {'aws': 'transcribe', 'local': 'whisper'}
+# How often a run waits to retry the lock held by another analysis of the same video
+RUN_LOCK_POLL_INTERVAL = 1.0
+
+
+def backend_run_id(video_path, backend):
+    """Run ID of a video analysed with a transcription backend (see run_id_for)."""
+    run_id = run_id_for(video_path)
+    # Runs of the same video with another backend must not resume from this one's transcript
+    return run_id if backend.name == 'aws' else f"{run_id}-{backend.name}"
+
+
+class AnalysisPipeline:
+    """The analyze_video stages for many concurrent requests, without blocking the event loop.
+
+    Extraction and chart rendering run on a CPU-sized thread pool, transcription and LLM
+    analysis on an I/O pool. Each stage admits at most stage_limits[stage] requests, so a
+    burst of uploads queues per stage instead of one request holding a worker for its whole
+    run. stats() reports per-stage call counts, busy time and time spent waiting for a slot.
+
+    Every run reports per-stage durations, bytes, tokens and cost into a RunMetrics (the caller's,
+    if it passes one), saved as JSON under metrics_dir when the run ends and kept there for
+    metrics_retention seconds.
+
+    With checkpoints, every stage's output is recorded under a run ID (by default derived from
+    the video's content), so a failed run retried with the same video resumes where it stopped.
+    Analyses of the same video run one at a time: a second one waits for the first to finish
+    and then reuses its transcript.
+    """
+
+    def __init__(self, llm, stage_limits=None, cpu_workers=CPU_WORKERS, use_cache=True, checkpoints=True,
+                 checkpoint_dir=CHECKPOINT_DIR, checkpoint_retention=CHECKPOINT_RETENTION, metrics_dir=METRICS_DIR,
+                 metrics_retention=METRICS_RETENTION):
+        self.llm = llm
+        self.stage_limits = {**STAGE_LIMITS, **(stage_limits or {})}
+        self.use_cache = use_cache
+        self.checkpoints = checkpoints
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_retention = checkpoint_retention
+        self.metrics_dir = metrics_dir
+        self.metrics_retention = metrics_retention
+        io_workers = sum(limit for stage, limit in self.stage_limits.items() if STAGE_POOLS[stage] == 'io')
+        self.executors = {
+            'cpu': ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix='pipeline-cpu'),
+            'io': ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='pipeline-io'),
+        }
+        self._semaphores = None
+        self.timings = {stage: {'calls': 0, 'busy': 0.0, 'waiting': 0.0} for stage in self.stage_limits}
+
+    def _semaphore(self, stage):
+        # Created on first use, inside the event loop that serves the requests
+        if self._semaphores is None:
+            self._semaphores = {stage: asyncio.Semaphore(limit) for stage, limit in self.stage_limits.items()}
+        return self._semaphores[stage]
+
+    def _record(self, stage, queued, started):
+        timing = self.timings[stage]
+        timing['calls'] += 1
+        timing['waiting'] += started - queued
+        timing['busy'] += time.perf_counter() - started
+
+    async def run_stage(self, stage, fn, *args, metrics=None):
+        """Run fn(*args) on the stage's pool; with a RunMetrics, fn reports its stages to it."""
+        queued = time.perf_counter()
+        async with self._semaphore(stage):
+            started = time.perf_counter()
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executors[STAGE_POOLS[stage]],
+                                                  metrics.bind(fn) if metrics else fn, *args)
+            finally:
+                self._record(stage, queued, started)
+
+    async def stream_stage(self, stage, generator_fn, *args, metrics=None):
+        """Iterate a blocking generator on the stage's pool, yielding its items as they arrive."""
+        queued = time.perf_counter()
+        async with self._semaphore(stage):
+            started = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue()
+
+            def drain():
+                try:
+                    for item in generator_fn(*args):
+                        loop.call_soon_threadsafe(queue.put_nowait, (False, item))
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, (True, None))
+
+            future = loop.run_in_executor(self.executors[STAGE_POOLS[stage]], metrics.bind(drain) if metrics else drain)
+            try:
+                while True:
+                    done, item = await queue.get()
+                    if done:
+                        break
+                    yield item
+                await future  # re-raises an exception from the generator
+            finally:
+                self._record(stage, queued, started)
+
+    async def run(self, video_path, progress=None, run_id=None, metrics=None, backend=None):
+        """Yield (status, transcription, results, charts) after transcription and per analysed speaker.
+
+        charts is create_charts(results), or None before any speaker is done. backend names the
+        transcription backend (see transcription_backends); None uses the default one.
+        """
+        metrics = metrics or RunMetrics(run_id)
+        backend = get_backend(backend)
+        if not self.checkpoints:
+            async for item in self._run(video_path, progress, metrics, backend, None):
+                yield item
+            return
+
+        purge_expired_runs(self.checkpoint_dir, self.checkpoint_retention)
+        if run_id is None:
+            run_id = await self.run_stage('extract', backend_run_id, video_path, backend)
+        metrics.run_id = run_id
+        lock = RunLock(run_id, self.checkpoint_dir)
+        while not lock.acquire():
+            await asyncio.sleep(RUN_LOCK_POLL_INTERVAL)
+        try:
+            checkpoint = RunCheckpoint(run_id, self.checkpoint_dir)
+            if checkpoint.complete:
+                # Analysing a finished run again reuses only its transcript, so changed tasks,
+                # knowledge or model take effect instead of the stored results coming back
+                checkpoint.discard(COMPLETE_MARKER, *ANALYSIS_CHECKPOINT_STAGES)
+            async for item in self._run(video_path, progress, metrics, backend, checkpoint):
+                yield item
+        finally:
+            lock.release()
+
+    async def _run(self, video_path, progress, metrics, backend, checkpoint):
+        # Without checkpoints the audio goes to a temp directory removed whatever happens; with
+        # them it stays in the run directory until the transcript is recorded, or for at most
+        # ARTIFACT_RETENTION if transcription fails
+        job_dir = checkpoint.dir if checkpoint else tempfile.mkdtemp(prefix='diarize_')
+        try:
+            if checkpoint and checkpoint.has('formatted_transcript'):
+                transcription = checkpoint.load('formatted_transcript')
+            else:
+                wav_path = checkpoint.load_file('audio') if checkpoint else None
+                if wav_path is None:
+                    wav_path = await self.run_stage('extract', convert_to_wav, video_path, job_dir, AUDIO_FORMAT,
+                                                    metrics=metrics)
+                    if wav_path and checkpoint:
+                        checkpoint.save_file('audio', wav_path)
+                if wav_path:
+                    transcription = await self.run_stage(BACKEND_STAGES.get(backend.name, 'transcribe'),
+                                                         transcribe_audio_file, wav_path, job_dir, self.use_cache,
+                                                         None, progress, checkpoint, backend, metrics=metrics)
+                else:
+                    transcription = "Audio conversion failed."
+        finally:
+            if checkpoint is None:
+                shutil.rmtree(job_dir, ignore_errors=True)
+            elif checkpoint.has('formatted_transcript'):
+                # Audio and chunk files are only needed to produce the transcript
+                checkpoint.remove_files()
+                checkpoint.discard('audio')
+        yield "Transcription complete, analysing speakers...", transcription, {}, None
+        if transcription in FAILED_TRANSCRIPTIONS:
+            checkpoint = None  # nothing worth resuming from an analysis of the error message
+
+        shown_speakers = 0
+        results, charts = {}, None
+        async for results, status in self.stream_stage('analyze', process_input_stream, transcription, self.llm,
+                                                       'auto', MAP_WINDOW_TOKENS, MAP_MAX_WORKERS, SPLIT_TASKS,
+                                                       checkpoint, metrics=metrics):
+            if len(results) > shown_speakers:
+                shown_speakers = len(results)
+                charts = await self.run_stage('charts', create_charts, dict(results), metrics=metrics)
+                yield status, transcription, results, charts
+        if charts is None or len(results) != shown_speakers:
+            charts = await self.run_stage('charts', create_charts, results, metrics=metrics)
+        if checkpoint and checkpoint.has('parsed_results'):
+            checkpoint.finish()
+        metrics.finish()
+        if self.metrics_dir:
+            purge_expired_metrics(self.metrics_dir, self.metrics_retention)
+            metrics.save(self.metrics_dir)
+        yield "Analysis complete.", transcription, results, charts
+
+    def stats(self):
+        return {stage: {'calls': timing['calls'], 'busy_s': round(timing['busy'], 3),
+                        'waiting_s': round(timing['waiting'], 3)}
+                for stage, timing in self.timings.items()}
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
@@ -1,20 +1,32 @@
-from langchain.schema import HumanMessage, BaseRetriever, Document
-from output_parser import output_parser
+from langchain.schema import HumanMessage, SystemMessage, BaseRetriever, Document
+from output_parser import (output_parser, merge_speaker_analyses, StreamingSpeakerParser, AttachmentStyle,
+                           BigFiveTraits, PersonalityDisorder, SECTIONS, response_format)
+from knowledge_index import KnowledgeIndex, format_context, format_document
+from llm_cache import stream_with_cache
+from instrumentation import record, timed, with_current_run
+from semantic_cache import SemanticCache
+from transcript import TURN_PATTERN, TURN_START, Transcript
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_community.vectorstores import FAISS
-from llm_loader import load_model, count_tokens
+from llm_loader import (load_model, count_tokens, truncate_tokens, context_window, MAX_OUTPUT_TOKENS, prompt_cache_usage,
+                        usage_counters)
 from config import openai_api_key
 from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
 from typing import List, Any, Optional
-from pydantic import Field
+from pydantic import BaseModel, Field
 from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.messages import AIMessage
+from openai import LengthFinishReasonError
 import os
 import json
-
-# Initialize embedding model
-embedding_model = OpenAIEmbeddings(openai_api_key=openai_api_key)
+import hashlib
+import threading
+from functools import lru_cache
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Define knowledge files
 knowledge_files = {
@@ -23,27 +35,150 @@ knowledge_files = {
     "personalities": "knowledge/personalities_definitions.txt"
 }
 
-# Load text-based knowledge
-documents = []
-for key, file_path in knowledge_files.items():
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read().strip()
-        documents.append(content)
+# The text index is built once from knowledge_files and stored next to the pre-existing indexes;
+# it is rebuilt only when the source files or the embedding model change
+TEXT_INDEX_PATH = "knowledge/faiss_index_Text_db"
+TEXT_INDEX_HASH_FILE = "source_hash.txt"
+# Bumped whenever the way the text index is built changes
+TEXT_INDEX_VERSION = 2
+ATTACHMENTS_INDEX_PATH = "knowledge/faiss_index_Attachments_db"
+PERSONALITIES_INDEX_PATH = "knowledge/faiss_index_Personalities_db"
 
-# Create FAISS index from text documents
-text_faiss_index = FAISS.from_texts(documents, embedding_model)
+# All three sources merged into one index tagged with a 'source' metadata field
+KNOWLEDGE_INDEX_PATH = "knowledge/faiss_index_Knowledge_db"
+# Documents per source and query, as each source's own retriever returned by default
+RETRIEVAL_QUOTAS = {"text": 4, "attachments": 4, "personalities": 4}
+# Hard cap on the tokens of the "Retrieved Knowledge" prompt section
+KNOWLEDGE_TOKEN_BUDGET = 4000
+# Transcript tokens passed to query generation, and slack for tokenizer differences in the prompt budget
+QUERY_INPUT_TOKEN_BUDGET = 16000
+PROMPT_SAFETY_MARGIN = 256
+
+# Split-task analysis: one LLM call per task, each with only its own knowledge. Keys are the
+# section names OutputParser reads; 'quotas' None means the task gets no retrieved knowledge.
+ANALYSIS_TASKS = {
+    "General Impression": {"task": 1, "quotas": None, "topic": None},
+    "Attachment Styles": {"task": 2, "quotas": {"text": 4, "attachments": 4}, "topic": "attachments"},
+    "Big Five Traits": {"task": 3, "quotas": {"text": 4}, "topic": "bigfive"},
+    "Personality Disorders": {"task": 4, "quotas": {"text": 4, "personalities": 4}, "topic": "personalities"},
+}
+SPLIT_TASKS = False
 
-# Load pre-existing FAISS indexes
-attachments_faiss_index = FAISS.load_local("knowledge/faiss_index_Attachments_db", embedding_model, allow_dangerous_deserialization=True)
-personalities_faiss_index = FAISS.load_local("knowledge/faiss_index_Personalities_db", embedding_model, allow_dangerous_deserialization=True)
+# Ask the model for JSON matching the SpeakerAnalysis schema (OpenAI structured output). Whatever
+# still comes back malformed is repaired locally, and only the broken parts are asked again: at
+# most MAX_SECTION_REASKS speakers per response, and MAX_CONTINUATIONS follow-ups for speakers a
+# truncated response never reached
+STRUCTURED_OUTPUT = True
+MAX_SECTION_REASKS = 4
+MAX_CONTINUATIONS = 2
+
+# Map-reduce analysis: transcript tokens per window and concurrent LLM calls
+MAP_WINDOW_TOKENS = 16000
+MAP_MAX_WORKERS = 4
+
+# Knowledge retrieval: 'generated' asks the LLM for search queries on every request, 'semantic'
+# reuses the knowledge of a near-identical earlier request (see SEMANTIC_CACHE_THRESHOLD), and
+# 'canonical' uses a fixed context per task retrieved with the task descriptions, with no
+# per-request model calls at all. Both shortcuts trade retrieval fit for latency, so they are opt-in
+RETRIEVAL_MODE = 'generated'
+# Request text embedded for the semantic cache (the embedding model accepts at most 8191 tokens)
+SEMANTIC_CACHE_INPUT_TOKENS = 8000
 
 # Initialize LLM
 llm = load_model(openai_api_key)
 
-# Create retrievers for each index
-text_retriever = text_faiss_index.as_retriever()
-attachments_retriever = attachments_faiss_index.as_retriever()
-personalities_retriever = personalities_faiss_index.as_retriever()
+semantic_cache = SemanticCache()
+_canonical_contexts = {}
+
+# Embeddings and indexes are created on first use, so importing this module does no network I/O
+_embedding_model = None
+_combined_retriever = None
+_knowledge_index = None
+_knowledge_lock = threading.Lock()
+
+def get_embedding_model():
+    global _embedding_model
+    if _embedding_model is None:
+        _embedding_model = OpenAIEmbeddings(openai_api_key=openai_api_key)
+    return _embedding_model
+
+def set_embedding_model(embedding_model):
+    """Swap the embedding model (e.g. for a local stand-in) and drop indexes and caches built with the old one."""
+    global _embedding_model, _combined_retriever, _knowledge_index
+    with _knowledge_lock:
+        _embedding_model = embedding_model
+        _combined_retriever = None
+        _knowledge_index = None
+        _canonical_contexts.clear()
+    semantic_cache.clear()
+
+def knowledge_sources_hash(embedding_model):
+    digest = hashlib.sha256(f"v{TEXT_INDEX_VERSION}".encode())
+    digest.update(f"{type(embedding_model).__name__}:{getattr(embedding_model, 'model', '')}".encode())
+    for key, file_path in sorted(knowledge_files.items()):
+        digest.update(key.encode())
+        with open(file_path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def load_text_index(embedding_model, rebuild=False):
+    source_hash = knowledge_sources_hash(embedding_model)
+    hash_path = os.path.join(TEXT_INDEX_PATH, TEXT_INDEX_HASH_FILE)
+    if not rebuild and os.path.exists(hash_path):
+        with open(hash_path, 'r', encoding='utf-8') as file:
+            if file.read().strip() == source_hash:
+                return FAISS.load_local(TEXT_INDEX_PATH, embedding_model, allow_dangerous_deserialization=True)
+
+    # Create FAISS index from text documents
+    print("Building knowledge text index")
+    documents = [load_text(file_path) for file_path in knowledge_files.values()]
+    # Each definitions file is tagged with its topic so per-task analysis can pick only its own
+    metadatas = [{"topic": key} for key in knowledge_files]
+    text_faiss_index = FAISS.from_texts(documents, embedding_model, metadatas=metadatas)
+    text_faiss_index.save_local(TEXT_INDEX_PATH)
+    with open(hash_path, 'w', encoding='utf-8') as file:
+        file.write(source_hash)
+    return text_faiss_index
+
+def load_knowledge_stores(embedding_model):
+    return {
+        "text": load_text_index(embedding_model),
+        # Load pre-existing FAISS indexes
+        "attachments": FAISS.load_local(ATTACHMENTS_INDEX_PATH, embedding_model, allow_dangerous_deserialization=True),
+        "personalities": FAISS.load_local(PERSONALITIES_INDEX_PATH, embedding_model, allow_dangerous_deserialization=True)
+    }
+
+def get_combined_retriever():
+    """Three separate retrievers queried one after another (the layout before KnowledgeIndex)."""
+    global _combined_retriever
+    with _knowledge_lock:
+        if _combined_retriever is None:
+            stores = load_knowledge_stores(get_embedding_model())
+            # Create retrievers for each index
+            _combined_retriever = CombinedRetriever(retrievers=[store.as_retriever() for store in stores.values()])
+        return _combined_retriever
+
+def knowledge_index_hash(embedding_model):
+    digest = hashlib.sha256(knowledge_sources_hash(embedding_model).encode())
+    for index_path in (ATTACHMENTS_INDEX_PATH, PERSONALITIES_INDEX_PATH):
+        for file_name in ("index.faiss", "index.pkl"):
+            with open(os.path.join(index_path, file_name), 'rb') as file:
+                digest.update(file.read())
+    return digest.hexdigest()
+
+def get_knowledge_index():
+    global _knowledge_index
+    with _knowledge_lock:
+        if _knowledge_index is None:
+            embedding_model = get_embedding_model()
+            source_hash = knowledge_index_hash(embedding_model)
+            if KnowledgeIndex.saved_hash(KNOWLEDGE_INDEX_PATH) == source_hash:
+                _knowledge_index = KnowledgeIndex.load(KNOWLEDGE_INDEX_PATH, embedding_model)
+            else:
+                print("Building merged knowledge index")
+                _knowledge_index = KnowledgeIndex.from_stores(load_knowledge_stores(embedding_model), embedding_model)
+                _knowledge_index.save(KNOWLEDGE_INDEX_PATH, source_hash)
+        return _knowledge_index
 
 class CombinedRetriever(BaseRetriever):
     retrievers: List[BaseRetriever] = Field(default_factory=list)
@@ -69,9 +204,6 @@ class CombinedRetriever(BaseRetriever):
             combined_docs.extend(docs)
         return combined_docs
 
-# Create an instance of the combined retriever
-combined_retriever = CombinedRetriever(retrievers=[text_retriever, attachments_retriever, personalities_retriever])
-
 # Create prompt template for query generation
 prompt_template = PromptTemplate(
     input_variables=["question"],
@@ -83,17 +215,102 @@ query_generation_chain = prompt_template | llm
 
 # Create multi-query retrieval chain
 def generate_queries(input):
-    queries = query_generation_chain.invoke({"question": input}).content.split('\n')
+    with timed('query_generation') as metrics:
+        response = query_generation_chain.invoke({"question": input})
+        metrics.update(usage_counters(response))
+    queries = response.content.split('\n')
     return [query.strip() for query in queries if query.strip()]
 
 def multi_query_retrieve(input):
     queries = generate_queries(input)
     all_docs = []
-    for query in queries:
-        docs = combined_retriever.get_relevant_documents(query)
+    # One embedding call and one index search for all generated queries
+    for docs in get_knowledge_index().search(queries, RETRIEVAL_QUOTAS):
         all_docs.extend(docs)
     return all_docs
 
+def pack_documents(ids, token_budget):
+    knowledge_index = get_knowledge_index()
+    documents, used_tokens = [], 0
+    for i in ids:
+        tokens = count_tokens(format_document(knowledge_index.documents[i]))
+        if used_tokens + tokens <= token_budget:
+            documents.append(knowledge_index.documents[i])
+            used_tokens += tokens
+    return documents
+
+def request_knowledge(input, token_budget=KNOWLEDGE_TOKEN_BUDGET, mode=None):
+    """(query_vectors, document_ids) for a request; query_vectors is None when there are no queries.
+
+    In 'semantic' mode a request similar enough to an earlier one reuses its queries and
+    documents, skipping query generation and the index search.
+    """
+    # Timed in two parts around query generation, which reports as its own stage
+    with timed('retrieval'):
+        knowledge_index = get_knowledge_index()
+        vector = None
+        cached = None
+        if (mode or RETRIEVAL_MODE) == 'semantic':
+            vector = knowledge_index.embed([truncate_tokens(input, SEMANTIC_CACHE_INPUT_TOKENS)])[0]
+            cached = semantic_cache.lookup(vector)
+    if cached is not None:
+        return cached
+
+    queries = generate_queries(input)
+    if not queries:
+        return None, []
+    with timed('retrieval', calls=0):
+        query_vectors = knowledge_index.embed(queries)
+        ids = knowledge_index.select_ids(query_vectors, RETRIEVAL_QUOTAS, token_budget, count_tokens)
+        if vector is not None:
+            semantic_cache.add(vector, query_vectors, ids)
+    return query_vectors, ids
+
+def canonical_context(section=None, token_budget=KNOWLEDGE_TOKEN_BUDGET):
+    """Fixed knowledge for one analysis task, or for all of them when section is None.
+
+    The task descriptions serve as the search queries, so the result depends only on the task
+    files and the index; it is computed once per process.
+    """
+    key = (section, token_budget)
+    with _knowledge_lock:
+        if key in _canonical_contexts:
+            return _canonical_contexts[key]
+
+    tasks = load_tasks()
+    specs = {s: spec for s, spec in ANALYSIS_TASKS.items() if spec["quotas"] and section in (None, s)}
+    knowledge_index = get_knowledge_index()
+    if specs:
+        queries = [truncate_tokens(tasks[spec["task"]], SEMANTIC_CACHE_INPUT_TOKENS) for spec in specs.values()]
+        if section is None:
+            documents = knowledge_index.select_context(queries, RETRIEVAL_QUOTAS, token_budget, count_tokens)
+        else:
+            topic = specs[section]["topic"]
+            documents = knowledge_index.select_context(
+                queries, specs[section]["quotas"], token_budget, count_tokens,
+                document_filter=lambda doc: doc.metadata.get("topic", topic) == topic
+            )
+        context = format_context(documents)
+    else:
+        context = ""
+
+    with _knowledge_lock:
+        _canonical_contexts[key] = context
+    return context
+
+def precompute_canonical_contexts():
+    canonical_context()
+    for section in ANALYSIS_TASKS:
+        canonical_context(section)
+
+def retrieve_knowledge(input, token_budget=KNOWLEDGE_TOKEN_BUDGET, mode=None):
+    """Deduplicated, MMR-ranked knowledge for the generated queries, packed into token_budget."""
+    if (mode or RETRIEVAL_MODE) == 'canonical':
+        return canonical_context(None, token_budget)
+    _, ids = request_knowledge(input, token_budget, mode)
+    with timed('retrieval', calls=0):
+        return format_context(pack_documents(ids, token_budget))
+
 multi_query_retriever = RunnableLambda(multi_query_retrieve)
 
 # Create QA chain with multi-query retriever
@@ -107,26 +324,61 @@ def load_text(file_path: str) -> str:
     with open(file_path, 'r', encoding='utf-8') as file:
         return file.read().strip()
 
+def split_turns(text: str) -> List[str]:
+    return [turn for turn in TURN_START.split(text) if turn.strip()]
+
+def as_transcript(input_text):
+    """A formatted transcript parsed once into a Transcript; other text is returned unchanged."""
+    if isinstance(input_text, Transcript):
+        return input_text
+    transcript = Transcript.parse(input_text)
+    return transcript if len(transcript) else input_text
+
 def truncate_text(text: str, max_tokens: int = 16000) -> str:
-    words = text.split()
-    if len(words) > max_tokens:
-        return ' '.join(words[:max_tokens])
-    return text
+    """Cut text to max_tokens real tokens, dropping whole speaker turns from the end.
+
+    Only when not even the first turn fits is the text cut inside a turn.
+    """
+    if isinstance(text, Transcript):
+        return text.head_tokens(max_tokens, count_tokens).render()
+    if count_tokens(text) <= max_tokens:
+        return text
 
-def process_input(input_text: str, llm):
-    general_task = load_text("tasks/General_tasks_description.txt")
-    general_impression_task = load_text("tasks/General_Impression_task.txt")
-    attachments_task = load_text("tasks/Attachments_task.txt")
-    bigfive_task = load_text("tasks/BigFive_task.txt")
-    personalities_task = load_text("tasks/Personalities_task.txt")
+    kept, used_tokens = [], 0
+    for turn in split_turns(text):
+        # Turns are rejoined with a blank line, which costs about one token
+        turn_tokens = count_tokens(turn) + 1
+        if used_tokens + turn_tokens > max_tokens:
+            break
+        kept.append(turn)
+        used_tokens += turn_tokens
 
-    truncated_input = truncate_text(input_text)
+    if not kept:
+        return truncate_tokens(text, max_tokens)
+    truncated = '\n\n'.join(kept)
+    while count_tokens(truncated) > max_tokens and len(kept) > 1:
+        kept.pop()
+        truncated = '\n\n'.join(kept)
+    return truncated
 
-    relevant_docs = qa_chain.invoke({"query": truncated_input})
-    
-    retrieved_knowledge = str(relevant_docs)
+# Per-message overhead of the chat format, in tokens
+MESSAGE_TOKEN_OVERHEAD = 4
 
-    prompt = f"""
+def prompt_tokens(prompt) -> int:
+    if isinstance(prompt, str):
+        return count_tokens(prompt)
+    return sum(count_tokens(message.content) + MESSAGE_TOKEN_OVERHEAD for message in prompt)
+
+def transcript_token_budget(fixed_prompt) -> int:
+    """Tokens left for the transcript once the rest of the prompt and the response are reserved."""
+    return context_window() - MAX_OUTPUT_TOKENS - prompt_tokens(fixed_prompt) - PROMPT_SAFETY_MARGIN
+
+# Analysis prompts are a system message that depends only on the task files, followed by a
+# user message with the per-request knowledge and transcript. Keeping the system message
+# byte-identical across requests lets the provider's prompt cache reuse it.
+@lru_cache(maxsize=None)
+def analysis_prefix(general_task, general_impression_task, attachments_task, bigfive_task, personalities_task):
+    return f"""
 {general_task}
 Genral Impression Task:
 {general_impression_task}
@@ -136,78 +388,508 @@ Big Five Traits Task:
 {bigfive_task}
 Personality Disorders Task:
 {personalities_task}
-Retrieved Knowledge: {retrieved_knowledge}
-Input: {truncated_input}
-Please provide a comprehensive analysis for each speaker, including:
+Please provide a comprehensive analysis for each speaker in the Input, including:
 1. General impressions (answer the sections provided in the General Impression Task.)
 2. Attachment styles (use the format from the Attachment Styles Task)
 3. Big Five traits (use the format from the Big Five Traits Task)
 4. Personality disorders (use the format from the Personality Disorders Task)
-Respond with a JSON object containing an array of speaker analyses under the key 'speaker_analyses'. Each speaker analysis should include all four aspects mentioned above, however, General impressions must not be in json or dict format.
+Respond with a JSON object containing an array of speaker analyses under the key 'speaker_analyses'. Each speaker analysis should include all four aspects mentioned above, however, General impressions must not be in json or dict format."""
+
+def analysis_input(retrieved_knowledge, truncated_input):
+    return f"""Retrieved Knowledge: {retrieved_knowledge}
+Input: {truncated_input}
 Analysis:"""
 
-    #truncated_input_tokents_count = count_tokens(truncated_input)
-    #print('truncated_input_tokents_count:', truncated_input_tokents_count)
-    #input_tokens_count = count_tokens(prompt)
-    #print('input_tokens_count', input_tokens_count)
-    
-    response = llm.invoke(prompt)
-    
+def build_prompt(general_task, general_impression_task, attachments_task, bigfive_task, personalities_task,
+                 retrieved_knowledge, truncated_input):
+    return [
+        SystemMessage(content=analysis_prefix(general_task, general_impression_task, attachments_task,
+                                              bigfive_task, personalities_task)),
+        HumanMessage(content=analysis_input(retrieved_knowledge, truncated_input)),
+    ]
+
+@lru_cache(maxsize=None)
+def load_tasks():
+    # Read once per process; restart to pick up edited task files
+    return (
+        load_text("tasks/General_tasks_description.txt"),
+        load_text("tasks/General_Impression_task.txt"),
+        load_text("tasks/Attachments_task.txt"),
+        load_text("tasks/BigFive_task.txt"),
+        load_text("tasks/Personalities_task.txt")
+    )
+
+def speaker_result(parsed_analysis):
+    # Convert general_impression to string if it's a dict or JSON object
+    general_impression = parsed_analysis.general_impression
+    if isinstance(general_impression, dict):
+        general_impression = json.dumps(general_impression)
+    elif isinstance(general_impression, str):
+        try:
+            # Check if it's a JSON string
+            json.loads(general_impression)
+            # If it parses successfully, it's likely a JSON string, so we'll keep it as is
+        except json.JSONDecodeError:
+            # If it's not a valid JSON string, we'll keep it as is (it's already a string)
+            pass
+
+    return {
+        'general_impression': general_impression,
+        'attachments': parsed_analysis.attachment_style,
+        'bigfive': parsed_analysis.big_five_traits,
+        'personalities': parsed_analysis.personality_disorder
+    }
+
+def empty_results():
+    empty_analysis = output_parser.parse_speaker_analysis({})
+    return {"Speaker 1": speaker_result(empty_analysis)}
+
+def structured_output(sections=SECTIONS):
+    """Call parameters requesting structured output for the given sections (none if disabled)."""
+    return {'response_format': response_format(sections)} if STRUCTURED_OUTPUT else {}
+
+def invoke_analysis(prompt, llm, sections=SECTIONS, stage='llm_analysis'):
+    """Run one analysis prompt and return the response text."""
+    with timed(stage) as metrics:
+        try:
+            response = llm.invoke(prompt, **structured_output(sections))
+        except LengthFinishReasonError as e:
+            # Structured output refuses answers cut off at max_tokens; keep what arrived for repair
+            completion = e.completion
+            token_usage = completion.usage.model_dump() if completion.usage else {}
+            response = AIMessage(content=completion.choices[0].message.content or "",
+                                 response_metadata={'token_usage': token_usage})
+        metrics.update(usage_counters(response))
+    prompt_cache_usage.record(response)
+    return response.content
+
+def speaker_label(speaker_analysis, index):
+    return str(speaker_analysis.get("Speaker") or f"Speaker {index + 1}")
+
+def section_prompt(prompt, speaker, sections):
+    """prompt followed by a request for only the given sections of one speaker."""
+    names = ", ".join(f"'{section}'" for section in sections)
+    return list(prompt) + [HumanMessage(content=f"""Please provide only the {names} section(s) for {speaker} again; they were missing or malformed in your previous answer.
+Respond with a JSON object whose 'speaker_analyses' array holds one entry with the key 'Speaker' and the keys {names}.""")]
+
+def continuation_prompt(prompt, done_speakers):
+    """prompt followed by a request for the speakers a truncated answer did not reach."""
+    done = ", ".join(done_speakers) or "(none)"
+    return list(prompt) + [HumanMessage(content=f"""Please provide the analyses of the remaining speakers only, continuing after {done}. Respond with the same JSON object, with an empty 'speaker_analyses' array if no speakers remain.""")]
+
+def retry_prompt(prompt):
+    return list(prompt) + [HumanMessage(content="Please provide your complete answer again as one valid JSON object; the previous answer could not be parsed.")]
+
+def _checked(content, sections):
+    with timed('output_parser'):
+        return output_parser.check(content, sections)
+
+def complete_speaker_analyses(prompt, llm, content, sections=SECTIONS):
+    """The 'speaker_analyses' list of a response to prompt, repaired and completed.
+
+    Defects are fixed locally where possible. Speakers with missing or malformed sections get one
+    call each asking for just those sections, and a truncated response is continued from the last
+    whole speaker. Only when the response has no usable JSON at all is the full prompt asked again.
+    Raises ValueError if the second answer is unusable as well.
+    """
+    try:
+        speaker_analyses, broken, truncated = _checked(content, sections)
+    except ValueError as e:
+        print(f"Unusable model output, asking again: {e}")
+        content = invoke_analysis(retry_prompt(prompt), llm, sections, 'full_reask')
+        speaker_analyses, broken, truncated = _checked(content, sections)
+
+    for _ in range(MAX_CONTINUATIONS):
+        if not truncated:
+            break
+        done = [speaker_label(speaker_analysis, i) for i, speaker_analysis in enumerate(speaker_analyses)]
+        print(f"Model output was truncated after {len(done)} speaker(s), continuing")
+        try:
+            content = invoke_analysis(continuation_prompt(prompt, done), llm, sections, 'continuation')
+            more, more_broken, truncated = _checked(content, sections)
+        except ValueError as e:
+            print(f"Unusable continuation: {e}")
+            break
+        broken.update((len(speaker_analyses) + i, missing) for i, missing in more_broken.items())
+        speaker_analyses.extend(more)
+
+    for index, missing in list(broken.items())[:MAX_SECTION_REASKS]:
+        speaker = speaker_label(speaker_analyses[index], index)
+        print(f"Asking again for {speaker}: {', '.join(missing)}")
+        try:
+            content = invoke_analysis(section_prompt(prompt, speaker, missing), llm, missing, 'section_reask')
+            patches, patch_broken, _ = _checked(content, missing)
+        except ValueError as e:
+            print(f"Unusable answer for {speaker}: {e}")
+            continue
+        if patches:
+            for section in missing:
+                if section not in patch_broken.get(0, []):
+                    speaker_analyses[index][section] = patches[0][section]
+    return speaker_analyses
+
+def invoke_speaker_analyses(prompt, llm, sections=SECTIONS):
+    """Run one prompt and return the 'speaker_analyses' list, repaired and completed by
+    complete_speaker_analyses; raises if no usable output could be obtained."""
+    content = invoke_analysis(prompt, llm, sections)
+
     print("Raw LLM Model Output:")
-    print(response.content)
+    print(content)
+
+    return complete_speaker_analyses(prompt, llm, content, sections)
+
+def analyze_prompt(prompt, llm):
+    """Run one analysis prompt and parse the speaker analyses; raises if no usable output could be obtained."""
+    speaker_analyses = invoke_speaker_analyses(prompt, llm)
+    with timed('output_parser', calls=0):
+        return [output_parser.parse_speaker_analysis(speaker_analysis) for speaker_analysis in speaker_analyses]
+
+def process_input(input_text: str, llm, mode: str = 'auto', window_tokens: int = MAP_WINDOW_TOKENS,
+                  max_workers: int = MAP_MAX_WORKERS, split_tasks: bool = SPLIT_TASKS):
+    """Analyse a diarized transcript; returns {speaker_id: results} for visualization.create_charts.
+
+    mode='single' sends one prompt and truncates the transcript to what fits. mode='map_reduce'
+    analyses speaker-turn-aligned windows concurrently and merges the per-speaker results.
+    mode='auto' uses map-reduce only when the transcript would otherwise be truncated.
+    split_tasks=True instead issues the four analysis tasks as parallel calls (single mode only).
+    """
+    input_text = as_transcript(input_text)
+    tasks = load_tasks()
+
+    if split_tasks and mode != 'map_reduce':
+        results, timings = analyze_tasks_parallel(input_text, llm, tasks)
+        print('task timings:', timings)
+        return results
+
+    retrieved_knowledge = retrieve_knowledge(truncate_text(input_text, QUERY_INPUT_TOKEN_BUDGET))
+
+    # Whatever the task files and knowledge leave of the context window goes to the transcript
+    fixed_prompt = build_prompt(*tasks, retrieved_knowledge, "")
+    transcript_budget = transcript_token_budget(fixed_prompt)
+
+    if mode == 'map_reduce' or (mode == 'auto' and count_tokens(str(input_text)) > transcript_budget):
+        return map_reduce_analysis(input_text, llm, tasks, retrieved_knowledge,
+                                   min(window_tokens, transcript_budget), max_workers)
+
+    truncated_input = truncate_text(input_text, transcript_budget)
+
+    prompt = build_prompt(*tasks, retrieved_knowledge, truncated_input)
+
+    print('input_tokens_count:', prompt_tokens(prompt))
 
     try:
-        content = response.content
-        if content.startswith("```json"):
-            content = content.split("```json", 1)[1]
-        if content.endswith("```"):
-            content = content.rsplit("```", 1)[0]
-        
-        parsed_json = json.loads(content.strip())
-        
         results = {}
-        speaker_analyses = parsed_json.get('speaker_analyses', [])
-        for i, speaker_analysis in enumerate(speaker_analyses, 1):
-            speaker_id = f"Speaker {i}"
-            parsed_analysis = output_parser.parse_speaker_analysis(speaker_analysis)
-
-                # Convert general_impression to string if it's a dict or JSON object
-            general_impression = parsed_analysis.general_impression
-            if isinstance(general_impression, dict):
-                general_impression = json.dumps(general_impression)
-            elif isinstance(general_impression, str):
-                try:
-                    # Check if it's a JSON string
-                    json.loads(general_impression)
-                    # If it parses successfully, it's likely a JSON string, so we'll keep it as is
-                except json.JSONDecodeError:
-                    # If it's not a valid JSON string, we'll keep it as is (it's already a string)
-                    pass
-            
-            results[speaker_id] = {
-                'general_impression': general_impression,
-                'attachments': parsed_analysis.attachment_style,
-                'bigfive': parsed_analysis.big_five_traits,
-                'personalities': parsed_analysis.personality_disorder
-            }
-        
+        for i, parsed_analysis in enumerate(analyze_prompt(prompt, llm), 1):
+            results[f"Speaker {i}"] = speaker_result(parsed_analysis)
+
         if not results:
             print("Warning: No speaker analyses found in the parsed JSON.")
-            empty_analysis = output_parser.parse_speaker_analysis({})
-            return {"Speaker 1": {
-                'general_impression': empty_analysis.general_impression,
-                'attachments': empty_analysis.attachment_style,
-                'bigfive': empty_analysis.big_five_traits,
-                'personalities': empty_analysis.personality_disorder
-            }}
-        
+            return empty_results()
+
         return results
     except Exception as e:
         print(f"Error processing input: {e}")
-        empty_analysis = output_parser.parse_speaker_analysis({})
-        return {"Speaker 1": {
-            'general_impression': empty_analysis.general_impression,
-            'attachments': empty_analysis.attachment_style,
-            'bigfive': empty_analysis.big_five_traits,
-            'personalities': empty_analysis.personality_disorder
-        }}
\ No newline at end of file
+        return empty_results()
+
+def stream_speaker_analyses(prompt, llm):
+    """Stream one analysis prompt, yielding parser events as speakers and their sections complete.
+
+    Yields ("section", index, key, value) and ("speaker", index, parsed_analysis) events, then a
+    final ("done", None, None, content) event with the full response text.
+    """
+    parser = StreamingSpeakerParser()
+    content = ""
+    response = None
+    # Waiting for chunks counts as the model call, handling them as parsing
+    model_seconds = parse_seconds = 0.0
+    chunks = iter(stream_with_cache(llm, prompt, **structured_output()))
+    while True:
+        start_time = time.perf_counter()
+        chunk = next(chunks, None)
+        model_seconds += time.perf_counter() - start_time
+        if chunk is None:
+            break
+        start_time = time.perf_counter()
+        content += chunk.content
+        response = chunk if response is None else response + chunk
+        events = []
+        for kind, index, *payload in parser.feed(chunk.content):
+            if kind == "speaker":
+                events.append((kind, index, None, output_parser.parse_speaker_analysis(payload[0])))
+            else:
+                events.append((kind, index, payload[0], payload[1]))
+        parse_seconds += time.perf_counter() - start_time
+        yield from events
+    record('llm_analysis', model_seconds, **(usage_counters(response) if response is not None else {}))
+    record('output_parser', parse_seconds)
+    if response is not None:
+        prompt_cache_usage.record(response)
+    yield "done", None, None, content
+
+def analyses_to_results(speaker_analyses):
+    return {f"Speaker {i}": speaker_result(output_parser.parse_speaker_analysis(speaker_analysis))
+            for i, speaker_analysis in enumerate(speaker_analyses, 1)}
+
+def results_to_json(results):
+    """JSON-serializable copy of a results dict (the pydantic sections become plain dicts)."""
+    return {
+        speaker_id: {key: value.model_dump() if isinstance(value, BaseModel) else value
+                     for key, value in speaker.items()}
+        for speaker_id, speaker in results.items()
+    }
+
+def results_from_json(data):
+    sections = {'attachments': AttachmentStyle, 'bigfive': BigFiveTraits, 'personalities': PersonalityDisorder}
+    return {
+        speaker_id: {key: sections[key](**value) if key in sections else value for key, value in speaker.items()}
+        for speaker_id, speaker in data.items()
+    }
+
+# Checkpoint stages written by the analysis; unlike the transcript they depend on the tasks, knowledge and model
+ANALYSIS_CHECKPOINT_STAGES = ('retrieved_context', 'raw_llm_output', 'parsed_results')
+
+def _checkpoint_results(checkpoint, results):
+    # The fallback for a failed analysis is not recorded, so a retry calls the model again
+    if checkpoint and results != empty_results():
+        checkpoint.save('parsed_results', results_to_json(results))
+    return results
+
+def process_input_stream(input_text: str, llm, mode: str = 'auto', window_tokens: int = MAP_WINDOW_TOKENS,
+                         max_workers: int = MAP_MAX_WORKERS, split_tasks: bool = SPLIT_TASKS, checkpoint=None):
+    """Like process_input, but yields (results, status) as each speaker's analysis arrives.
+
+    results holds only speakers whose analysis is complete; status describes the latest section
+    received. The last item carries the full results. Map-reduce and split-task runs cannot
+    report speakers before all calls finish, so they yield once.
+    With a checkpoints.RunCheckpoint, the retrieved context, raw model output and parsed results
+    are recorded, and a retry skips every stage that already completed.
+    """
+    if checkpoint and checkpoint.has('parsed_results'):
+        yield results_from_json(checkpoint.load('parsed_results')), "Analysis complete."
+        return
+
+    input_text = as_transcript(input_text)
+    tasks = load_tasks()
+
+    if split_tasks and mode != 'map_reduce':
+        results = process_input(input_text, llm, mode, window_tokens, max_workers, split_tasks)
+        yield _checkpoint_results(checkpoint, results), "Analysis complete."
+        return
+
+    retrieved_knowledge = checkpoint.load('retrieved_context') if checkpoint else None
+    if retrieved_knowledge is None:
+        retrieved_knowledge = retrieve_knowledge(truncate_text(input_text, QUERY_INPUT_TOKEN_BUDGET))
+        if checkpoint:
+            checkpoint.save('retrieved_context', retrieved_knowledge)
+    fixed_prompt = build_prompt(*tasks, retrieved_knowledge, "")
+    transcript_budget = transcript_token_budget(fixed_prompt)
+
+    if mode == 'map_reduce' or (mode == 'auto' and count_tokens(str(input_text)) > transcript_budget):
+        results = map_reduce_analysis(input_text, llm, tasks, retrieved_knowledge,
+                                      min(window_tokens, transcript_budget), max_workers)
+        yield _checkpoint_results(checkpoint, results), "Analysis complete."
+        return
+
+    results = {}
+    prompt = build_prompt(*tasks, retrieved_knowledge, truncate_text(input_text, transcript_budget))
+    raw_output = checkpoint.load('raw_llm_output') if checkpoint else None
+    if raw_output is not None:
+        # The model answered on an earlier attempt; only parsing (and any repairs) is left to redo
+        try:
+            results = analyses_to_results(complete_speaker_analyses(prompt, llm, raw_output))
+        except Exception as e:
+            print(f"Checkpointed model output is unusable, asking again: {e}")
+            results = {}
+
+    if not results:
+        print('input_tokens_count:', prompt_tokens(prompt))
+        try:
+            for kind, index, key, value in stream_speaker_analyses(prompt, llm):
+                if kind == "section":
+                    yield results, f"Speaker {index + 1}: received {key}"
+                elif kind == "speaker":
+                    results[f"Speaker {index + 1}"] = speaker_result(value)
+                    yield results, f"Speaker {index + 1} complete"
+                else:
+                    print("Raw LLM Model Output:")
+                    print(value)
+                    if checkpoint:
+                        checkpoint.save('raw_llm_output', value)
+                    # Speakers streamed with broken sections, or never reached, are completed here
+                    results = analyses_to_results(complete_speaker_analyses(prompt, llm, value))
+        except Exception as e:
+            print(f"Error processing input: {e}")
+
+    if not results:
+        print("Warning: No speaker analyses found in the streamed output.")
+        results = empty_results()
+    yield _checkpoint_results(checkpoint, results), "Analysis complete."
+
+@lru_cache(maxsize=None)
+def task_prefix(general_task, section, task_text):
+    return f"""
+{general_task}
+{section} Task:
+{task_text}
+Please provide the {section} analysis for each speaker in the Input, using the format from the {section} Task.
+Respond with a JSON object containing an array of speaker analyses under the key 'speaker_analyses'. Each speaker analysis must contain the key 'Speaker' and the key '{section}'."""
+
+def build_task_prompt(general_task, section, task_text, retrieved_knowledge, truncated_input):
+    knowledge = f"Retrieved Knowledge: {retrieved_knowledge}\n" if retrieved_knowledge else ""
+    return [
+        SystemMessage(content=task_prefix(general_task, section, task_text)),
+        HumanMessage(content=f"{knowledge}Input: {truncated_input}\nAnalysis:"),
+    ]
+
+def analyze_tasks_parallel(input_text, llm, tasks):
+    """Issue the four analysis tasks as concurrent LLM calls and merge them per speaker.
+
+    Returns the results dict and per-stage timings in seconds.
+    """
+    timings = {}
+    start_time = time.perf_counter()
+    vectors = None
+    if RETRIEVAL_MODE != 'canonical':
+        vectors, _ = request_knowledge(truncate_text(input_text, QUERY_INPUT_TOKEN_BUDGET))
+    timings['query_generation'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    knowledge_index = get_knowledge_index()
+    task_knowledge = {}
+    for section, spec in ANALYSIS_TASKS.items():
+        if RETRIEVAL_MODE == 'canonical':
+            task_knowledge[section] = canonical_context(section)
+            continue
+        if spec["quotas"] is None or vectors is None:
+            task_knowledge[section] = ""
+            continue
+        ids = knowledge_index.select_ids(
+            vectors, spec["quotas"], KNOWLEDGE_TOKEN_BUDGET, count_tokens,
+            document_filter=lambda doc, topic=spec["topic"]: doc.metadata.get("topic", topic) == topic
+        )
+        task_knowledge[section] = format_context([knowledge_index.documents[i] for i in ids])
+    timings['retrieval'] = time.perf_counter() - start_time
+
+    # Each call is budgeted on its own, so the transcript budget is set by the largest task prompt
+    prompts = {}
+    for section, spec in ANALYSIS_TASKS.items():
+        fixed_prompt = build_task_prompt(tasks[0], section, tasks[spec["task"]], task_knowledge[section], "")
+        truncated_input = truncate_text(input_text, transcript_token_budget(fixed_prompt))
+        prompts[section] = build_task_prompt(tasks[0], section, tasks[spec["task"]], task_knowledge[section],
+                                             truncated_input)
+
+    def run_task(section):
+        task_start = time.perf_counter()
+        try:
+            return invoke_speaker_analyses(prompts[section], llm, [section])
+        except Exception as e:
+            print(f"Error processing {section} task: {e}")
+            return []
+        finally:
+            timings[section] = time.perf_counter() - task_start
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        task_outputs = dict(zip(prompts, executor.map(with_current_run(run_task), prompts)))
+    timings['analysis'] = time.perf_counter() - start_time
+
+    # Combine the sections per speaker, keyed by the model's speaker label or else by position
+    combined = {}
+    for section, speaker_analyses in task_outputs.items():
+        for i, speaker_analysis in enumerate(speaker_analyses, 1):
+            if not isinstance(speaker_analysis, dict):
+                continue
+            match = re.search(r"Speaker\s*(\d+)", str(speaker_analysis.get("Speaker", "")))
+            speaker_id = f"Speaker {match.group(1)}" if match else f"Speaker {i}"
+            combined.setdefault(speaker_id, {"Speaker": speaker_id})[section] = speaker_analysis.get(section, {})
+
+    results = {}
+    for speaker_id in sorted(combined, key=lambda s: int(re.sub(r"\D", "", s) or 0)):
+        results[speaker_id] = speaker_result(output_parser.parse_speaker_analysis(combined[speaker_id]))
+    if not results:
+        print("Warning: No speaker analyses found in the task outputs.")
+        results = empty_results()
+    return results, timings
+
+def split_windows(text: str, window_tokens: int) -> List[str]:
+    """Group consecutive speaker turns into windows of at most window_tokens tokens."""
+    if isinstance(text, Transcript):
+        return text.windows(window_tokens, count_tokens)
+    windows, current, used_tokens = [], [], 0
+    for turn in split_turns(text):
+        turn_tokens = count_tokens(turn) + 1
+        if turn_tokens > window_tokens:
+            turn, turn_tokens = truncate_tokens(turn, window_tokens - 1), window_tokens
+        if current and used_tokens + turn_tokens > window_tokens:
+            windows.append('\n\n'.join(current))
+            current, used_tokens = [], 0
+        current.append(turn)
+        used_tokens += turn_tokens
+    if current:
+        windows.append('\n\n'.join(current))
+    return windows
+
+def speaker_weights(window: str) -> dict:
+    """Tokens spoken per speaker in a window, in order of first appearance."""
+    if isinstance(window, Transcript):
+        return window.speaker_tokens(count_tokens)
+    weights = {}
+    for turn in split_turns(window):
+        match = TURN_PATTERN.match(turn)
+        if match:
+            _, speaker_id, text = match.groups()
+            weights[speaker_id] = weights.get(speaker_id, 0) + count_tokens(text)
+    return weights
+
+def map_reduce_analysis(input_text, llm, tasks, retrieved_knowledge, window_tokens, max_workers):
+    windows = split_windows(input_text, window_tokens)
+    print(f"Map-reduce analysis over {len(windows)} windows")
+
+    def analyze_window(window):
+        return analyze_prompt(build_prompt(*tasks, retrieved_knowledge, window), llm)
+
+    # Map: windows are analysed concurrently, at most max_workers LLM calls in flight
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(with_current_run(analyze_window), window) for window in windows]
+
+    partials = {}
+    for window, future in zip(windows, futures):
+        try:
+            analyses = future.result()
+        except Exception as e:
+            print(f"Error processing window: {e}")
+            continue
+        weights = speaker_weights(window)
+        window_speakers = list(weights)
+        for i, analysis in enumerate(analyses):
+            # Trust the model's speaker label if it names someone in this window, else use the order
+            match = re.search(r"Speaker\s*(\d+)", analysis.speaker)
+            speaker_id = f"Speaker {match.group(1)}" if match else None
+            if speaker_id not in weights:
+                speaker_id = window_speakers[i] if i < len(window_speakers) else None
+            if speaker_id is not None:
+                partials.setdefault(speaker_id, []).append((analysis, weights[speaker_id]))
+
+    # Reduce: one merged analysis per speaker
+    results = {}
+    for speaker_id in sorted(partials, key=lambda s: int(re.sub(r"\D", "", s) or 0)):
+        results[speaker_id] = speaker_result(merge_speaker_analyses(partials[speaker_id]))
+
+    if not results:
+        print("Warning: No speaker analyses found in any window.")
+        return empty_results()
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Knowledge index maintenance")
+    parser.add_argument('--build-index', action='store_true',
+                        help=f"Build {TEXT_INDEX_PATH} and {KNOWLEDGE_INDEX_PATH} with the OpenAI embeddings")
+    args = parser.parse_args()
+    if not args.build_index:
+        parser.error("nothing to do; pass --build-index")
+    # Build the persisted knowledge indexes offline, so serving only loads them
+    load_text_index(get_embedding_model(), rebuild=True)
+    get_knowledge_index()
+    precompute_canonical_contexts()
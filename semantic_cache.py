@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Cosine similarity needed to reuse an entry. Only near-repeats of one transcript should match:
+# 'benchmark.py semantic' measures them at >= 0.9998 and different transcripts at up to ~0.991
+SEMANTIC_CACHE_THRESHOLD = 0.995
+SEMANTIC_CACHE_MAX_ENTRIES = 512
+
+
+class SemanticCache:
+    """In-memory cache from request embeddings to the knowledge retrieved for them.
+
+    Each entry stores the normalized embedding of a request, the embeddings of the search
+    queries generated for it and the ids of the documents that were selected. A new request
+    whose embedding has cosine similarity of at least threshold with a stored one gets that
+    entry back, so query generation and the index search are skipped. The oldest entries are
+    dropped past max_entries.
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._counter = 0
+        self._matrix = None
+        self._keys = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector):
+        """(query_vectors, document_ids) of the most similar stored request, or None."""
+        vector = self._normalize(vector)
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.vstack([entry[0] for entry in self.entries.values()]) if self.entries else None
+                self._keys = list(self.entries)
+            if self._matrix is not None:
+                similarities = self._matrix @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    _, query_vectors, document_ids = self.entries[self._keys[best]]
+                    return query_vectors, document_ids
+            self.misses += 1
+            return None
+
+    def add(self, vector, query_vectors, document_ids):
+        with self._lock:
+            self.entries[self._counter] = (self._normalize(vector), query_vectors, list(document_ids))
+            self._counter += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._matrix = None  # rebuilt on the next lookup
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+        }
@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+# Polling schedule: never poll more often than MIN_POLL_INTERVAL or less often than MAX_POLL_INTERVAL
+MIN_POLL_INTERVAL = 2.0
+MAX_POLL_INTERVAL = 30.0
+# Rough Transcribe processing speed (seconds of processing per second of audio) and fixed startup cost
+EXPECTED_REALTIME_FACTOR = 0.35
+EXPECTED_STARTUP = 15.0
+JOB_TIMEOUT = 4 * 3600.0
+
+
+class TranscriptionError(Exception):
+    pass
+
+
+class _Job:
+    def __init__(self, job_name, expected_done, deadline):
+        self.job_name = job_name
+        self.future = Future()
+        self.submitted = time.monotonic()
+        self.expected_done = expected_done
+        self.deadline = deadline
+        self.interval = None
+        self.polls = 0
+        self.status = 'QUEUED'
+        self.started_processing = None
+        self.finished = None
+        self.reported_times = None
+
+    def durations(self):
+        """(queue_seconds, processing_seconds) of the job.
+
+        Uses the CreationTime/StartTime/CompletionTime Transcribe reports when available, else the
+        times the poller saw the job change state, which are only as precise as the polls.
+        """
+        if self.reported_times and all(self.reported_times):
+            created, started, completed = self.reported_times
+            return (started - created).total_seconds(), (completed - started).total_seconds()
+        finished = self.finished or time.monotonic()
+        started = self.started_processing or finished
+        return started - self.submitted, finished - started
+
+
+class TranscribeJobManager:
+    """Tracks any number of Transcribe jobs from one background polling thread.
+
+    Each job gets a Future resolving to its TranscriptFileUri, with the job itself (and so its
+    durations()) as future.job. Polls are spaced out while a job
+    is far from its expected completion (estimated from the audio duration), tightened to
+    min_interval around it, and backed off exponentially once it runs late.
+    """
+
+    def __init__(self, client_factory, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                 realtime_factor=EXPECTED_REALTIME_FACTOR, startup=EXPECTED_STARTUP, timeout=JOB_TIMEOUT):
+        self.client_factory = client_factory
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.realtime_factor = realtime_factor
+        self.startup = startup
+        self.timeout = timeout
+        self.jobs = {}
+        self._schedule = []
+        self._counter = itertools.count()
+        self._thread = None
+        self._wakeup = threading.Condition()
+
+    @property
+    def client(self):
+        # Resolved on every call so a replaced shared client takes effect immediately
+        return self.client_factory()
+
+    def expected_processing_time(self, audio_duration):
+        if audio_duration is None:
+            return self.startup
+        return self.startup + audio_duration * self.realtime_factor
+
+    def submit(self, job_name, file_uri, media_format='wav', settings=None, audio_duration=None):
+        self.client.start_transcription_job(
+            TranscriptionJobName=job_name,
+            Media={'MediaFileUri': file_uri},
+            MediaFormat=media_format,
+            IdentifyLanguage=True,
+            Settings=settings or {}
+        )
+        now = time.monotonic()
+        job = _Job(job_name, now + self.expected_processing_time(audio_duration), now + self.timeout)
+        job.interval = self.min_interval
+        job.future.job = job
+        with self._wakeup:
+            self.jobs[job_name] = job
+            self._push(job, self._next_poll(job, now))
+            self._ensure_thread()
+            self._wakeup.notify()
+        return job.future
+
+    def submit_async(self, *args, **kwargs):
+        return asyncio.wrap_future(self.submit(*args, **kwargs))
+
+    def _next_poll(self, job, now):
+        remaining = job.expected_done - now
+        if remaining > 0:
+            # Halve the distance to the expected completion, so polls converge on it
+            delay = min(max(remaining / 2, self.min_interval), self.max_interval)
+        else:
+            delay = job.interval
+            job.interval = min(job.interval * 1.5, self.max_interval)
+        return min(now + delay, job.deadline)
+
+    def _push(self, job, when):
+        heapq.heappush(self._schedule, (when, next(self._counter), job))
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='transcribe-poller', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while not self._schedule:
+                    self._wakeup.wait()
+                when, _, job = self._schedule[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self._wakeup.wait(timeout=delay)
+                    continue
+                heapq.heappop(self._schedule)
+            try:
+                self._poll(job)
+            except Exception as e:
+                # An odd response fails only its own job; the poller keeps serving every other one
+                print(f"Error handling transcription job {job.job_name}: {e}")
+                self._finish(job, error=e)
+
+    def _poll(self, job):
+        if job.future.cancelled():
+            with self._wakeup:
+                self.jobs.pop(job.job_name, None)
+            return
+        now = time.monotonic()
+        try:
+            response = self.client.get_transcription_job(TranscriptionJobName=job.job_name)
+        except Exception as e:
+            # Transient API errors (throttling, network) are retried on the normal schedule
+            print(f"Error polling transcription job {job.job_name}: {e}")
+            response = None
+        job.polls += 1
+
+        if response is not None:
+            transcription_job = response['TranscriptionJob']
+            job.status = transcription_job['TranscriptionJobStatus']
+            if job.status == 'IN_PROGRESS' and job.started_processing is None:
+                job.started_processing = now
+            if job.status in ('COMPLETED', 'FAILED'):
+                job.reported_times = tuple(transcription_job.get(key)
+                                           for key in ('CreationTime', 'StartTime', 'CompletionTime'))
+            if job.status == 'COMPLETED':
+                print(f"Identified language: {transcription_job.get('LanguageCode')}")
+                self._finish(job, result=transcription_job['Transcript']['TranscriptFileUri'])
+                return
+            if job.status == 'FAILED':
+                reason = transcription_job.get('FailureReason', 'unknown reason')
+                self._finish(job, error=TranscriptionError(f"Transcription job {job.job_name} failed: {reason}"))
+                return
+
+        if now >= job.deadline:
+            self._finish(job, error=TimeoutError(f"Transcription job {job.job_name} timed out"))
+            return
+
+        with self._wakeup:
+            self._push(job, self._next_poll(job, now))
+
+    def _finish(self, job, result=None, error=None):
+        with self._wakeup:
+            self.jobs.pop(job.job_name, None)
+        job.finished = time.monotonic()
+        try:
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+        except InvalidStateError:
+            pass  # the caller cancelled the future
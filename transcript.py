@@ -0,0 +1,239 @@
+import re
+import numpy as np
+
+# Start of each '[i. Speaker N | text: ...]' turn produced by diarize_audio, and its fields
+TURN_START = re.compile(r"\n+(?=\[\d+\. )")
+TURN_PATTERN = re.compile(r"\[(\d+)\. (.+?) \| text: (.*?)\]?\s*$", re.S)
+
+
+class Transcript:
+    """A diarized transcript stored as columns: one text buffer plus one array entry per word.
+
+    Words are text[char_starts[i]:char_ends[i]], separated by single spaces in the buffer, so
+    a turn's text is one slice of it. speakers indexes speaker_names (-1 for words before the
+    first labelled one), turns holds each word's turn number (0-based), and start_times,
+    end_times and confidences are NaN where the source had none. Offsets are int32, times
+    float32 and confidences float16, about 24 bytes per word besides the text.
+
+    Word ranges (transcript[a:b], between(), head_tokens(), windows()) are views sharing the
+    buffer and the arrays. for_speaker() gathers the index columns but still shares the text.
+    str() renders the '[i. Speaker N | text: ...]' format of format_transcriptions, keeping
+    the original turn numbers in slices.
+    """
+
+    COLUMNS = ('char_starts', 'char_ends', 'speakers', 'turns', 'start_times', 'end_times', 'confidences')
+
+    def __init__(self, text, speaker_names, char_starts, char_ends, speakers, turns, start_times=None,
+                 end_times=None, confidences=None):
+        missing = np.full(len(char_starts), np.nan, dtype=np.float32)
+        self.text = text
+        self.speaker_names = list(speaker_names)
+        self.char_starts = char_starts
+        self.char_ends = char_ends
+        self.speakers = speakers
+        self.turns = turns
+        self.start_times = missing if start_times is None else start_times
+        self.end_times = missing if end_times is None else end_times
+        self.confidences = missing.astype(np.float16) if confidences is None else confidences
+
+    @classmethod
+    def from_words(cls, words, speaker_ids, speaker_names, start_times=None, end_times=None, confidences=None):
+        """Build from per-word strings and speaker ids; a new turn starts wherever the speaker changes."""
+        lengths = np.fromiter(map(len, words), dtype=np.int32, count=len(words))
+        char_starts = np.zeros(len(words), dtype=np.int32)
+        np.cumsum(lengths[:-1] + 1, out=char_starts[1:])
+        speakers = np.asarray(speaker_ids, dtype=np.int16)
+        turns = np.zeros(len(words), dtype=np.int32)
+        np.cumsum(speakers[1:] != speakers[:-1], out=turns[1:])
+        as_array = lambda values, dtype: None if values is None else np.asarray(values, dtype=dtype)
+        return cls(' '.join(words), speaker_names, char_starts, char_starts + lengths, speakers, turns,
+                   as_array(start_times, np.float32), as_array(end_times, np.float32),
+                   as_array(confidences, np.float16))
+
+    @classmethod
+    def from_transcribe(cls, transcript_data):
+        """Build from Amazon Transcribe JSON, with the speaker rules of extract_transcriptions_with_speakers:
+        punctuation joins the preceding word, unlabelled words stay with the current speaker and
+        speakers are numbered in order of first appearance."""
+        # Imported here because transcription_diarization builds on this module
+        from transcription_diarization import word_speaker_labels
+
+        segments = transcript_data['results']['speaker_labels']['segments']
+        items = transcript_data['results']['items']
+        pronunciations = [item for item in items if item['type'] == 'pronunciation']
+        labels = word_speaker_labels(segments, pronunciations)
+
+        words, start_times, end_times, confidences = [], [], [], []
+        for item in items:
+            alternative = item['alternatives'][0]
+            if item['type'] == 'pronunciation':
+                words.append(alternative['content'])
+                start_times.append(float(item.get('start_time', 'nan')))
+                end_times.append(float(item.get('end_time', 'nan')))
+                confidences.append(float(alternative.get('confidence', 'nan')))
+            elif item['type'] == 'punctuation' and words:
+                words[-1] += alternative['content']
+
+        label_ids, speaker_ids = {}, np.empty(len(labels), dtype=np.int16)
+        for i, label in enumerate(labels):
+            speaker_ids[i] = -1 if label is None else label_ids.setdefault(label, len(label_ids))
+        # Unlabelled words take the speaker of the last labelled word before them
+        last_labelled = np.maximum.accumulate(np.where(speaker_ids >= 0, np.arange(len(labels)), -1))
+        speaker_ids = np.where(last_labelled >= 0, speaker_ids[np.maximum(last_labelled, 0)], -1)
+        speaker_names = [f"Speaker {i + 1}" for i in range(len(label_ids))]
+        return cls.from_words(words, speaker_ids, speaker_names, start_times, end_times, confidences)
+
+    @classmethod
+    def parse(cls, formatted):
+        """Build from the '[i. Speaker N | text: ...]' string, keeping its turn numbers; no times."""
+        words, speaker_ids, turn_numbers, names = [], [], [], {}
+        for turn in TURN_START.split(formatted):
+            match = TURN_PATTERN.match(turn.strip())
+            if not match:
+                continue
+            number, name, text = match.groups()
+            turn_words = text.split()
+            words.extend(turn_words)
+            speaker_ids.extend([names.setdefault(name, len(names))] * len(turn_words))
+            turn_numbers.extend([int(number) - 1] * len(turn_words))
+        transcript = cls.from_words(words, speaker_ids, list(names))
+        transcript.turns = np.asarray(turn_numbers, dtype=np.int32)
+        return transcript
+
+    def _view(self, index):
+        view = object.__new__(Transcript)
+        view.text = self.text
+        view.speaker_names = self.speaker_names
+        for column in self.COLUMNS:
+            setattr(view, column, getattr(self, column)[index])
+        return view
+
+    def __len__(self):
+        return len(self.char_starts)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError("Transcripts are sliced by contiguous word ranges")
+        return self._view(index)
+
+    def __str__(self):
+        return self.render()
+
+    def speaker_name(self, speaker_id):
+        return self.speaker_names[speaker_id] if speaker_id >= 0 else None
+
+    def turn_bounds(self):
+        """First and one-past-last word index of each turn."""
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(self.turns[1:] != self.turns[:-1]) + 1))
+        return starts, np.append(starts[1:], len(self))
+
+    def _turn_spans(self):
+        # (first word, one past last word, turn number, speaker name, text) per turn
+        starts, ends = self.turn_bounds()
+        columns = (starts.tolist(), ends.tolist(), (self.turns[starts] + 1).tolist(), self.speakers[starts].tolist(),
+                   self.char_starts[starts].tolist(), self.char_ends[ends - 1].tolist())
+        for start, end, number, speaker_id, char_start, char_end in zip(*columns):
+            yield start, end, number, self.speaker_name(speaker_id), self.text[char_start:char_end]
+
+    def _rendered_turns(self):
+        for start, end, number, speaker, text in self._turn_spans():
+            yield start, end, f"[{number}. {speaker} | text: {text}]"
+
+    def iter_turns(self):
+        """(turn number, speaker name, text) per turn."""
+        for _, _, number, speaker, text in self._turn_spans():
+            yield number, speaker, text
+
+    def turn_list(self):
+        """[{'speaker', 'text'}] per turn, as extract_transcriptions_with_speakers returns it."""
+        return [{'speaker': speaker, 'text': text} for _, speaker, text in self.iter_turns()]
+
+    def render_turns(self):
+        return [turn for _, _, turn in self._rendered_turns()]
+
+    def render(self):
+        return '\n'.join(turn + "\n" for turn in self.render_turns())
+
+    def between(self, start_time, end_time):
+        """Words spoken within [start_time, end_time] seconds; times must be ascending."""
+        if len(self) and np.isnan(self.start_times[0]):
+            raise ValueError("This transcript has no word times")
+        lo = np.searchsorted(self.start_times, start_time, side='left')
+        hi = np.searchsorted(self.end_times, end_time, side='right')
+        return self[lo:max(lo, hi)]
+
+    def for_speaker(self, speaker):
+        """Words of one speaker, given by name or id."""
+        speaker_id = self.speaker_names.index(speaker) if isinstance(speaker, str) else speaker
+        return self._view(np.flatnonzero(self.speakers == speaker_id))
+
+    def speaker_tokens(self, count_tokens):
+        """Tokens spoken per speaker, in order of first appearance."""
+        weights = {}
+        for _, speaker, text in self.iter_turns():
+            weights[speaker] = weights.get(speaker, 0) + count_tokens(text)
+        return weights
+
+    def _fit_turn(self, start, end, max_tokens, count_tokens):
+        # Longest head of one turn whose rendering fits in max_tokens, by bisection over words
+        lo, hi = 1, end - start
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if count_tokens(self[start:start + mid].render_turns()[0]) <= max_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        return start + lo
+
+    def head_tokens(self, max_tokens, count_tokens):
+        """Leading whole turns within max_tokens (each turn costs one more token for its separator),
+        or the head of the first turn if even that does not fit; as truncate_text does for strings."""
+        used_tokens, kept_ends = 0, []
+        for start, end, turn in self._rendered_turns():
+            turn_tokens = count_tokens(turn) + 1
+            if used_tokens + turn_tokens > max_tokens:
+                if not kept_ends:
+                    return self[:self._fit_turn(start, end, max_tokens, count_tokens)]
+                break
+            used_tokens += turn_tokens
+            kept_ends.append(end)
+        while len(kept_ends) > 1 and count_tokens(self[:kept_ends[-1]].render()) > max_tokens:
+            kept_ends.pop()
+        return self[:kept_ends[-1] if kept_ends else 0]
+
+    def windows(self, window_tokens, count_tokens):
+        """Consecutive turns grouped into views of at most window_tokens tokens, as split_windows
+        does for strings. A turn longer than a whole window gets a window of its own, cut to fit."""
+        windows, window_start, used_tokens = [], None, 0
+        for start, end, turn in self._rendered_turns():
+            turn_tokens = count_tokens(turn) + 1
+            if window_start is not None and (turn_tokens > window_tokens or used_tokens + turn_tokens > window_tokens):
+                windows.append(self[window_start:start])
+                window_start, used_tokens = None, 0
+            if turn_tokens > window_tokens:
+                windows.append(self[start:self._fit_turn(start, end, window_tokens - 1, count_tokens)])
+                continue
+            if window_start is None:
+                window_start = start
+            used_tokens += turn_tokens
+        if window_start is not None:
+            windows.append(self[window_start:])
+        return windows
+
+    def save(self, path):
+        """Write the columns to an uncompressed .npz file."""
+        np.savez(path, text=np.frombuffer(self.text.encode('utf-8'), dtype=np.uint8),
+                 speaker_names=np.array(self.speaker_names, dtype=str),
+                 **{column: getattr(self, column) for column in self.COLUMNS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['text'].tobytes().decode('utf-8'), data['speaker_names'].tolist(),
+                       *(data[column] for column in cls.COLUMNS))
+
+    def nbytes(self):
+        """Approximate memory held by the columns and the text buffer."""
+        return len(self.text) + sum(getattr(self, column).nbytes for column in self.COLUMNS)
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+TRANSCRIPT_CACHE_DIR = os.path.join('.cache', 'transcripts')
+TRANSCRIPT_CACHE_MAX_BYTES = 512 * 2**20
+
+
+def hash_file(file_path, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TranscriptCache:
+    """Disk cache of Transcribe results keyed by audio content and transcription settings.
+
+    Each entry is one JSON file holding the raw transcript and the formatted speaker text.
+    File mtimes track recency, and the least recently used entries are evicted once the
+    cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir=TRANSCRIPT_CACHE_DIR, max_bytes=TRANSCRIPT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key_for(self, audio_path, settings):
+        return self.key_for_hash(hash_file(audio_path), settings)
+
+    def key_for_hash(self, audio_hash, settings):
+        settings_json = json.dumps(settings, sort_keys=True)
+        return hashlib.sha256(f"{audio_hash}:{settings_json}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    entry = json.load(file)
+                os.utime(path)  # mark as recently used
+                self.hits += 1
+                return entry
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+
+    def put(self, key, transcript_data, formatted):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'transcript': transcript_data, 'formatted': formatted, 'created': time.time()}, file)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, name in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                os.remove(os.path.join(self.cache_dir, name))
+                total_bytes -= size
+
+    def stats(self):
+        entries = self._entries() if os.path.isdir(self.cache_dir) else []
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+
+transcript_cache = TranscriptCache()
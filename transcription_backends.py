@@ -0,0 +1,263 @@
+import os
+import re
+import threading
+import time
+import wave
+import numpy as np
+from instrumentation import record
+from transcription_diarization import TRANSCRIBE_SETTINGS, audio_duration, media_format, transcribe_file, upload_progress
+
+# Backend used when a request does not pick one. 'local' is experimental: its speaker clustering
+# has not been validated on real recordings (see SPEAKER_DISTANCE_THRESHOLD), so keep 'aws' as the
+# default until 'benchmark.py rtf --speakers N' on such a recording gives acceptable speaker counts
+DEFAULT_TRANSCRIPTION_BACKEND = os.environ.get('TRANSCRIPTION_BACKEND', 'aws')
+
+# faster-whisper model: a size name ('tiny', 'base', 'small', ...) or a directory of CTranslate2 files
+LOCAL_WHISPER_MODEL = os.environ.get('LOCAL_WHISPER_MODEL', 'base')
+LOCAL_WHISPER_COMPUTE_TYPE = 'int8'
+# Segments closer than this cosine distance are merged into one speaker; it suits voice_embedding,
+# so a custom embed function usually needs its own. The default has only been checked on synthetic
+# audio, not on real recordings; 'benchmark.py rtf --speakers N --thresholds ...' on a recording
+# with a known number of speakers shows which value to set here or in the environment
+SPEAKER_DISTANCE_THRESHOLD = float(os.environ.get('SPEAKER_DISTANCE_THRESHOLD', 0.05))
+# Segments shorter than this are too short for a reliable voice embedding; they join the nearest speaker
+MIN_EMBEDDING_SECONDS = 1.0
+MEL_BANDS = 40
+PUNCTUATION = re.compile(r"^(.*?\w)([.,!?;:]+)$")
+
+
+class TranscriptionBackend:
+    """Turns a WAV file into a diarized transcript in the Amazon Transcribe JSON shape.
+
+    Every backend's output goes through extract_transcriptions_with_speakers, the transcript
+    cache and the checkpoints unchanged. settings() is part of the transcript cache key.
+    """
+
+    name = None
+
+    def settings(self, wav_path, long_recording=None):
+        raise NotImplementedError
+
+    def transcribe(self, wav_path, job_dir, settings, job_name, progress=None, checkpoint=None):
+        """Transcript JSON for wav_path, or None if transcription failed."""
+        raise NotImplementedError
+
+
+class AWSTranscribeBackend(TranscriptionBackend):
+    """S3 upload and an Amazon Transcribe job; long WAV recordings are transcribed in parallel chunks."""
+
+    name = 'aws'
+
+    def settings(self, wav_path, long_recording=None):
+        # Imported here because chunked_transcription builds on transcription_diarization
+        import chunked_transcription
+
+        if long_recording is None:
+            duration = audio_duration(wav_path)
+            long_recording = (media_format(wav_path) == 'wav' and duration is not None
+                              and duration > chunked_transcription.LONG_RECORDING_SECONDS)
+        settings = {'IdentifyLanguage': True, **TRANSCRIBE_SETTINGS}
+        if long_recording:
+            settings.update(chunk_seconds=chunked_transcription.CHUNK_SECONDS,
+                            overlap=chunked_transcription.CHUNK_OVERLAP_SECONDS)
+        return settings
+
+    def transcribe(self, wav_path, job_dir, settings, job_name, progress=None, checkpoint=None):
+        import chunked_transcription
+
+        if 'chunk_seconds' in settings:
+            chunks_dir = os.path.join(job_dir, 'chunks')
+            os.makedirs(chunks_dir, exist_ok=True)
+            return chunked_transcription.transcribe_long_audio(wav_path, chunks_dir, job_prefix=job_name)
+        return transcribe_file(wav_path, job_name, progress_callback=upload_progress(progress), checkpoint=checkpoint)
+
+
+def read_wav(wav_path):
+    """Mono float32 samples in [-1, 1] and the sample rate of a 16-bit PCM WAV."""
+    with wave.open(wav_path, 'rb') as wav_file:
+        channels = wav_file.getnchannels()
+        sample_rate = wav_file.getframerate()
+        samples = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+    samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+    return (samples / 32768.0).astype(np.float32), sample_rate
+
+
+def mel_filterbank(sample_rate, n_fft, n_bands=MEL_BANDS):
+    to_mel = lambda hz: 2595 * np.log10(1 + hz / 700)
+    to_hz = lambda mel: 700 * (10 ** (mel / 2595) - 1)
+    edges = to_hz(np.linspace(to_mel(60), to_mel(sample_rate / 2), n_bands + 2))
+    bins = np.fft.rfftfreq(n_fft, 1 / sample_rate)
+    lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (bins - lower) / (center - lower)
+    falling = (upper - bins) / (upper - center)
+    return np.maximum(0, np.minimum(rising, falling)).astype(np.float32)
+
+
+def voice_embedding(samples, sample_rate, n_bands=MEL_BANDS):
+    """Mean and standard deviation of log-mel energies over 25 ms frames: a small, dependency-free
+    voice print that separates speakers with clearly different voices. Each frame is normalized
+    by its mean energy, so how loud or close to the microphone someone is does not count."""
+    frame, hop = int(0.025 * sample_rate), int(0.010 * sample_rate)
+    if len(samples) < frame:
+        samples = np.pad(samples, (0, frame - len(samples)))
+    n_frames = 1 + (len(samples) - frame) // hop
+    frames = np.lib.stride_tricks.as_strided(samples, (n_frames, frame), (samples.strides[0] * hop, samples.strides[0]))
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame).astype(np.float32), axis=1)) ** 2
+    log_mel = np.log(spectrum @ mel_filterbank(sample_rate, frame, n_bands).T + 1e-8)
+    log_mel -= log_mel.mean(axis=1, keepdims=True)
+    return np.concatenate([log_mel.mean(axis=0), log_mel.std(axis=0)])
+
+
+def cluster_speakers(embeddings, weights, max_speakers, threshold=SPEAKER_DISTANCE_THRESHOLD):
+    """Speaker index per embedding, by agglomerative clustering on centroid cosine distance.
+
+    Clusters merge while their closest pair is within threshold, and keep merging past it
+    until at most max_speakers remain. Labels are numbered in order of first appearance.
+    """
+    n = len(embeddings)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    vectors = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-8)
+    weights = np.asarray(weights, dtype=np.float64).copy()
+    centroids = vectors.copy()
+    parent = np.arange(n)
+    active = np.ones(n, dtype=bool)
+    similarity = centroids @ centroids.T
+    np.fill_diagonal(similarity, -np.inf)
+
+    while active.sum() > 1:
+        i, j = np.unravel_index(np.argmax(similarity), similarity.shape)
+        if 1 - similarity[i, j] > threshold and active.sum() <= max_speakers:
+            break
+        merged = weights[i] * centroids[i] + weights[j] * centroids[j]
+        centroids[i] = merged / max(np.linalg.norm(merged), 1e-8)
+        weights[i] += weights[j]
+        parent[parent == j] = i
+        active[j] = False
+        similarity[j, :] = similarity[:, j] = -np.inf
+        row = np.where(active, centroids @ centroids[i], -np.inf)
+        row[i] = -np.inf
+        similarity[i, :] = similarity[:, i] = row
+
+    _, labels = np.unique(parent, return_inverse=True)
+    order = {label: k for k, label in enumerate(dict.fromkeys(labels.tolist()))}
+    return np.array([order[label] for label in labels.tolist()], dtype=np.int64)
+
+
+def whisper_transcript(segments, labels):
+    """Transcribe-shaped JSON from faster-whisper segments (with word timestamps) and a speaker per segment."""
+    items, speaker_segments = [], []
+    for segment, label in zip(segments, labels):
+        speaker_label = f"spk_{label}"
+        speaker_segments.append({'speaker_label': speaker_label, 'start_time': f"{segment.start:.3f}",
+                                 'end_time': f"{segment.end:.3f}"})
+        for word in segment.words or []:
+            text = word.word.strip()
+            if not text:
+                continue
+            match = PUNCTUATION.match(text)
+            content, punctuation = match.groups() if match else (text, None)
+            items.append({'type': 'pronunciation', 'start_time': f"{word.start:.3f}", 'end_time': f"{word.end:.3f}",
+                          'speaker_label': speaker_label,
+                          'alternatives': [{'content': content, 'confidence': f"{word.probability:.4f}"}]})
+            if punctuation:
+                items.append({'type': 'punctuation', 'alternatives': [{'content': punctuation}]})
+    return {'results': {'speaker_labels': {'segments': speaker_segments}, 'items': items}}
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """faster-whisper (CTranslate2) transcription on the CPU with voice-activity detection,
+    followed by speaker clustering of per-segment voice embeddings. No network access needed
+    once the model files are present.
+
+    embed(samples, sample_rate) -> vector can replace the built-in log-mel voice_embedding,
+    e.g. with a neural speaker encoder. The model is loaded on first use and shared.
+
+    Experimental: speaker separation is only checked on synthetic audio so far.
+    """
+
+    name = 'local'
+
+    def __init__(self, model=LOCAL_WHISPER_MODEL, compute_type=LOCAL_WHISPER_COMPUTE_TYPE, cpu_threads=0,
+                 vad_filter=True, max_speakers=TRANSCRIBE_SETTINGS['MaxSpeakerLabels'],
+                 distance_threshold=SPEAKER_DISTANCE_THRESHOLD, embed=voice_embedding):
+        self.model = model
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self.vad_filter = vad_filter
+        self.max_speakers = max_speakers
+        self.distance_threshold = distance_threshold
+        self.embed = embed
+        self._whisper = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._whisper is None:
+                try:
+                    from faster_whisper import WhisperModel
+                except ImportError as e:
+                    raise RuntimeError("The local transcription backend needs the faster-whisper package") from e
+                start_time = time.perf_counter()
+                self._whisper = WhisperModel(self.model, device='cpu', compute_type=self.compute_type,
+                                             cpu_threads=self.cpu_threads)
+                record('load_whisper_model', time.perf_counter() - start_time)
+            return self._whisper
+
+    def settings(self, wav_path, long_recording=None):
+        return {'backend': self.name, 'model': os.path.basename(os.path.normpath(self.model)),
+                'vad': self.vad_filter, 'MaxSpeakerLabels': self.max_speakers,
+                'distance_threshold': self.distance_threshold}
+
+    def transcribe(self, wav_path, job_dir, settings, job_name, progress=None, checkpoint=None):
+        whisper = self.load()
+        start_time = time.perf_counter()
+        segment_iter, info = whisper.transcribe(wav_path, word_timestamps=True, vad_filter=self.vad_filter)
+        segments = []
+        for segment in segment_iter:  # decoding happens as the generator is consumed
+            segments.append(segment)
+            if progress and info.duration:
+                progress(min(segment.end / info.duration, 1.0), f"Transcribing locally ({segment.end:.0f}/{info.duration:.0f} s)")
+        record('transcribe_local', time.perf_counter() - start_time, audio_seconds=info.duration)
+
+        start_time = time.perf_counter()
+        labels = self.diarize(wav_path, segments)
+        record('cluster_speakers', time.perf_counter() - start_time)
+        return whisper_transcript(segments, labels)
+
+    def diarize(self, wav_path, segments):
+        if not segments:
+            return []
+        samples, sample_rate = read_wav(wav_path)
+        durations = np.array([segment.end - segment.start for segment in segments])
+        embeddings = np.stack([self.embed(samples[int(segment.start * sample_rate):int(segment.end * sample_rate)],
+                                          sample_rate) for segment in segments])
+        reliable = np.flatnonzero(durations >= MIN_EMBEDDING_SECONDS)
+        if len(reliable) == 0:
+            reliable = np.arange(len(segments))
+        labels = np.empty(len(segments), dtype=np.int64)
+        labels[reliable] = cluster_speakers(embeddings[reliable], durations[reliable], self.max_speakers,
+                                            self.distance_threshold)
+        # Short segments take the speaker of the closest reliable segment in embedding space
+        short = np.setdiff1d(np.arange(len(segments)), reliable)
+        if len(short):
+            normalized = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-8)
+            nearest = np.argmax(normalized[short] @ normalized[reliable].T, axis=1)
+            labels[short] = labels[reliable][nearest]
+        return labels.tolist()
+
+
+TRANSCRIPTION_BACKENDS = {
+    'aws': AWSTranscribeBackend(),
+    'local': LocalWhisperBackend(),
+}
+
+
+def get_backend(backend=None):
+    """A TranscriptionBackend, given one, its name, or None for DEFAULT_TRANSCRIPTION_BACKEND."""
+    if isinstance(backend, TranscriptionBackend):
+        return backend
+    name = backend or DEFAULT_TRANSCRIPTION_BACKEND
+    if name not in TRANSCRIPTION_BACKENDS:
+        raise ValueError(f"Unknown transcription backend: {name}")
+    return TRANSCRIPTION_BACKENDS[name]
@@ -1,16 +1,114 @@
-import boto3
 import time
+import hashlib
 import json
 import os
+import shutil
+import subprocess
+import tempfile
 import urllib.parse
+import uuid
+import threading
+import wave
+import numpy as np
 from moviepy.editor import VideoFileClip
 import requests
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
-from config import aws_access_key_id, aws_secret_access_key
+from aws_clients import get_client
+from instrumentation import record, timed
+from transcript import Transcript
+from transcript_cache import transcript_cache
+from transcribe_jobs import TranscribeJobManager
+
+# Audio extraction settings: Transcribe works on 16 kHz mono, so anything more is wasted upload
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_CHANNELS = 1
+AUDIO_FORMAT = 'wav'
+
+# Transcribe job settings; also part of the transcript cache key
+TRANSCRIBE_SETTINGS = {
+    'ShowSpeakerLabels': True,
+    'MaxSpeakerLabels': 4
+}
+
+# ffmpeg output arguments per supported format; the key doubles as the Transcribe MediaFormat
+AUDIO_CODECS = {
+    'wav': ['-c:a', 'pcm_s16le', '-f', 'wav'],
+    'flac': ['-c:a', 'flac', '-f', 'flac'],
+    'ogg': ['-c:a', 'libopus', '-b:a', '32k', '-f', 'ogg'],
+}
+
+# Amazon Transcribe list price per minute of audio (standard tier), for cost estimates
+TRANSCRIBE_PRICE_PER_MINUTE = 0.024
+
+# Multipart upload tuning: parts are sent in parallel over the shared client's connection pool
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 2**20,
+    multipart_chunksize=8 * 2**20,
+    max_concurrency=10,
+    use_threads=True
+)
+
+# Reused for transcript downloads so repeated requests keep their HTTPS connection
+http_session = requests.Session()
+
+def get_ffmpeg_exe():
+    try:
+        # moviepy depends on imageio-ffmpeg, which ships a static ffmpeg binary
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return shutil.which('ffmpeg') or 'ffmpeg'
+
+def media_format(audio_path):
+    return os.path.splitext(audio_path)[1].lstrip('.').lower()
+
+# Returned by diarize_audio in place of a transcript when a stage fails
+FAILED_TRANSCRIPTIONS = ("Audio conversion failed.", "Transcription failed.")
+
+def convert_to_wav(video_path, output_dir=None, audio_format=AUDIO_FORMAT,
+                   sample_rate=AUDIO_SAMPLE_RATE, channels=AUDIO_CHANNELS):
+    """Extract only the audio stream of video_path, resampled to mono 16 kHz by default.
+
+    ffmpeg demuxes the audio track and resamples while streaming, so no video frames are
+    decoded and memory stays bounded regardless of recording length. The output is written
+    to output_dir, or to a fresh per-job temp directory that the caller removes. If extraction
+    fails, a temp directory created here is removed before returning None.
+    """
+    if audio_format not in AUDIO_CODECS:
+        raise ValueError(f"Unsupported audio format: {audio_format}")
 
-def convert_to_wav(video_path):
     base_name = os.path.splitext(os.path.basename(video_path))[0]
-    output_path = f"{base_name}.wav"
+    created_dir = not output_dir
+    output_dir = output_dir or tempfile.mkdtemp(prefix='audio_')
+    output_path = os.path.join(output_dir, f"{base_name}.{audio_format}")
+
+    command = [get_ffmpeg_exe(), '-nostdin', '-y', '-loglevel', 'error',
+               '-i', video_path, '-vn', '-sn', '-dn',
+               '-ac', str(channels), '-ar', str(sample_rate),
+               # bitexact keeps encoder tags out of the output so identical audio hashes identically
+               '-fflags', '+bitexact', '-flags:a', '+bitexact',
+               *AUDIO_CODECS[audio_format], output_path]
+    try:
+        with timed('convert_to_wav') as metrics:
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            metrics['bytes'] = os.path.getsize(output_path)
+        return output_path
+    except subprocess.CalledProcessError as e:
+        print(f"Error during audio conversion: {e.stderr.decode(errors='replace').strip()}")
+        if created_dir:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        return None
+    except Exception as e:
+        print(f"Error during audio conversion: {str(e)}")
+        if created_dir:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        return None
+
+def convert_to_wav_moviepy(video_path, output_dir='.'):
+    # Original full-decode path, kept for benchmarking against the streaming extraction
+    base_name = os.path.splitext(os.path.basename(video_path))[0]
+    output_path = os.path.join(output_dir, f"{base_name}.wav")
     
     try:
         video = VideoFileClip(video_path)
@@ -27,133 +125,305 @@ def convert_to_wav(video_path):
         print(f"Error during audio conversion: {str(e)}")
         return None
 
-def upload_to_s3(local_file_path, bucket_name, s3_file_key):
-    s3_client = boto3.client('s3',
-                             aws_access_key_id=aws_access_key_id,
-                             aws_secret_access_key=aws_secret_access_key,
-                             region_name='eu-central-1')
-    s3_client.upload_file(local_file_path, bucket_name, s3_file_key)
+class UploadProgress:
+    """boto3 transfer Callback that accumulates bytes sent across parallel parts."""
+
+    def __init__(self, callback, total_bytes=None):
+        self.callback = callback
+        self.total_bytes = total_bytes
+        self.sent_bytes = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.sent_bytes += bytes_amount
+            sent_bytes = self.sent_bytes
+        self.callback(sent_bytes, self.total_bytes)
+
+def upload_to_s3(local_file_path, bucket_name, s3_file_key, progress_callback=None,
+                 transfer_config=S3_TRANSFER_CONFIG):
+    """Multipart upload through the shared S3 client; progress_callback(sent_bytes, total_bytes)."""
+    s3_client = get_client('s3')
+    total_bytes = os.path.getsize(local_file_path)
+    callback = UploadProgress(progress_callback, total_bytes) if progress_callback else None
+    with timed('upload_to_s3', bytes=total_bytes):
+        s3_client.upload_file(local_file_path, bucket_name, s3_file_key, Config=transfer_config, Callback=callback)
     return f's3://{bucket_name}/{s3_file_key}'
 
-def transcribe_audio(file_uri, job_name):
-    transcribe = boto3.client('transcribe',
-                              aws_access_key_id=aws_access_key_id,
-                              aws_secret_access_key=aws_secret_access_key,
-                              region_name='eu-central-1')
-
-    transcribe.start_transcription_job(
-        TranscriptionJobName=job_name,
-        Media={'MediaFileUri': file_uri},
-        MediaFormat='wav',
-        IdentifyLanguage=True,
-        Settings={
-            'ShowSpeakerLabels': True,
-            'MaxSpeakerLabels': 4
-        }
-    )
-
-    while True:
-        status = transcribe.get_transcription_job(TranscriptionJobName=job_name)
-        if status['TranscriptionJob']['TranscriptionJobStatus'] in ['COMPLETED', 'FAILED']:
-            break
-        time.sleep(30)
-
-    if status['TranscriptionJob']['TranscriptionJobStatus'] == 'COMPLETED':
-        identified_language = status['TranscriptionJob']['LanguageCode']
-        print(f"Identified language: {identified_language}")
-        return status['TranscriptionJob']['Transcript']['TranscriptFileUri']
-    else:
-        print('Transcription Job returned None')
+class HashingReader:
+    """File-like wrapper that hashes and counts everything read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.bytes_read += len(data)
+        return data
+
+def stream_audio_to_s3(video_path, bucket_name, s3_file_key, audio_format='flac', progress_callback=None,
+                       transfer_config=S3_TRANSFER_CONFIG, sample_rate=AUDIO_SAMPLE_RATE, channels=AUDIO_CHANNELS):
+    """Pipe ffmpeg's audio output straight into a multipart upload without an intermediate file.
+
+    Returns the S3 URI and the SHA-256 of the uploaded audio. WAV is not supported because its
+    header sizes cannot be filled in on a non-seekable pipe.
+    """
+    if audio_format not in ('flac', 'ogg'):
+        raise ValueError(f"Unsupported streaming audio format: {audio_format}")
+
+    command = [get_ffmpeg_exe(), '-nostdin', '-loglevel', 'error',
+               '-i', video_path, '-vn', '-sn', '-dn',
+               '-ac', str(channels), '-ar', str(sample_rate),
+               '-fflags', '+bitexact', '-flags:a', '+bitexact',
+               *AUDIO_CODECS[audio_format], 'pipe:1']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    reader = HashingReader(process.stdout)
+    callback = UploadProgress(progress_callback) if progress_callback else None
+    try:
+        get_client('s3').upload_fileobj(reader, bucket_name, s3_file_key, Config=transfer_config, Callback=callback)
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"Error during audio conversion: {stderr.decode(errors='replace').strip()}")
+    return f's3://{bucket_name}/{s3_file_key}', reader.digest.hexdigest()
+
+# One background poller shared by every in-flight transcription job
+transcribe_job_manager = TranscribeJobManager(lambda: get_client('transcribe'))
+
+def audio_duration(audio_path):
+    """Duration in seconds read from the WAV/FLAC header, or None for other formats."""
+    try:
+        if media_format(audio_path) == 'wav':
+            with wave.open(audio_path, 'rb') as wav_file:
+                return wav_file.getnframes() / wav_file.getframerate()
+        if media_format(audio_path) == 'flac':
+            with open(audio_path, 'rb') as flac_file:
+                header = flac_file.read(42)
+            # STREAMINFO follows the 'fLaC' marker and a 4-byte block header
+            streaminfo = header[8:]
+            sample_rate = (streaminfo[10] << 12) | (streaminfo[11] << 4) | (streaminfo[12] >> 4)
+            total_samples = ((streaminfo[13] & 0x0F) << 32) | int.from_bytes(streaminfo[14:18], 'big')
+            return total_samples / sample_rate
+    except Exception as e:
+        print(f"Error reading audio duration: {e}")
+    return None
+
+def transcribe_audio(file_uri, job_name, media_format='wav', audio_duration=None):
+    future = transcribe_job_manager.submit(job_name, file_uri, media_format=media_format,
+                                           settings=TRANSCRIBE_SETTINGS, audio_duration=audio_duration)
+    try:
+        # The poller fails the job at its deadline; the margin only guards against a stalled poller
+        return future.result(timeout=future.job.deadline - time.monotonic() + transcribe_job_manager.max_interval)
+    except Exception as e:
+        print(f'Transcription Job returned None: {e!r}')
         return None
+    finally:
+        queue_seconds, processing_seconds = future.job.durations()
+        record('transcribe_queue', queue_seconds)
+        cost = TRANSCRIBE_PRICE_PER_MINUTE * max(audio_duration, 15) / 60 if audio_duration else 0.0
+        record('transcribe_processing', processing_seconds, audio_seconds=audio_duration, cost_usd=cost)
 
 def download_transcript(transcript_url):
     try:
-        response = requests.get(transcript_url)
-        response.raise_for_status()
+        with timed('download_transcript') as metrics:
+            response = http_session.get(transcript_url)
+            response.raise_for_status()
+            metrics['bytes'] = len(response.content)
         return json.loads(response.text)
     except Exception as e:
         print(f"Error downloading transcript: {e}")
         return None
 
+def parse_times(records):
+    # Transcribe stores timestamps as strings; parse them once into float arrays
+    starts = np.fromiter((float(r['start_time']) for r in records), dtype=np.float64, count=len(records))
+    ends = np.fromiter((float(r['end_time']) for r in records), dtype=np.float64, count=len(records))
+    return starts, ends
+
+def assign_segments(word_starts, word_ends, seg_starts, seg_ends, block_size=4096):
+    """Index of the first segment (in list order) that fully contains each word, or -1."""
+    if len(seg_starts) == 0:
+        return np.full(len(word_starts), -1, dtype=np.int64)
+
+    if np.all(np.diff(seg_starts) >= 0) and np.all(np.diff(seg_ends) >= 0):
+        # Sorted segments: those starting before the word are [0, hi) and those ending after
+        # it are [lo, n), so the first containing segment is lo whenever lo < hi
+        hi = np.searchsorted(seg_starts, word_starts, side='right')
+        lo = np.searchsorted(seg_ends, word_ends, side='left')
+        return np.where(lo < hi, lo, -1)
+
+    # Unordered segments: exact first-match via blocked broadcasting
+    assigned = np.full(len(word_starts), -1, dtype=np.int64)
+    for i in range(0, len(word_starts), block_size):
+        ws = word_starts[i:i + block_size, None]
+        we = word_ends[i:i + block_size, None]
+        mask = (seg_starts[None, :] <= ws) & (seg_ends[None, :] >= we)
+        first = mask.argmax(axis=1)
+        assigned[i:i + block_size] = np.where(mask.any(axis=1), first, -1)
+    return assigned
+
+def word_speaker_labels(segments, pronunciations):
+    # Fast path: newer Transcribe output labels every item directly
+    if pronunciations and all('speaker_label' in item for item in pronunciations):
+        return [item['speaker_label'] for item in pronunciations]
+
+    seg_starts, seg_ends = parse_times(segments)
+    word_starts, word_ends = parse_times(pronunciations)
+    assigned = assign_segments(word_starts, word_ends, seg_starts, seg_ends)
+    return [segments[i]['speaker_label'] if i >= 0 else None for i in assigned.tolist()]
+
 def extract_transcriptions_with_speakers(transcript_data):
-    segments = transcript_data['results']['speaker_labels']['segments']
-    items = transcript_data['results']['items']
-    
-    current_speaker = None
-    current_text = []
-    transcriptions = []
-    
-    speaker_mapping = {}
-    speaker_count = 0
-
-    for item in items:
-        if item['type'] == 'pronunciation':
-            start_time = float(item['start_time'])
-            end_time = float(item['end_time'])
-            content = item['alternatives'][0]['content']
-
-            speaker_segment = next((seg for seg in segments if float(seg['start_time']) <= start_time and float(seg['end_time']) >= end_time), None)
-
-            if speaker_segment:
-                speaker_label = speaker_segment['speaker_label']
-                
-                # Map speaker labels to sequential numbers starting from 1
-                if speaker_label not in speaker_mapping:
-                    speaker_count += 1
-                    speaker_mapping[speaker_label] = f"Speaker {speaker_count}"
-                
-                if speaker_mapping[speaker_label] != current_speaker:
-                    if current_text:
-                        transcriptions.append({
-                            'speaker': current_speaker,
-                            'text': ' '.join(current_text)
-                        })
-                        current_text = []
-                    current_speaker = speaker_mapping[speaker_label]
-
-            current_text.append(content)
-        elif item['type'] == 'punctuation':
-            current_text[-1] += item['alternatives'][0]['content']
-
-    if current_text:
-        transcriptions.append({
-            'speaker': current_speaker,
-            'text': ' '.join(current_text)
-        })
-
-    return transcriptions
-
-def diarize_audio(video_path):
-    # Convert video to WAV audio
-    wav_path = convert_to_wav(video_path)
-    
-    if not wav_path:
+    return Transcript.from_transcribe(transcript_data).turn_list()
+
+def format_transcriptions(transcriptions):
+    output = []
+    for i, trans in enumerate(transcriptions, 1):
+        output.append(f"[{i}. {trans['speaker']} | text: {trans['text']}]\n")
+    return '\n'.join(output)
+
+def transcribe_file(audio_path, job_name, progress_callback=None, checkpoint=None):
+    """Upload one audio file, run a Transcribe job on it and return the transcript JSON (or None).
+
+    With a checkpoints.RunCheckpoint, an upload finished by an earlier attempt is reused.
+    """
+    file_uri = checkpoint.load('s3_uri') if checkpoint else None
+    if file_uri is None:
+        bucket_name = 'transcriptionjobbucket'
+        s3_file_key = f"{job_name}/{os.path.basename(audio_path)}"
+        file_uri = upload_to_s3(audio_path, bucket_name, s3_file_key, progress_callback=progress_callback)
+        if checkpoint:
+            checkpoint.save('s3_uri', file_uri)
+
+    transcript_url = transcribe_audio(file_uri, job_name, media_format=media_format(audio_path),
+                                      audio_duration=audio_duration(audio_path))
+
+    print('transcript url:', transcript_url)
+
+    if not transcript_url:
+        return None
+    return download_transcript(transcript_url)
+
+def upload_progress(progress):
+    """Adapt a progress(fraction, desc) callable into an UploadProgress callback."""
+    def callback(sent_bytes, total_bytes):
+        if total_bytes:
+            progress(sent_bytes / total_bytes, f"Uploading audio ({sent_bytes / 2**20:.1f}/{total_bytes / 2**20:.1f} MB)")
+        else:
+            progress(None, f"Uploading audio ({sent_bytes / 2**20:.1f} MB)")
+    return callback if progress else None
+
+def diarize_audio(video_path, audio_format=AUDIO_FORMAT, use_cache=True, long_recording=None,
+                  stream_upload=False, progress=None, backend=None):
+    """Transcribe and diarize video_path into '[i. Speaker N | text: ...]' lines.
+
+    long_recording=None switches to chunked, parallel transcription for WAV audio longer than
+    chunked_transcription.LONG_RECORDING_SECONDS; True or False forces either mode.
+    stream_upload=True pipes the extracted audio straight to S3 (FLAC unless audio_format is
+    'ogg'); the transcript cache is then checked after the upload instead of before it.
+    progress(fraction, desc) receives upload progress.
+    backend picks the transcription backend by name ('aws' or 'local', see transcription_backends);
+    long_recording and stream_upload only apply to 'aws'.
+    """
+    from transcription_backends import get_backend
+
+    backend = get_backend(backend)
+    if stream_upload and backend.name == 'aws':
+        return _diarize_streamed(video_path, 'ogg' if audio_format == 'ogg' else 'flac', use_cache, progress)
+
+    if long_recording or backend.name != 'aws':
+        audio_format = 'wav'
+
+    # Extract the audio track into a per-job temp directory
+    job_dir = tempfile.mkdtemp(prefix='diarize_')
+    try:
+        wav_path = convert_to_wav(video_path, output_dir=job_dir, audio_format=audio_format)
+
+        if not wav_path:
+            return "Audio conversion failed."
+
+        return transcribe_audio_file(wav_path, job_dir, use_cache, long_recording, progress, backend=backend)
+    finally:
+        # Clean up: remove the temporary audio directory
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+def transcribe_audio_file(wav_path, job_dir, use_cache=True, long_recording=None, progress=None, checkpoint=None,
+                          backend=None):
+    """The part of diarize_audio after audio extraction; job_dir receives any chunk files.
+
+    backend is a transcription_backends.TranscriptionBackend or its name ('aws', 'local');
+    None uses DEFAULT_TRANSCRIPTION_BACKEND. With a checkpoints.RunCheckpoint, the S3 URI,
+    transcript JSON and formatted transcript are recorded as they complete, and a retry
+    resumes after the last of them.
+    """
+    # Imported here because transcription_backends builds on this module
+    from transcription_backends import get_backend
+
+    if checkpoint and checkpoint.has('formatted_transcript'):
+        return checkpoint.load('formatted_transcript')
+
+    backend = get_backend(backend)
+    settings = backend.settings(wav_path, long_recording)
+
+    # Identical audio with identical settings yields the same transcript, so skip transcription
+    if use_cache:
+        cache_key = transcript_cache.key_for(wav_path, settings)
+        cached = transcript_cache.get(cache_key)
+        print('transcript cache:', transcript_cache.stats())
+        if cached is not None:
+            return cached['formatted']
+
+    job_name = f'transcription_job_{int(time.time())}_{uuid.uuid4().hex[:8]}'
+    transcript_data = checkpoint.load('transcript_json') if checkpoint else None
+    if transcript_data is None:
+        transcript_data = backend.transcribe(wav_path, job_dir, settings, job_name, progress, checkpoint)
+        if checkpoint and transcript_data is not None:
+            checkpoint.save('transcript_json', transcript_data)
+
+    formatted = _finish_transcript(transcript_data, cache_key if use_cache else None)
+    if checkpoint and transcript_data is not None:
+        checkpoint.save('formatted_transcript', formatted)
+    return formatted
+
+def _diarize_streamed(video_path, audio_format, use_cache, progress):
+    job_name = f'transcription_job_{int(time.time())}_{uuid.uuid4().hex[:8]}'
+    base_name = os.path.splitext(os.path.basename(video_path))[0]
+    try:
+        file_uri, audio_hash = stream_audio_to_s3(video_path, 'transcriptionjobbucket',
+                                                  f"{job_name}/{base_name}.{audio_format}",
+                                                  audio_format=audio_format,
+                                                  progress_callback=upload_progress(progress))
+    except Exception as e:
+        print(f"Error streaming audio to S3: {e}")
         return "Audio conversion failed."
-    
-    bucket_name = 'transcriptionjobbucket'
-    s3_file_key = os.path.basename(wav_path)
-    file_uri = upload_to_s3(wav_path, bucket_name, s3_file_key)
 
-    job_name = f'transcription_job_{int(time.time())}'
-    transcript_url = transcribe_audio(file_uri, job_name)
-    
+    cache_key = None
+    if use_cache:
+        cache_key = transcript_cache.key_for_hash(audio_hash, {'IdentifyLanguage': True, **TRANSCRIBE_SETTINGS})
+        cached = transcript_cache.get(cache_key)
+        print('transcript cache:', transcript_cache.stats())
+        if cached is not None:
+            return cached['formatted']
+
+    transcript_url = transcribe_audio(file_uri, job_name, media_format=audio_format)
     print('transcript url:', transcript_url)
+    return _finish_transcript(download_transcript(transcript_url) if transcript_url else None, cache_key)
 
-    if transcript_url:
-        transcript_data = download_transcript(transcript_url)
-        if transcript_data is None:
-            return "Failed to download transcript."
-        
-        transcriptions = extract_transcriptions_with_speakers(transcript_data)
-        print('transcriptions:', transcriptions)
+def _finish_transcript(transcript_data, cache_key):
+    if transcript_data is None:
+        return "Transcription failed."
 
-        output = []
-        for i, trans in enumerate(transcriptions, 1):
-            output.append(f"[{i}. {trans['speaker']} | text: {trans['text']}]\n")
+    with timed('extract_speakers'):
+        transcript = Transcript.from_transcribe(transcript_data)
+        formatted = transcript.render()
+    print(f"transcript: {len(transcript)} words, {len(transcript.turn_bounds()[0])} turns, "
+          f"{len(transcript.speaker_names)} speakers")
 
-        # Clean up: remove the temporary WAV file
-        os.remove(wav_path)
+    if cache_key is not None:
+        transcript_cache.put(cache_key, transcript_data, formatted)
 
-        return '\n'.join(output)
-    else:
-        return "Transcription failed."
\ No newline at end of file
+    return formatted
@@ -1,6 +1,11 @@
 import plotly.graph_objs as go
+from instrumentation import timed
 
 def create_charts(results):
+    with timed('create_charts'):
+        return _create_charts(results)
+
+def _create_charts(results):
     charts = {}
     explanations = {}
     general_impressions = {}